@@ -5,6 +5,13 @@ import pymongo
 import pyes
 from session import MongoCookieSessionFactoryConfig
 from authorization import ACLAuthorizationPolicyWithLocalRoles
+from traversal import ContentPathTraverser
+from sortindexes import SortIndexManager
+import indexqueue
+from htmlutil import html_text_cache
+from searchcache import search_cache
+from resources.history import revision_cache
+from diffutil import diff_strategy
 from pyramid.events import subscriber, NewRequest
 
 def main(global_config, **settings):
@@ -17,6 +24,20 @@ def main(global_config, **settings):
     settings['es_uri'] = es_uri
     es_timeout = float(settings.get('es_timeout', '5.0'))
     settings['es_timeout'] = es_timeout
+    settings['es_bulk_size'] = int(settings.get('es_bulk_size', '500'))
+    settings['es_bulk_flush_interval'] = float(settings.get('es_bulk_flush_interval', '5.0'))
+    settings['es_async_indexing'] = asbool(settings.get('es_async_indexing'))
+    settings['persist_extracted_text'] = asbool(settings.get('persist_extracted_text'))
+    html_text_cache.max_size = int(settings.get('extracted_text_cache_size', '1000'))
+    settings['search_principal_buckets'] = asbool(settings.get('search_principal_buckets'))
+    search_cache.ttl = float(settings.get('search_cache_ttl', '0'))
+    search_cache.max_size = int(settings.get('search_cache_size', '1000'))
+    settings['history_keyframe_interval'] = int(settings.get('history_keyframe_interval', '50'))
+    settings['history_keyframe_size'] = int(settings.get('history_keyframe_size', '262144'))
+    revision_cache.max_size = int(settings.get('history_revision_cache_size', '100'))
+    revision_cache.max_chars = int(settings.get('history_revision_cache_chars', '10485760'))
+    diff_strategy.line_mode_size = int(settings.get('history_diff_line_mode_size', '10000'))
+    diff_strategy.timeout = float(settings.get('history_diff_timeout', '1.0'))
     filter_unauth_traversal = asbool(settings.get('filter_unauth_traversal'))
     settings['filter_unauth_traversal'] = filter_unauth_traversal
 
@@ -26,6 +47,7 @@ def main(global_config, **settings):
     config.include('pyramid_zcml')
     config.load_zcml(zcml_file)
     config.include('pyramid_mailer')
+    config.add_traverser(ContentPathTraverser)
 
     # Do initialization based on custom settings.
     db_conn = pymongo.Connection(db_uri, tz_aware=True)
@@ -45,17 +67,27 @@ def main(global_config, **settings):
 def ensure_db_indexes(conn, db_name):
     db = conn[db_name]
     db['content'].ensure_index([('__parent__', pymongo.ASCENDING), ('__name__', pymongo.ASCENDING)], unique=True)
-    #db['history'].ensure_index([('ids', pymongo.ASCENDING), ('time', pymongo.DESCENDING)])
-    #db['history'].ensure_index([('user', pymongo.ASCENDING), ('time', pymongo.DESCENDING)])
-    db['history'].ensure_index([('ids', pymongo.ASCENDING)])
-    db['history'].ensure_index([('user', pymongo.ASCENDING)])
+    db['content'].ensure_index([('_path', pymongo.ASCENDING)])
+    # Compound indexes for keyset pagination of child listings (see keysetutil).
+    db['content'].ensure_index([('__parent__', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    # Children of ordered folders are listed by position.
+    db['content'].ensure_index([('__parent__', pymongo.ASCENDING), ('_position', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    # Indexes for the sort choices offered by the content types.
+    # Indexes for the sorts of specific folders are reported on (and created)
+    # by the recms-sort-indexes script.
+    SortIndexManager(db['content'], Root._content_type_factories.values()).sync(drop=False, include_folders=False)
+    db['history'].ensure_index([('ids', pymongo.ASCENDING), ('time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+    db['history'].ensure_index([('user', pymongo.ASCENDING), ('time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+    indexqueue.ensure_indexes(db[indexqueue.COLLECTION_NAME])
     db['users'].ensure_index([('__name__', pymongo.ASCENDING)], unique=True)
     db['groups'].ensure_index([('__name__', pymongo.ASCENDING)], unique=True)
     # FIXME: add session indexes?
     # FIXME: add indexes to gridfs?
 
 def ensure_es_index(conn, es_name):
-    conn.create_index_if_missing(es_name)
+    # es_name may be an alias (see the recms-reindex script).
+    if es_name not in conn.get_indices(include_aliases=True):
+        conn.create_index(es_name)
     # FIXME: should we have one doctype for all Content, or should each Content subclass have its own doctype/mapping?
     #conn.put_mapping(Content._get_es_doctype(), {'properties':Content._get_es_mapping()}, [es_name])
 
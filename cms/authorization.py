@@ -1,8 +1,11 @@
 from zope.interface import implements
-from pyramid.interfaces import IAuthorizationPolicy
+from pyramid.interfaces import IAuthorizationPolicy, IAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.security import Allow, Allowed, ACLAllowed, ACLDenied
+from pyramid.traversal import lineage
 
 import logging
+import threading
 log = logging.getLogger(__name__)
 
 class ACLAuthorizationPolicyWithLocalRoles(object):
@@ -16,6 +19,11 @@ class ACLAuthorizationPolicyWithLocalRoles(object):
 
     def permits(self, context, principals, permission):
         #log.debug("permits(context=%s, principals=%s, permission=%s)" % (repr(context), repr(principals), repr(permission)))
+        principals = self._expand_principals(context, principals)
+        return self.acl_policy.permits(context, principals, permission)
+
+    def _expand_principals(self, context, principals):
+        # Add the "role" principals granted to any of the principals by local roles.
         try:
             local_roles = context._get_merged_local_roles()
         except AttributeError:
@@ -28,7 +36,62 @@ class ACLAuthorizationPolicyWithLocalRoles(object):
                     expanded_principals.update(roles)
             #log.debug("in permits - local_roles=%s expanded_principals=%s" % (repr(local_roles), repr(expanded_principals)))
             principals = expanded_principals
-        return self.acl_policy.permits(context, principals, permission)
+        return principals
+
+    def permits_many(self, contexts, principals, permission):
+        """ Like permits(), but evaluates a sequence of contexts (typically siblings,
+        such as the children listed on a folder contents page) in one pass.
+        Returns a list of ACLAllowed/ACLDenied results in the same order as contexts.
+        Each context's own ACL is resolved with the trash status of its parent and
+        the publication workflow looked up only once, and the result for the rest of
+        the lineage is computed once per parent (and set of effective principals).
+        """
+        results = []
+        in_trash_by_parent = {}
+        workflows = {}
+        lineage_results = {}
+        for context in contexts:
+            expanded = self._expand_principals(context, principals)
+            parent = getattr(context, '__parent__', None)
+            get_acl = getattr(context, '_get_acl', None)
+            if (parent is None) or (get_acl is None):
+                results.append(self.acl_policy.permits(context, expanded, permission))
+                continue
+            parent_key = id(parent)
+            if parent_key not in in_trash_by_parent:
+                in_trash_by_parent[parent_key] = context.in_trash()
+            acl = get_acl(in_trash=in_trash_by_parent[parent_key], workflows=workflows)
+            result = None
+            if acl is not None:
+                result = _match_acl(context, acl, expanded, permission)
+            if result is None:
+                key = (parent_key, frozenset(expanded))
+                if key not in lineage_results:
+                    lineage_results[key] = self.acl_policy.permits(parent, expanded, permission)
+                result = lineage_results[key]
+            results.append(result)
+        return results
+
+    def permitted_permissions(self, context, principals, permissions):
+        """ Return the subset of permissions that are granted in context to principals.
+        The ACL of each object in the lineage is resolved only once, which is
+        handy when building the menu of actions for a page.
+        """
+        principals = self._expand_principals(context, principals)
+        acls = []
+        for location in lineage(context):
+            try:
+                acls.append((location, location.__acl__))
+            except AttributeError:
+                continue
+        result = set()
+        for permission in permissions:
+            for (location, acl) in acls:
+                match = _match_acl(location, acl, principals, permission)
+                if match is not None:
+                    if match: result.add(permission)
+                    break
+        return result
 
     def principals_allowed_by_permission(self, context, permission):
         #log.debug("principals_allowed_by_permission(context=%s, permission=%s)" % (repr(context), repr(permission)))
@@ -38,7 +101,10 @@ class ACLAuthorizationPolicyWithLocalRoles(object):
         except AttributeError:
             local_roles = None
         if local_roles:
-            principals_by_role = _invert_local_roles(local_roles)
+            try:
+                principals_by_role = context._get_inverted_local_roles()
+            except AttributeError:
+                principals_by_role = _invert_local_roles(local_roles)
             expanded_allowed = set(allowed)
             for r in allowed:
                 principals = principals_by_role.get(r)
@@ -48,6 +114,53 @@ class ACLAuthorizationPolicyWithLocalRoles(object):
             allowed = expanded_allowed
         return allowed
 
+def _match_acl(location, acl, principals, permission):
+    # Check a single ACL the same way pyramid's ACLAuthorizationPolicy does.
+    # Returns ACLAllowed or ACLDenied for the first matching ACE, or None if no ACE matched.
+    for ace in acl:
+        ace_action, ace_principal, ace_permissions = ace
+        if ace_principal in principals:
+            if not hasattr(ace_permissions, '__iter__'):
+                ace_permissions = [ace_permissions]
+            if permission in ace_permissions:
+                if ace_action == Allow:
+                    return ACLAllowed(ace, acl, permission, principals, location)
+                else:
+                    return ACLDenied(ace, acl, permission, principals, location)
+    return None
+
+def _get_principals_and_policy(request):
+    # Returns a 2-tuple of (principals, authorization policy) or None if no authentication policy is in use.
+    reg = request.registry
+    authn_policy = reg.queryUtility(IAuthenticationPolicy)
+    if authn_policy is None:
+        return None
+    return (authn_policy.effective_principals(request), reg.queryUtility(IAuthorizationPolicy))
+
+def has_permission_many(permission, contexts, request):
+    """ Like pyramid.security.has_permission(), but for a sequence of contexts.
+    Returns a list of results in the same order as contexts.
+    """
+    info = _get_principals_and_policy(request)
+    if info is None:
+        return [Allowed('No authentication policy in use.') for context in contexts]
+    (principals, policy) = info
+    if hasattr(policy, 'permits_many'):
+        return policy.permits_many(contexts, principals, permission)
+    return [policy.permits(context, principals, permission) for context in contexts]
+
+def get_permitted_permissions(permissions, context, request):
+    """ Return the set of the given permissions that are granted in context
+    to the user implied by the request.
+    """
+    info = _get_principals_and_policy(request)
+    if info is None:
+        return set(permissions)
+    (principals, policy) = info
+    if hasattr(policy, 'permitted_permissions'):
+        return policy.permitted_permissions(context, principals, permissions)
+    return set([p for p in permissions if policy.permits(context, principals, p)])
+
 def _invert_local_roles(local_roles):
     # Given a dictionary where each key is a principal name and each value is a sequence of "role" principals,
     # return a dictionary where each key is a role prinicipal and each value is a set of principal names.
@@ -58,3 +171,80 @@ def _invert_local_roles(local_roles):
             s.add(principal)
             result[role] = s
     return result
+
+class MergedLocalRolesCache(object):
+    """ A process-wide cache of merged local roles (see Content._get_merged_local_roles())
+    keyed by the _id of each object.
+    An entry is only reused if it was computed in the current generation, from
+    the same local roles and from the same (cached) merged roles of the parent.
+    Code that changes local roles should call invalidate() to bump the generation.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.generation = 0
+        self._entries = {}
+        # Requests are handled in several threads.
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries = {}
+
+    def get_merged_local_roles(self, _id, local_roles, parent_merged):
+        """ Return a dictionary where each key is a principal name and each value
+        is a set of system-level group principal names.
+        local_roles is the object's own local roles, parent_merged the merged
+        roles of its parent (or None for the root).
+        The result is shared, so callers must not modify it.
+        """
+        with self._lock:
+            generation = self.generation
+            entry = self._entries.get(_id)
+            if entry and (entry[0] == generation) and (entry[1] is parent_merged) and (entry[2] == local_roles):
+                return entry[3]
+        merged = {}
+        if parent_merged:
+            merged.update(parent_merged)
+        for (principal, sysgroup) in local_roles.items():
+            local_sysgroups = set(merged.get(principal, ()))
+            local_sysgroups.add(sysgroup)
+            merged[principal] = local_sysgroups
+        if _id is not None:
+            with self._lock:
+                # Don't cache roles computed before an invalidation.
+                if generation == self.generation:
+                    if len(self._entries) >= self.max_size: self._entries = {}
+                    self._entries[_id] = [generation, parent_merged, dict(local_roles), merged, None]
+        return merged
+
+    def get_inverted_local_roles(self, _id, merged):
+        """ Return the inverse of the given merged local roles (see _invert_local_roles()),
+        reusing the result computed for the cached entry of _id if possible.
+        """
+        with self._lock:
+            entry = self._entries.get(_id)
+            if entry and (entry[3] is merged) and (entry[4] is not None):
+                return entry[4]
+        inverted = _invert_local_roles(merged)
+        if entry and (entry[3] is merged): entry[4] = inverted
+        return inverted
+
+local_roles_cache = MergedLocalRolesCache()
+
+def get_principal_buckets(principals):
+    """ Split a user's effective principals into a list of sorted lists:
+    system principals (such as "system.Everyone"), then groups ("group:..."),
+    then anything user-specific (the userid).  Empty buckets are omitted.
+    The first two buckets are shared by many users, so search filters built
+    from them can be cached and reused by ElasticSearch.
+    """
+    system = []
+    groups = []
+    personal = []
+    for principal in set(principals):
+        if principal.startswith('system.'): system.append(principal)
+        elif principal.startswith('group:'): groups.append(principal)
+        else: personal.append(principal)
+    return [sorted(x) for x in (system, groups, personal) if x]
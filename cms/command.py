@@ -46,7 +46,8 @@ def edit(request, obj, appstruct, pre_save=None):
     log_history(request, 'edit',
         ids=[object_id],
         object_path=object_path,
-        changes=changes)
+        changes=changes,
+        **HistoryCollection(request).get_keyframe_fields(object_id, changes, new_values))
     return True
 
 def comment(request, obj, comment):
@@ -89,7 +90,8 @@ def revert(request, obj, history_id):
         object_path=object_path,
         changes=changes,
         history_id=history_id,
-        history_time=history_time)
+        history_time=history_time,
+        **hc.get_keyframe_fields(object_id, changes, new_values))
     return True
 
 def rename_children(request, parent, names):
@@ -2,6 +2,7 @@ from gridfs import GridFS
 from pyramid.response import Response
 from gridfs.errors import NoFile
 from pyramid.httpexceptions import HTTPNotFound
+from cms.esbulk import BulkIndexer, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL
 
 def get_mongodb(request):
     if not hasattr(request, '_db'):
@@ -30,12 +31,47 @@ def encode_keys(d):
         result[key.encode('utf-8')] = value
     return result
 
+def fetch_limit(limit, count):
+    """ Return the limit to pass to find() for a batch of "limit" documents.
+    When not counting, one extra document is fetched to find out if there are more.
+    """
+    if limit and not count: return limit + 1
+    return limit
+
+def get_batch(cursor, skip, limit, count=True, construct=None):
+    """ Given a cursor (whose limit was set by fetch_limit()), return a
+    dictionary with the keys "items" (a list of documents, or of whatever
+    construct() returns for each document), "total" and "has_more".
+    If count is False, "total" is None and no count query is sent to MongoDB.
+    """
+    total = None
+    if count: total = cursor.count()
+    items = []
+    has_more = False
+    for doc in cursor:
+        if limit and (len(items) == limit):
+            has_more = True
+            break
+        if construct: doc = construct(doc)
+        items.append(doc)
+    if count: has_more = (skip + len(items)) < total
+    return dict(total=total, items=items, has_more=has_more)
+
 def get_es_conn(request):
     return request.registry.settings['es_conn']
 
 def get_es_index_name(request):
     return request.registry.settings['es_name']
 
+def get_es_bulk_indexer(request):
+    """ Return a new esbulk.BulkIndexer configured by the "es_bulk_size"
+    and "es_bulk_flush_interval" settings.  Call its close() method when done.
+    """
+    settings = request.registry.settings
+    return BulkIndexer(get_es_conn(request), get_es_index_name(request),
+                       batch_size=settings.get('es_bulk_size', DEFAULT_BATCH_SIZE),
+                       flush_interval=settings.get('es_bulk_flush_interval', DEFAULT_FLUSH_INTERVAL))
+
 def serve_gridfs_file(file):
     response = Response()
     response.content_type = file.content_type
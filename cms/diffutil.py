@@ -1,5 +1,8 @@
 from thirdparty import diff_match_patch, htmldiff
 import copy
+import time
+import logging
+log = logging.getLogger(__name__)
 
 dmp = diff_match_patch.diff_match_patch()
 
@@ -139,17 +142,108 @@ def diff_flattened_dictionaries(fd1, fd2):
                 # Note: All patches will start with "@@ ".
                 # Code that reconstructs old versions of edited objects can check
                 # for this prefix to decide whether the stored change is a patch or the old string.
-                try:
-                    patch = dmp.patch_toText(dmp.patch_make(new, old))
-                    if len(patch) < len(old):
-                        change = patch
-                except:
-                    pass
+                change = diff_strategy.get_change(key, old, new)
             changes.append((key, change))
     return changes
 
+class DiffStrategy(object):
+    """ Decides how to store the old value of a changed string in a patch
+    (see diff_flattened_dictionaries()): as the old value itself, or as a
+    diff-match-patch patch computed character by character or (for large
+    multi-line strings) line by line.  The time spent computing each patch
+    is capped by timeout (diff-match-patch's Diff_Timeout; the result is
+    still correct, just less compact), and is recorded per top-level field
+    for get_stats().
+    """
+
+    # A patch takes a dozen characters or so ("@@ -1 +1 @@") before any of
+    # the changed text, so shorter old values are just stored as is.
+    min_patch_size = 16
+
+    def __init__(self, line_mode_size=10000, timeout=1.0):
+        self.line_mode_size = line_mode_size
+        self.dmp = diff_match_patch.diff_match_patch()
+        self.dmp.Diff_Timeout = timeout
+        self.clear()
+
+    def _get_timeout(self):
+        return self.dmp.Diff_Timeout
+    def _set_timeout(self, timeout):
+        self.dmp.Diff_Timeout = timeout
+    timeout = property(_get_timeout, _set_timeout)
+
+    def get_strategy(self, old, new):
+        if len(old) < self.min_patch_size or not new:
+            return 'value'
+        if self.line_mode_size and max(len(old), len(new)) >= self.line_mode_size and new.count('\n') > 1:
+            return 'lines'
+        return 'chars'
+
+    def get_change(self, key, old, new):
+        """ Return what to store in the patch for key: the old value or a
+        patch that turns new into old.
+        """
+        strategy = self.get_strategy(old, new)
+        if strategy == 'value':
+            return old
+        start = time.time()
+        change = old
+        try:
+            if strategy == 'lines':
+                (chars1, chars2, lines) = self.dmp.diff_linesToChars(new, old)
+                diffs = self.dmp.diff_main(chars1, chars2, False)
+                self.dmp.diff_charsToLines(diffs, lines)
+                patch = self.dmp.patch_toText(self.dmp.patch_make(new, diffs))
+            else:
+                patch = self.dmp.patch_toText(self.dmp.patch_make(new, old))
+            if len(patch) < len(old):
+                change = patch
+            else:
+                strategy = 'value'
+        except:
+            strategy = 'value'
+        self._record(key, strategy, time.time() - start)
+        return change
+
+    def _record(self, key, strategy, seconds):
+        field = get_top_level_key(key)
+        stats = self._fields.get(field)
+        if stats is None:
+            stats = self._fields[field] = dict(count=0, seconds=0.0, max_seconds=0.0)
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        self._strategies[strategy] = self._strategies.get(strategy, 0) + 1
+        log.debug("diffed %s (%s) in %.3f seconds" % (key, strategy, seconds))
+
+    def get_stats(self):
+        """ Return a dictionary with "fields" (a dictionary of count, seconds
+        and max_seconds by top-level field name) and "strategies" (the
+        number of changes stored as "chars" or "lines" patches, or as the
+        old "value" after an attempt to patch).
+        """
+        return dict(fields=copy.deepcopy(self._fields), strategies=dict(self._strategies))
+
+    def clear(self):
+        self._fields = {}
+        self._strategies = {}
+
+diff_strategy = DiffStrategy()
+
 def patch_flattened_dictionary(fd, patch):
+    return patch_flattened_dictionary_multi(fd, [patch])
+
+def patch_flattened_dictionary_multi(fd, patches):
+    """ Apply a sequence of patches (in order) to a flattened dictionary.
+    Returns a patched copy; fd itself is left alone.
+    """
     patched = copy.copy(fd)
+    index = ListKeyIndex(patched)
+    for patch in patches:
+        _patch_in_place(patched, patch, index)
+    return patched
+
+def _patch_in_place(fd, patch, index):
     lengths = {}
     for (name, value) in patch:
         if name.endswith('__len__'):
@@ -158,24 +252,70 @@ def patch_flattened_dictionary(fd, patch):
         else:
             if type(value) in (str, unicode) and value.startswith('@@ '):
                 # Apply patch
-                current = patched.get(name, '')
+                current = fd.get(name, '')
                 value = dmp.patch_apply(dmp.patch_fromText(value), current)[0]
-        patched[name] = value
+        if name not in fd: index.add(name)
+        fd[name] = value
 
     # Shorten lists (as needed):
     for (listname, length) in lengths.items():
-        prefix = listname+'['
-        names_to_del = []
-        for (name, value) in patched.items():
-            if name.startswith(prefix):
-                tmp = name[len(prefix):]
-                bracket_idx = tmp.index(']')
-                list_idx = int(tmp[:bracket_idx])
-                if list_idx >= length:
-                    names_to_del.append(name)
-        for name in names_to_del:
-            del patched[name]
-    return patched
+        for name in index.pop_items(listname, length):
+            del fd[name]
+
+class ListKeyIndex(object):
+    """ An index of the keys of a flattened dictionary by the lists they're in,
+    so that the items past the end of a shortened list can be found without
+    scanning all the keys.
+    For example, "a[1].b[2].c" is item 1 of list "a" and item 2 of list "a[1].b".
+    """
+
+    def __init__(self, fd=()):
+        # {listname: {list index: set of keys}}
+        self._lists = {}
+        # {listname: one past the highest list index added} (an upper bound,
+        # so that pop_items() only looks at the positions it removes).
+        self._ends = {}
+        for name in fd:
+            self.add(name)
+
+    def _get_positions(self, name):
+        positions = []
+        start = name.find('[')
+        while start != -1:
+            end = name.find(']', start)
+            if end == -1: break
+            try:
+                positions.append((name[:start], int(name[start+1:end])))
+            except ValueError:
+                pass # Not a list item (just a key with a bracket in it).
+            start = name.find('[', end)
+        return positions
+
+    def add(self, name):
+        for (listname, list_idx) in self._get_positions(name):
+            self._lists.setdefault(listname, {}).setdefault(list_idx, set()).add(name)
+            if list_idx >= self._ends.get(listname, 0): self._ends[listname] = list_idx + 1
+
+    def remove(self, name):
+        for (listname, list_idx) in self._get_positions(name):
+            items = self._lists.get(listname, {})
+            names = items.get(list_idx)
+            if names is None: continue
+            names.discard(name)
+            if not names: del items[list_idx]
+
+    def pop_items(self, listname, length):
+        """ Remove the keys of the items of listname at positions >= length
+        from the index, and return them.
+        """
+        items = self._lists.get(listname, {})
+        removed = []
+        for list_idx in xrange(length, self._ends.get(listname, 0)):
+            removed.extend(items.get(list_idx, ()))
+        for name in removed:
+            self.remove(name)
+        if self._ends.get(listname, 0) > length: self._ends[listname] = length
+        return removed
 
 def diff_dictionaries(d1, d2):
     """ Returns a patch (a list of name-value tuples) that can be passed to
@@ -190,10 +330,7 @@ def patch_dictionary(d, patch):
     return unflatten_dictionary(patch_flattened_dictionary(flatten_dictionary(d), patch))
 
 def patch_dictionary_multi(d, patches):
-    f = flatten_dictionary(d)
-    for patch in patches:
-        f = patch_flattened_dictionary(f, patch)
-    return unflatten_dictionary(f)
+    return unflatten_dictionary(patch_flattened_dictionary_multi(flatten_dictionary(d), patches))
 
 def get_patch_keys(patch, top_level_only=False):
     """ Returns a list of the "keys" in a patch.
@@ -202,9 +339,25 @@ def get_patch_keys(patch, top_level_only=False):
     keys = set()
     for (key, value) in patch:
         if top_level_only:
-            key = key.split('.')[0]
-            if '[' in key:
-                bracket_idx = key.index('[')
-                key = key[:bracket_idx]
+            key = get_top_level_key(key)
         keys.add(key)
     return keys
+
+def get_top_level_key(key):
+    key = key.split('.')[0]
+    if '[' in key:
+        bracket_idx = key.index('[')
+        key = key[:bracket_idx]
+    return key
+
+def get_patch_size(patch):
+    """ Returns the approximate size (in characters) of a patch.
+    (Used to decide when to store a full snapshot in the edit history.)
+    """
+    size = 0
+    for (key, value) in patch:
+        if type(value) in (str, unicode):
+            size += len(key) + len(value)
+        else:
+            size += len(key) + len(repr(value))
+    return size
@@ -0,0 +1,171 @@
+""" Buffered ElasticSearch "_bulk" indexing.
+
+Recursive operations (moving, trashing, restoring or publishing a folder)
+may have to (re)index thousands of documents.  Instead of one request per
+document, a BulkIndexer buffers index/delete actions and sends them in
+batches, flushing when the batch is full or when flush_interval seconds
+have passed since the last flush.  Either trigger can be disabled by
+passing None, for callers that want to decide when to flush.
+
+pyes has its own bulk buffer, but it lives on the (shared) connection
+object and discards the response, so errors for individual documents
+would go unnoticed.  Here each batch's response is checked and failures
+are logged and collected in the report.
+
+ElasticSearch 0.19 can't do partial updates in a "_bulk" request, so
+update() actions (which only replace some fields of a document) are
+resolved at flush time: the current sources are fetched with one "_mget"
+request, the new field values are merged in, and the documents are sent
+as ordinary index actions.  That's still much cheaper than rebuilding the
+documents from the content objects (which means walking the schema and
+converting rich text to plain text).  Only documents that turn out to be
+missing from the index are rebuilt (if the caller passed a way to).
+"""
+
+import time
+import json
+import logging
+from cms.searchcache import search_cache
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+class BulkIndexError(Exception):
+    """ Raised by BulkIndexer.close(check=True) when some actions failed.
+    The report attribute is the bulk report (see BulkIndexer.close()).
+    """
+    def __init__(self, report):
+        self.report = report
+        errors = report['errors']
+        first = errors[0]
+        Exception.__init__(self, "%s of %s ElasticSearch bulk actions failed (first: %s %s: %s)" % (
+            len(errors), report['count'], first['op'], first['_id'], first['error']))
+
+class BulkIndexer(object):
+
+    def __init__(self, conn, index_name, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.conn = conn
+        self.index_name = index_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._actions = []
+        # Buffered (op, doc) by document _id.
+        self._pending = {}
+        # Callables that return the full document, for updates of missing documents.
+        self._get_documents = {}
+        self._last_flush = time.time()
+        self.batches = 0
+        self.count = 0
+        self.errors = []
+
+    def index(self, doctype, _id, doc):
+        action = dict(_index=self.index_name, _type=doctype, _id=str(_id))
+        self._add('index', action, doc)
+
+    def update(self, doctype, _id, fields, get_document=None):
+        """ Replace just the given fields (a dictionary) of an indexed document.
+        If the document isn't in the index, the full document returned by
+        get_document() (if passed) is indexed instead.
+        """
+        action = dict(_index=self.index_name, _type=doctype, _id=str(_id))
+        # Fold into an index action for the same document that's still buffered.
+        pending = self._pending.get(action['_id'])
+        if pending is not None:
+            (op, doc) = pending
+            if op != 'delete': doc.update(fields)
+            return
+        if get_document is not None: self._get_documents[action['_id']] = get_document
+        self._add('update', action, dict(fields))
+
+    def delete(self, doctype, _id):
+        action = dict(_index=self.index_name, _type=doctype, _id=str(_id))
+        self._add('delete', action)
+
+    def _add(self, op, action, doc=None):
+        self._actions.append((op, action, doc))
+        self._pending[action['_id']] = (op, doc)
+        if ((self.batch_size is not None) and (len(self._actions) >= self.batch_size)) or \
+           ((self.flush_interval is not None) and (time.time() - self._last_flush >= self.flush_interval)):
+            self.flush()
+
+    def get_pending_count(self):
+        return len(self._actions)
+
+    def flush(self):
+        """ Send the buffered actions (if any) as one "_bulk" request. """
+        self._last_flush = time.time()
+        if not self._actions: return
+        actions = self._actions
+        get_documents = self._get_documents
+        self._actions = []
+        self._pending = {}
+        self._get_documents = {}
+        self.batches += 1
+        self.count += len(actions)
+        try:
+            actions = self._resolve_updates(actions, get_documents)
+            lines = []
+            for (op, action, doc) in actions:
+                lines.append(json.dumps({op: action}, cls=self.conn.encoder))
+                if doc is not None:
+                    lines.append(json.dumps(doc, cls=self.conn.encoder))
+            if not lines: return
+            body = '\n'.join(lines) + '\n'
+            # pyes 0.16 has no public method that returns the bulk response.
+            response = self.conn._send_request('POST', '/_bulk', body)
+            search_cache.invalidate()
+        except Exception, e:
+            log.error("bulk batch %s (%s actions) failed: %s" % (self.batches, len(actions), e))
+            for (op, action, doc) in actions:
+                self.errors.append(dict(batch=self.batches, op=op, _id=action['_id'], error=str(e)))
+            return
+        errors = 0
+        for item in response.get('items', []):
+            for (op, result) in item.items():
+                if result.get('error'):
+                    errors += 1
+                    self.errors.append(dict(batch=self.batches, op=op, _id=result.get('_id'), error=result['error']))
+        if errors:
+            log.error("bulk batch %s: %s of %s actions failed" % (self.batches, errors, len(actions)))
+
+    def _resolve_updates(self, actions, get_documents):
+        """ Turn update actions into index actions of the merged documents
+        (or of the full documents, for documents missing from the index).
+        """
+        updates = [action for (op, action, doc) in actions if op == 'update']
+        if not updates: return actions
+        body = dict(docs=[dict(_index=x['_index'], _type=x['_type'], _id=x['_id']) for x in updates])
+        sources = {}
+        for item in self.conn._send_request('GET', '/_mget', body).get('docs', []):
+            if item.get('exists'):
+                sources[(item['_type'], item['_id'])] = item['_source']
+        result = []
+        for (op, action, doc) in actions:
+            if op == 'update':
+                source = sources.get((action['_type'], action['_id']))
+                if source is None:
+                    get_document = get_documents.get(action['_id'])
+                    if get_document is None:
+                        self.errors.append(dict(batch=self.batches, op=op, _id=action['_id'], error='DocumentMissingException'))
+                        continue
+                    log.info("%s %s is missing from the index; indexing the full document" % (action['_type'], action['_id']))
+                    source = get_document()
+                source.update(doc)
+                (op, doc) = ('index', source)
+            result.append((op, action, doc))
+        return result
+
+    def close(self, check=False):
+        """ Flush any remaining actions and return a report dictionary
+        with the keys "count", "batches" and "errors" (a list of dictionaries
+        with the keys "batch", "op", "_id" and "error").
+        If check is True, raise a BulkIndexError instead if there were errors.
+        """
+        self.flush()
+        report = self.get_report()
+        if check and report['errors']: raise BulkIndexError(report)
+        return report
+
+    def get_report(self):
+        return dict(count=self.count, batches=self.batches, errors=self.errors)
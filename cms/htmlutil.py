@@ -8,81 +8,54 @@ def sniff_html(s):
 #  Converts HTML to text by stripping out HTML elements,
 #  and in some cases handling elements in special ways.
 #  Originally based on code in The Python Cookbook, recipe 10.8
+#  (an htmllib parser with a formatter/writer).  Now a single regular
+#  expression walks the tags, entities and text, and the output is collected
+#  in a list (the output is the same as the htmllib version's, see
+#  HTMLToTextTests.test_htmllib_equivalence; the one deliberate difference is
+#  that named entities in link urls are UTF-8 rather than Latin-1 encoded).
 
-import htmllib, formatter, cStringIO
 import htmlentitydefs
 import re
-
-class HTML_to_text_parser(htmllib.HTMLParser):
-    def __init__(self, formatter, show_link_urls=1, skip_tags=[], unknown_entity_replacement=None):
-        htmllib.HTMLParser.__init__(self, formatter)
-        self.last_href = None
-        self.formatter = formatter
-        self.show_link_urls = show_link_urls
-        self.skip_tags = ["head", "script"]
-        for x in skip_tags:
-            if x not in self.skip_tags: self.skip_tags.append(x)
-        self.unknown_entity_replacement = unknown_entity_replacement  # None signifies that the value should be passed through as-is.  In some cases, you may instead want "?" or "" or some such.
-        self.skip_flag = 0
-
-    def handle_starttag(self, tag, method, attrs):
-        if(tag in self.skip_tags):
-            self.skip_flag += 1
-        if self.skip_flag: return
-
-        if(tag == 'a'):
-            self.last_href = None
-            for attr in attrs:
-                if(attr[0] == 'href'):
-                    self.last_href = attr[1]
-                    break
-        if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
-            self.formatter.add_literal_data("\n\n")
-        elif(tag == 'p'):
-            self.formatter.add_literal_data("\n\n")
-        elif(tag == 'br'):
-            self.formatter.add_literal_data("\n")
-        elif(tag == 'li'):
-            self.formatter.add_literal_data("\n\n- ")
-
-    def handle_endtag(self, tag, method):
-        if(tag in self.skip_tags):
-            if self.skip_flag: self.skip_flag -= 1
-            return
-        if self.skip_flag: return
-
-        if(self.show_link_urls and tag == 'a' and self.last_href):
-            self.formatter.add_literal_data(" [%s]" % self.last_href)
-
-        if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
-            self.formatter.add_literal_data("\n\n")
-        #else:  # Prevent words from running together.
-        #    self.formatter.add_literal_data(" ")
-
-    def unknown_starttag(self, tag, attrs):
-        return self.handle_starttag(tag, None, attrs)
-
-    def unknown_endtag(self, tag):
-        return self.handle_endtag(tag, None)
-
-    def handle_data(self, data):
-        if self.skip_flag: return
-        data = data.replace('\xc2\xa0', ' ') # Replace non-breaking spaces with regular spaces.
-        self.formatter.add_literal_data(data)
-
-    def handle_charref(self, ref):
-        # Handles &#ref;
-        self.handle_data(unichr(int(ref)).encode('utf-8'))
-
-    def handle_entityref(self, ref):
-        # Handles &ref;
-        match = htmlentitydefs.name2codepoint.get(ref, None)
-        if match:
-            self.handle_charref(match)
-        elif self.unknown_entity_replacement:
-            self.handle_data(self.unknown_entity_replacement)
-
-SELF_CLOSING_FIX_RE = re.compile(r'(\S)/>')
+import threading
+import collections
+import hashlib
+
+# Tags that htmllib treats as containers (the ones it has start_ methods for).
+# End tags for these are only handled if the tag is open; closing one also
+# closes any tags opened inside it.
+CONTAINER_TAGS = frozenset(['a', 'address', 'b', 'blockquote', 'body', 'cite', 'code', 'dir', 'dl', 'em',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'head', 'html', 'i', 'kbd', 'listing', 'menu', 'ol', 'pre',
+    'samp', 'strong', 'title', 'tt', 'ul', 'var', 'xmp'])
+HEADING_TAGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+
+# Like htmllib, only decimal character references are recognized.
+TOKEN_RE = re.compile(r"""
+    <!--.*?-->                                  # comment
+  | <[!?](?!--)[^>]*>                           # declaration or processing instruction
+  | <(/?)([a-zA-Z][-.a-zA-Z0-9]*)               # tag (groups 1 and 2)
+      ((?:[^>"']|"[^"]*"|'[^']*')*)>            # attributes (group 3)
+  | &(?:\#([0-9]+)                              # character reference (group 4)
+       |([a-zA-Z][-.a-zA-Z0-9]*));?             # entity reference (group 5)
+  | (<[!?].*)                                   # unterminated comment etc. (group 6)
+""", re.S | re.X)
+
+HREF_RE = re.compile(r"""\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I)
+REF_RE = re.compile(r"&(?:#([0-9]+)|([a-zA-Z][-.a-zA-Z0-9]*));?")
+
+def _convert_charref(ref):
+    try:
+        return unichr(int(ref)).encode('utf-8')
+    except ValueError:
+        return ''
+
+def _convert_attr_ref(match):
+    if match.group(1):
+        # htmllib only converts ASCII character references in attributes.
+        if int(match.group(1)) > 127: return match.group(0)
+        return chr(int(match.group(1)))
+    codepoint = htmlentitydefs.name2codepoint.get(match.group(2))
+    if codepoint: return unichr(codepoint).encode('utf-8')
+    return match.group(0)
 
 # Assumes html is a Unicode string or UTF-8 encoded.
 # The return value is the same type as the input.
@@ -92,22 +65,140 @@ def html_to_text(html, show_link_urls=1, skip_tags=[], unknown_entity_replacemen
         html = html.encode('utf-8')
         output_unicode = True
 
-    textout = cStringIO.StringIO()
-    formtext = formatter.AbstractFormatter(formatter.DumbWriter(textout))
-    parser = HTML_to_text_parser(formtext, show_link_urls, skip_tags, unknown_entity_replacement)
-
-    # Annoyingly HTMLParser doesn't handle self-closing tags without a space
-    # (such as "<br/>") properly.
-    # So let's add any missing spaces (for example, "<br />").
-    html = SELF_CLOSING_FIX_RE.sub(r'\1 />', html)
-
-    parser.feed(html)
-    parser.close()
-    text = textout.getvalue().strip()
-    del textout, formtext, parser
+    skip = set(["head", "script"])
+    skip.update(skip_tags)
+    name2codepoint = htmlentitydefs.name2codepoint
+    out = []
+    append = out.append
+    stack = []
+    skip_flag = 0
+    last_href = None
+    pos = 0
+
+    def end_tag(tag):
+        # Returns the change to skip_flag.
+        if tag in skip: return skip_flag and -1 or 0
+        if skip_flag: return 0
+        if show_link_urls and tag == 'a' and last_href:
+            append(" [%s]" % last_href)
+        if tag in HEADING_TAGS:
+            append("\n\n")
+        return 0
+
+    for match in TOKEN_RE.finditer(html):
+        start = match.start()
+        if start > pos and not skip_flag:
+            append(html[pos:start].replace('\xc2\xa0', ' '))
+        pos = match.end()
+        tag = match.group(2)
+        if tag is not None:
+            tag = tag.lower()
+            if match.group(1):
+                # End tag.
+                if tag in CONTAINER_TAGS:
+                    if tag not in stack: continue
+                    while stack:
+                        closed = stack.pop()
+                        skip_flag += end_tag(closed)
+                        if closed == tag: break
+                else:
+                    skip_flag += end_tag(tag)
+                continue
+            # Start tag.
+            if tag in CONTAINER_TAGS: stack.append(tag)
+            if tag in skip: skip_flag += 1
+            if skip_flag: continue
+            if tag == 'a':
+                last_href = None
+                href = HREF_RE.search(match.group(3))
+                if href:
+                    last_href = REF_RE.sub(_convert_attr_ref, href.group(1) or href.group(2) or href.group(3) or '')
+            elif tag in HEADING_TAGS or tag == 'p':
+                append("\n\n")
+            elif tag == 'br':
+                append("\n")
+            elif tag == 'li':
+                append("\n\n- ")
+            continue
+        if skip_flag: continue
+        if match.group(6):
+            # htmllib stops parsing here, and passes the rest through as text.
+            append(match.group(6).replace('\xc2\xa0', ' '))
+            continue
+        charref = match.group(4)
+        entityref = match.group(5)
+        if (charref or entityref) and (pos == len(html)) and not html.endswith(';'):
+            # Like htmllib, keep a reference that's cut off by the end of the input as is.
+            append(match.group(0))
+        elif charref:
+            append(_convert_charref(charref).replace('\xc2\xa0', ' '))
+        elif entityref:
+            codepoint = name2codepoint.get(entityref)
+            if codepoint:
+                append(unichr(codepoint).encode('utf-8').replace('\xc2\xa0', ' '))
+            elif unknown_entity_replacement:
+                append(unknown_entity_replacement)
+        # Comments, declarations and processing instructions are dropped.
+    if pos < len(html) and not skip_flag:
+        append(html[pos:].replace('\xc2\xa0', ' '))
+
+    text = ''.join(out).strip()
     if output_unicode: return unicode(text, 'utf-8')
     else: return text
 
+class HTMLTextCache(object):
+    """ A process-wide LRU cache of html_to_text() results, keyed by a hash
+    of the html (and the show_link_urls flag), so that reindexing content
+    whose rich text hasn't changed doesn't parse the html again.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        # Requests are handled in several threads.
+        self._lock = threading.Lock()
+
+    def get_key(self, html, show_link_urls=1):
+        if type(html) == unicode: html = html.encode('utf-8')
+        return '%s%s' % (show_link_urls and 'u' or 't', hashlib.sha1(html).hexdigest())
+
+    def get(self, key):
+        with self._lock:
+            text = self._entries.pop(key, None)
+            if text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[key] = text
+            return text
+
+    def set(self, key, text):
+        if not self.max_size: return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = text
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def html_to_text(self, html, show_link_urls=1):
+        key = self.get_key(html, show_link_urls)
+        text = self.get(key)
+        if text is None:
+            text = html_to_text(html, show_link_urls)
+            self.set(key, text)
+        return text
+
+    def get_stats(self):
+        return dict(size=len(self._entries), hits=self.hits, misses=self.misses)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+html_text_cache = HTMLTextCache()
+
 def main():
     # Try to read stdin
     import sys
@@ -0,0 +1,74 @@
+import logging
+log = logging.getLogger(__name__)
+
+class IdentityMap(object):
+    """ A request-scoped cache of content objects, so that each document is
+    fetched from MongoDB and constructed at most once per request.
+    Objects are keyed both by their _id and by (parent _id, __name__).
+    The hits and misses attributes count lookups (handy for profiling).
+    """
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_name = {}
+        self._names_by_id = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, _id):
+        return _id in self._by_id
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _count(self, obj):
+        if obj is None: self.misses += 1
+        else: self.hits += 1
+        return obj
+
+    def get(self, _id):
+        return self._count(self._by_id.get(_id))
+
+    def get_by_name(self, parent_id, name):
+        return self._count(self._by_name.get((parent_id, name)))
+
+    def add(self, obj, parent_id, name):
+        """ Register obj (which should have been saved, so it has an _id)
+        under the given parent _id and name.  If obj was previously registered
+        under a different parent or name (it was moved or renamed), the old
+        key is dropped.
+        """
+        _id = obj._id
+        if _id is None: return
+        old_key = self._names_by_id.get(_id)
+        key = (parent_id, name)
+        if (old_key is not None) and (old_key != key):
+            if self._by_name.get(old_key) is self._by_id.get(_id):
+                del self._by_name[old_key]
+        self._by_id[_id] = obj
+        self._by_name[key] = obj
+        self._names_by_id[_id] = key
+
+    def discard(self, _id):
+        obj = self._by_id.pop(_id, None)
+        key = self._names_by_id.pop(_id, None)
+        if (key is not None) and (self._by_name.get(key) is obj):
+            del self._by_name[key]
+
+    def clear(self):
+        self._by_id.clear()
+        self._by_name.clear()
+        self._names_by_id.clear()
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self))
+
+def get_identity_map(request):
+    if not hasattr(request, '_identity_map'):
+        imap = IdentityMap()
+        request._identity_map = imap
+        if hasattr(request, 'add_finished_callback'):
+            def log_stats(request):
+                log.debug("identity map stats for %s: %s" % (getattr(request, 'path', ''), repr(imap.get_stats())))
+            request.add_finished_callback(log_stats)
+    return request._identity_map
@@ -0,0 +1,143 @@
+""" Asynchronous ElasticSearch indexing.
+
+When the "es_async_indexing" setting is enabled, Content.index() and
+unindex() don't talk to ElasticSearch.  Instead they write a small record
+to the "index_queue" MongoDB collection (the outbox), and a separate worker
+process (the recms-index-worker console script) drains the queue in bulk
+batches.  So request latency doesn't depend on ElasticSearch, and an
+ElasticSearch outage only delays indexing.
+
+Records are keyed by the content _id, so repeated saves of the same object
+before the worker gets to it coalesce into a single record (the latest
+operation wins).  Each enqueue bumps the record's "version"; the worker only
+removes a record if its version is unchanged, so an update that arrives
+while a batch is in flight isn't lost.
+Failed records (including ones whose document can't be built) are retried
+with exponential backoff, up to MAX_ATTEMPTS.
+
+Only one worker should drain a given queue at a time.
+"""
+
+import time
+import datetime
+import logging
+import pymongo
+from cms import dbutil
+from cms.dateutil import utcnow
+log = logging.getLogger(__name__)
+
+COLLECTION_NAME = 'index_queue'
+INDEX = 'index'
+UNINDEX = 'unindex'
+MAX_ATTEMPTS = 10
+MAX_RETRY_DELAY = 600
+
+class IndexQueue(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def enqueue(self, _id, op, doctype):
+        now = utcnow()
+        self.collection.update({'_id': _id},
+            {'$set': {'op': op, 'doctype': doctype, 'queued': now, 'next_try': now, 'attempts': 0, 'failed': False}, '$inc': {'version': 1}},
+            upsert=True, safe=True)
+
+    def get_batch(self, size):
+        """ Return a list of up to size records that are due. """
+        spec = {'failed': False, 'next_try': {'$lte': utcnow()}}
+        return list(self.collection.find(spec, sort=[('next_try', pymongo.ASCENDING)], limit=size))
+
+    def done(self, record):
+        self.collection.remove({'_id': record['_id'], 'version': record['version']}, safe=True)
+
+    def retry(self, record, error):
+        attempts = record.get('attempts', 0) + 1
+        failed = attempts >= MAX_ATTEMPTS
+        delay = min(2 ** attempts, MAX_RETRY_DELAY)
+        next_try = utcnow() + datetime.timedelta(seconds=delay)
+        self.collection.update({'_id': record['_id'], 'version': record['version']},
+            {'$set': {'attempts': attempts, 'next_try': next_try, 'failed': failed, 'error': error}}, safe=True)
+        if failed: log.error("giving up on %s of %s after %s attempts: %s" % (record['op'], record['_id'], attempts, error))
+
+    def get_stats(self):
+        return dict(pending=self.collection.find({'failed': False}).count(), failed=self.collection.find({'failed': True}).count())
+
+def get_index_queue(request):
+    """ Return an IndexQueue if the "es_async_indexing" setting is enabled, else None. """
+    settings = request.registry.settings or {}
+    if not settings.get('es_async_indexing'): return None
+    return IndexQueue(dbutil.get_collection(request, COLLECTION_NAME))
+
+def ensure_indexes(collection):
+    collection.ensure_index([('failed', pymongo.ASCENDING), ('next_try', pymongo.ASCENDING)])
+
+def process_batch(queue, root, size):
+    """ Send up to size due records from the queue to ElasticSearch in bulk.
+    Returns the number of records processed.
+    """
+    records = queue.get_batch(size)
+    if not records: return 0
+    # Load objects fresh for each batch.
+    if hasattr(root.request, '_identity_map'): root.request._identity_map.clear()
+    bulk = dbutil.get_es_bulk_indexer(root.request)
+    sent = []
+    for record in records:
+        try:
+            obj = None
+            if record['op'] == INDEX:
+                obj = root.get_content_by_id(record['_id'])
+            if (obj is not None) and (not obj.in_trash()):
+                bulk.index(obj._get_es_doctype(), obj._id, obj._get_es_document())
+            else:
+                # Deleted or trashed since it was queued.
+                bulk.delete(record['doctype'], record['_id'])
+        except Exception, e:
+            # Don't let one bad record block the rest of the queue.
+            log.exception("error preparing %s of %s" % (record['op'], record['_id']))
+            queue.retry(record, str(e))
+        else:
+            sent.append(record)
+    errors = {}
+    for error in bulk.close()['errors']:
+        errors[error['_id']] = error['error']
+    for record in sent:
+        error = errors.get(str(record['_id']))
+        if error: queue.retry(record, error)
+        else: queue.done(record)
+    return len(records)
+
+def main(argv=None):
+    """ Console script that indexes queued content in ElasticSearch.
+    Usage: recms-index-worker config_uri [--once] [--batch-size=N] [--sleep=SECONDS]
+    """
+    import sys
+    from pyramid.paster import bootstrap
+    if argv is None: argv = sys.argv
+    if len(argv) < 2:
+        print main.__doc__
+        return 2
+    options = dict(x.lstrip('-').split('=', 1) for x in argv[2:] if '=' in x)
+    once = '--once' in argv[2:]
+    env = bootstrap(argv[1])
+    request = env['request']
+    root = env['root']
+    settings = env['registry'].settings
+    size = int(options.get('batch-size', settings.get('es_bulk_size', 500)))
+    sleep = float(options.get('sleep', 1.0))
+    queue = IndexQueue(dbutil.get_collection(request, COLLECTION_NAME))
+    try:
+        while True:
+            try:
+                count = process_batch(queue, root, size)
+            except Exception, e:
+                log.exception("error processing index queue")
+                count = 0
+            if count: log.info("indexed %s queued items" % count)
+            if once and not count: break
+            if count < size: time.sleep(sleep)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env['closer']()
+    return 0
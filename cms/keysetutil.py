@@ -0,0 +1,147 @@
+""" Keyset (AKA cursor) pagination for MongoDB queries.
+
+Instead of skipping N documents (which MongoDB does by walking them all),
+a page is fetched by asking for the documents that sort after (or before)
+the last (or first) document of the current page.  The sort key values of
+that document are passed between requests as an opaque token.
+
+Caveat: MongoDB comparison operators only match values of the same BSON type,
+so a sort field should hold values of one type (or be missing/null) across
+the documents being paged.
+"""
+
+import base64
+from bson import BSON
+
+NEXT = 'n'
+PREV = 'p'
+
+def get_full_sort(sort):
+    """ Return a copy of the list of (field, direction) tuples with an "_id"
+    tiebreaker appended (in the same direction as the last sort key), so that
+    the order is total and there's exactly one "next" document.
+    """
+    sort = list(sort or [])
+    if '_id' not in [x[0] for x in sort]:
+        if sort: dir = sort[-1][1]
+        else: dir = 1
+        sort.append(('_id', dir))
+    return sort
+
+def reverse_sort(sort):
+    return [(field, -dir) for (field, dir) in sort]
+
+def get_field_value(doc, field):
+    # Supports dotted field names (such as "_memento.orig_name").
+    value = doc
+    for part in field.split('.'):
+        if not isinstance(value, dict): return None
+        value = value.get(part)
+    return value
+
+def get_sort_values(doc, sort):
+    return [get_field_value(doc, field) for (field, dir) in sort]
+
+def get_keyset_spec(sort, values):
+    """ Return a MongoDB spec that matches the documents that follow a
+    document with the given sort key values in the given sort order.
+    Missing/null values sort first (same as MongoDB).
+    """
+    clauses = []
+    prefix = {}
+    for ((field, dir), value) in zip(sort, values):
+        if value is None:
+            if dir == 1: clauses.append(dict(prefix, **{field: {'$ne': None}}))
+        elif dir == 1:
+            clauses.append(dict(prefix, **{field: {'$gt': value}}))
+        else:
+            clauses.append(dict(prefix, **{field: {'$lt': value}}))
+            clauses.append(dict(prefix, **{field: None}))
+        prefix[field] = value
+    return {'$or': clauses}
+
+def add_to_spec(spec, extra):
+    spec = dict(spec or {})
+    for key in extra.keys():
+        if key in spec:
+            return {'$and': [spec, extra]}
+    spec.update(extra)
+    return spec
+
+def encode_token(sort, values, direction, total=None):
+    """ total may be a count of all the items being paged, for callers
+    that can't cheaply count them for every page (see get_token_total()).
+    """
+    data = dict(s=[list(x) for x in sort], v=values, d=direction)
+    if total is not None: data['t'] = total
+    return base64.urlsafe_b64encode(BSON.encode(data)).rstrip('=')
+
+def _decode(token):
+    if not token: return None
+    try:
+        token = str(token)
+        return BSON(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))).decode(tz_aware=True)
+    except Exception:
+        return None
+
+def get_token_total(token):
+    """ Return the total passed to encode_token() for the token, or None. """
+    data = _decode(token)
+    return data and data.get('t')
+
+def decode_token(token, sort):
+    """ Return a tuple of (direction, values) for the token, or None if the
+    token is invalid or was made for a different sort order.
+    """
+    data = _decode(token)
+    if data is None: return None
+    if [tuple(x) for x in data.get('s', [])] != list(sort): return None
+    if data.get('d') not in (NEXT, PREV): return None
+    values = data.get('v')
+    if (not isinstance(values, list)) or (len(values) != len(sort)): return None
+    return (data['d'], values)
+
+def get_page(collection, spec=None, sort=None, limit=20, token=None, fields=None, construct=None):
+    """ Return a page of documents from a pymongo collection as a dictionary
+    with these keys:
+    "items" - a list of documents (or of whatever construct() returns for each document)
+    "has_prev", "has_next" - booleans
+    "prev_token", "next_token" - tokens to pass back to this function
+    to get the previous/next page (None when there's no such page)
+
+    token should be None for the first page, or a token from a previous result.
+    If fields is specified, the sort fields are added to it.
+    """
+    sort = get_full_sort(sort)
+    decoded = decode_token(token, sort)
+    query_sort = sort
+    backwards = False
+    if decoded:
+        (direction, values) = decoded
+        backwards = (direction == PREV)
+        if backwards: query_sort = reverse_sort(sort)
+        spec = add_to_spec(spec, get_keyset_spec(query_sort, values))
+    if fields is not None:
+        fields = list(fields)
+        for (field, dir) in sort:
+            if field not in fields: fields.append(field)
+    docs = list(collection.find(spec=spec, fields=fields, sort=query_sort, limit=limit+1))
+    more = len(docs) > limit
+    docs = docs[:limit]
+    if backwards:
+        docs.reverse()
+        has_prev = more
+        has_next = True
+    else:
+        has_prev = decoded is not None
+        has_next = more
+    prev_token = next_token = None
+    if docs:
+        if has_prev: prev_token = encode_token(sort, get_sort_values(docs[0], sort), PREV)
+        if has_next: next_token = encode_token(sort, get_sort_values(docs[-1], sort), NEXT)
+    else:
+        # Nothing left in this direction (perhaps items were deleted);
+        # the caller can always start over from the first page.
+        has_prev = has_next = False
+    if construct: docs = [construct(doc) for doc in docs]
+    return dict(items=docs, has_prev=has_prev, has_next=has_next, prev_token=prev_token, next_token=next_token)
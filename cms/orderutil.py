@@ -1,68 +1,160 @@
-def reorder_ids_by_delta(all_ids, ids_to_reorder, delta):
-    """ Given a list of ID strings, another list that should be a subset of
-    those ID strings, and a signed int delta value, reorder the items in
-    the all_ids list such that the specified subset of IDs are moved by the
-    delta value.
-    A negative delta moves items closer to the beginning (index 0) of the list.
-    A positive delta moves items closer to the end of the list.
+""" Position keys for explicitly ordered folders.
+
+Each child of an ordered folder stores a "_position" string; the children
+are listed by sorting on it.  There's always room for another key between
+any two keys, and plain string comparison (which is what MongoDB does)
+gives the right order.  Moving a child only means giving it a new key
+between its new neighbors; no other child is touched.
+
+A key is a variable-length base-62 "integer part" followed by an optional
+fraction.  The first character of the integer part encodes its length, so
+appending (or prepending) keys only grows them logarithmically, and keys
+only get long when many children are squeezed into the same spot.
+
+Algorithm borrowed from "Implementing Fractional Indexing" by David Greenspan.
+"""
+
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+INTEGER_ZERO = 'a0'
+SMALLEST_INTEGER = 'A' + '0' * 26
+
+# Folders with keys longer than this should have their positions respaced.
+MAX_KEY_LENGTH = 32
+
+def key_between(a, b):
+    """ Return a key that sorts strictly between keys a and b.
+    a may be None (meaning before the first key) and b may be None
+    (meaning after the last key).
     """
-    reordered_ids = []
-    # Logic borrowed from Zope/lib/python/OFS/OrderSupport.py
-    min_position = 0
-    # unify moving direction
-    if delta > 0:
-        ids_to_reorder.reverse()
-        all_ids.reverse()
+    if a is not None: _validate_key(a)
+    if b is not None: _validate_key(b)
+    if (a is not None) and (b is not None) and (a >= b):
+        raise ValueError("%s is not less than %s" % (repr(a), repr(b)))
+    if a is None:
+        if b is None: return INTEGER_ZERO
+        ib = _get_integer_part(b)
+        fb = b[len(ib):]
+        if ib == SMALLEST_INTEGER: return ib + _midpoint('', fb)
+        if ib < b: return ib
+        result = _decrement_integer(ib)
+        if result is None: raise ValueError("Can't make a key before %s" % repr(b))
+        return result
+    ia = _get_integer_part(a)
+    fa = a[len(ia):]
+    if b is None:
+        result = _increment_integer(ia)
+        if result is None: return ia + _midpoint(fa, None)
+        return result
+    ib = _get_integer_part(b)
+    fb = b[len(ib):]
+    if ia == ib: return ia + _midpoint(fa, fb)
+    result = _increment_integer(ia)
+    if result is None: raise ValueError("Can't make a key after %s" % repr(a))
+    if result < b: return result
+    return ia + _midpoint(fa, None)
 
-    for id in ids_to_reorder:
-        if id in all_ids:
-            old_position = all_ids.index(id)
-            new_position = max(old_position - abs(delta), min_position)
-            if new_position == min_position:
-                min_position += 1
-            if old_position != new_position:
-                all_ids.remove(id)
-                all_ids.insert(new_position, id)
-                reordered_ids.append(id)
+def keys_between(a, b, n):
+    """ Return a list of n ascending keys between a and b (see key_between()),
+    spread out so that the keys stay short.
+    """
+    if n < 1: return []
+    if n == 1: return [key_between(a, b)]
+    if b is None:
+        keys = []
+        for i in range(n):
+            a = key_between(a, None)
+            keys.append(a)
+        return keys
+    if a is None:
+        keys = []
+        for i in range(n):
+            b = key_between(None, b)
+            keys.insert(0, b)
+        return keys
+    mid = n // 2
+    key = key_between(a, b)
+    return keys_between(a, key, mid) + [key] + keys_between(key, b, n - mid - 1)
 
-    if delta > 0: all_ids.reverse()
-    return reordered_ids
+def needs_respacing(keys):
+    for key in keys:
+        if key and (len(key) > MAX_KEY_LENGTH): return True
+    return False
 
-def reorder_ids_up(all_ids, ids_to_reorder, delta=1):
-    return reorder_ids_by_delta(all_ids, ids_to_reorder, -delta)
+def _get_integer_length(head):
+    if 'a' <= head <= 'z': return ord(head) - ord('a') + 2
+    if 'A' <= head <= 'Z': return ord('Z') - ord(head) + 2
+    raise ValueError("Invalid position key head %s" % repr(head))
 
-def reorder_ids_down(all_ids, ids_to_reorder, delta=1):
-    return reorder_ids_by_delta(all_ids, ids_to_reorder, delta)
+def _get_integer_part(key):
+    length = _get_integer_length(key[0])
+    if length > len(key): raise ValueError("Invalid position key %s" % repr(key))
+    return key[:length]
 
-def reorder_ids_to_top(all_ids, ids_to_reorder):
-    reordered_ids = []
-    # Figure out which ones will actually move...
-    idx = 0
-    for id in ids_to_reorder:
-        if all_ids[idx] != id:
-            reordered_ids.append(id)
-        idx += 1
-    if not reordered_ids: return reordered_ids
+def _validate_key(key):
+    if key == SMALLEST_INTEGER: raise ValueError("Invalid position key %s" % repr(key))
+    if key[len(_get_integer_part(key)):].endswith('0'):
+        raise ValueError("Invalid position key %s" % repr(key))
 
-    ids_to_reorder.reverse()
-    for id in ids_to_reorder:
-        if id in all_ids:
-            all_ids.remove(id)
-            all_ids.insert(0, id)
-    return reordered_ids
+def _midpoint(a, b):
+    """ Return a fraction string between fraction strings a and b
+    (b may be None, meaning 1).
+    """
+    if b is not None:
+        # Skip the common prefix (padding a with zeros).
+        n = 0
+        while (n < len(b)) and ((a[n:n+1] or '0') == b[n]):
+            n += 1
+        if n: return b[:n] + _midpoint(a[n:], b[n:])
+    if a: digit_a = DIGITS.index(a[0])
+    else: digit_a = 0
+    if b is not None: digit_b = DIGITS.index(b[0])
+    else: digit_b = BASE
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b) // 2]
+    # The first digits are consecutive.
+    if (b is not None) and (len(b) > 1):
+        return b[0]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
 
-def reorder_ids_to_bottom(all_ids, ids_to_reorder):
-    reordered_ids = []
-    # Figure out which ones will actually move...
-    idx = -len(ids_to_reorder)
-    for id in ids_to_reorder:
-        if all_ids[idx] != id:
-            reordered_ids.append(id)
-        idx += 1
-    if not reordered_ids: return reordered_ids
+def _increment_integer(x):
+    head = x[0]
+    digits = list(x[1:])
+    carry = True
+    i = len(digits) - 1
+    while carry and (i >= 0):
+        d = DIGITS.index(digits[i]) + 1
+        if d == BASE:
+            digits[i] = DIGITS[0]
+        else:
+            digits[i] = DIGITS[d]
+            carry = False
+        i -= 1
+    if carry:
+        if head == 'Z': return 'a' + DIGITS[0]
+        if head == 'z': return None
+        head = chr(ord(head) + 1)
+        if head > 'a': digits.append(DIGITS[0])
+        else: digits.pop()
+    return head + ''.join(digits)
 
-    for id in ids_to_reorder:
-        if id in all_ids:
-            all_ids.remove(id)
-            all_ids.append(id)
-    return reordered_ids
+def _decrement_integer(x):
+    head = x[0]
+    digits = list(x[1:])
+    borrow = True
+    i = len(digits) - 1
+    while borrow and (i >= 0):
+        d = DIGITS.index(digits[i]) - 1
+        if d == -1:
+            digits[i] = DIGITS[-1]
+        else:
+            digits[i] = DIGITS[d]
+            borrow = False
+        i -= 1
+    if borrow:
+        if head == 'a': return 'Z' + DIGITS[-1]
+        if head == 'A': return None
+        head = chr(ord(head) - 1)
+        if head < 'Z': digits.append(DIGITS[-1])
+        else: digits.pop()
+    return head + ''.join(digits)
@@ -0,0 +1,368 @@
+""" Full rebuild of the ElasticSearch index.
+
+The recms-reindex console script streams the "content" collection in _id
+order, builds the ElasticSearch documents in a pool of worker processes
+(Content._get_es_document() is CPU bound, mostly because of the
+HTML-to-text conversion of rich text fields), and bulk-loads them into a
+fresh index named "<es_name>_<timestamp>".  When the load is complete,
+the "es_name" alias is switched to the new index in a single "_aliases"
+request, so searches never see a partially built index.
+
+The last _id loaded is checkpointed in the "reindex_checkpoints" MongoDB
+collection after each flushed batch, so an interrupted run can be resumed
+with --resume (into the same new index).
+If any document fails to load, the alias isn't switched (and no old index
+is deleted); the failed documents are recorded as changes (see below), so
+that --resume retries them.
+
+Content changed while a rebuild is running is indexed into the old index.
+So that the new index doesn't miss those changes (including moves,
+security updates and deletions, which don't touch _modified), every
+Content.index(), unindex() and update_index() call also records the
+object's _id in the "reindex_changes" collection while a checkpoint exists
+(see record_change()).  The recorded changes are replayed into the new
+index (reindexed from their current state, or deleted) just before the
+alias is switched and again right after.  Processes check for a running
+rebuild every RUNNING_CHECK_INTERVAL seconds, so a new run waits that long
+before it starts loading.  (An interrupted run keeps changes being
+recorded until it's resumed, or until the next run starts over.)
+
+The first time this is run on an installation where "es_name" is a real
+index rather than an alias, that index has to be deleted before the alias
+can be created, so there's a brief window where searches fail.
+"""
+
+import time
+import logging
+import threading
+import multiprocessing
+import pymongo
+from cms import dbutil
+from cms.esbulk import BulkIndexer, BulkIndexError
+from bson.objectid import ObjectId
+from cms.dateutil import utcnow
+log = logging.getLogger(__name__)
+
+COLLECTION_NAME = 'reindex_checkpoints'
+CHANGES_COLLECTION_NAME = 'reindex_changes'
+DEFAULT_CHUNK_SIZE = 100
+
+# How often (in seconds) each process checks whether a rebuild is running.
+RUNNING_CHECK_INTERVAL = 5
+
+# Settings that are connections (and can't be passed to a worker process).
+CONNECTION_SETTINGS = ('db_conn', 'es_conn')
+
+# Root object of a worker process (see _init_worker()).
+_worker_root = None
+
+# Cached result of is_rebuild_running() for this process.
+_running = dict(es_name=None, checked=0, running=False)
+_running_lock = threading.Lock()
+
+def get_new_index_name(es_name, now=None):
+    if now is None: now = utcnow()
+    return '%s_%s' % (es_name, now.strftime('%Y%m%d%H%M%S'))
+
+def get_alias_commands(indices, alias, new_index):
+    """ Given the result of pyes' ES.get_indices(include_aliases=True),
+    return a tuple of (list of change_aliases() commands that point alias
+    at new_index, name of a concrete index with the alias's name that has
+    to be deleted first or None).
+    """
+    commands = []
+    concrete = None
+    info = indices.get(alias)
+    if info is not None:
+        if 'alias_for' in info:
+            for index in info['alias_for']:
+                if index != new_index: commands.append(('remove', index, alias))
+        else:
+            concrete = alias
+    commands.append(('add', new_index, alias))
+    return (commands, concrete)
+
+def iter_id_chunks(collection, spec, chunk_size):
+    """ Yield lists of up to chunk_size content _ids in ascending order. """
+    cursor = collection.find(spec, fields=['_id'], sort=[('_id', pymongo.ASCENDING)])
+    chunk = []
+    for doc in cursor:
+        chunk.append(doc['_id'])
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+def build_documents(root, ids):
+    """ Return a list of (doctype, _id, document) tuples for the content
+    with the given ids (skipping missing and trashed objects).
+    """
+    result = []
+    if hasattr(root.request, '_identity_map'): root.request._identity_map.clear()
+    for _id in ids:
+        obj = root.get_content_by_id(_id)
+        if (obj is None) or (obj is root) or obj.in_trash(): continue
+        result.append((obj._get_es_doctype(), obj._id, obj._get_es_document()))
+    return result
+
+def is_rebuild_running(request):
+    """ Return True if a rebuild of the index is running (or was interrupted).
+    The answer is cached for RUNNING_CHECK_INTERVAL seconds.
+    """
+    es_name = dbutil.get_es_index_name(request)
+    now = time.time()
+    with _running_lock:
+        if (_running['es_name'] == es_name) and (now - _running['checked'] < RUNNING_CHECK_INTERVAL):
+            return _running['running']
+    running = Checkpoints(dbutil.get_collection(request, COLLECTION_NAME)).get(es_name) is not None
+    with _running_lock:
+        _running.update(es_name=es_name, checked=now, running=running)
+    return running
+
+def record_change(request, _id, doctype):
+    """ Remember that the content with the given _id changed, if a rebuild is
+    running (see replay_changes()).
+    """
+    if not is_rebuild_running(request): return
+    _add_change(dbutil.get_collection(request, CHANGES_COLLECTION_NAME), _id, doctype)
+
+def _add_change(changes, _id, doctype):
+    changes.update({'_id': _id}, {'$set': {'doctype': doctype}, '$inc': {'version': 1}}, upsert=True, safe=True)
+
+def _add_failures(collection, changes, errors):
+    """ Record the content whose bulk actions failed as changes, so that
+    the next (resumed) run sends it again.
+    """
+    ids = [ObjectId(x['_id']) for x in errors if ObjectId.is_valid(x['_id'])]
+    for doc in collection.find({'_id': {'$in': ids}}, fields=['_object_type']):
+        _add_change(changes, doc['_id'], doc['_object_type'])
+
+def replay_changes(root, changes, bulk, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Bring bulk's index up to date with the changes recorded in the
+    changes collection: changed content is indexed again, and content that
+    was deleted or trashed is deleted.
+    Each record is removed once it's been sent, unless it was recorded
+    again in the meantime.
+    Returns the number of records replayed.
+    """
+    records = list(changes.find())
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i+chunk_size]
+        docs = {}
+        for (doctype, _id, doc) in build_documents(root, [x['_id'] for x in chunk]):
+            docs[_id] = (doctype, doc)
+        for record in chunk:
+            if record['_id'] in docs:
+                (doctype, doc) = docs[record['_id']]
+                bulk.index(doctype, record['_id'], doc)
+            else:
+                bulk.delete(record['doctype'], record['_id'])
+    bulk.flush()
+    for record in records:
+        changes.remove({'_id': record['_id'], 'version': record['version']}, safe=True)
+    return len(records)
+
+def get_worker_settings(settings):
+    """ Return a copy of settings that can be passed to a worker process. """
+    return dict([(key, value) for (key, value) in settings.items() if key not in CONNECTION_SETTINGS])
+
+def _init_worker(settings):
+    # Just what building documents needs: a MongoDB connection, and the
+    # authorization policy and workflows (for the "_view" and "_pub_state"
+    # fields), without the rest of the application's startup work.
+    global _worker_root
+    from pyramid.config import Configurator
+    from pyramid.request import Request
+    from cms.authorization import ACLAuthorizationPolicyWithLocalRoles
+    from cms.resources import root_factory
+    settings = dict(settings)
+    settings['db_conn'] = pymongo.Connection(settings['db_uri'], tz_aware=True)
+    config = Configurator(settings=settings, authorization_policy=ACLAuthorizationPolicyWithLocalRoles())
+    config.include('pyramid_zcml')
+    config.load_zcml(settings.get('configure_zcml', 'configure.zcml'))
+    config.commit()
+    request = Request.blank('/')
+    request.registry = config.registry
+    config.begin(request)
+    _worker_root = root_factory(request)
+
+def _build_chunk(ids):
+    return (ids[-1], build_documents(_worker_root, ids))
+
+class Checkpoints(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, es_name):
+        return self.collection.find_one({'_id': es_name})
+
+    def start(self, es_name, index_name):
+        doc = dict(_id=es_name, index=index_name, last_id=None, count=0, started=utcnow())
+        self.collection.save(doc, safe=True)
+        return doc
+
+    def update(self, es_name, last_id, count):
+        self.collection.update({'_id': es_name}, {'$set': {'last_id': last_id, 'count': count}}, safe=True)
+
+    def clear(self, es_name):
+        self.collection.remove({'_id': es_name}, safe=True)
+
+def reindex(env, processes=None, chunk_size=DEFAULT_CHUNK_SIZE, resume=False, delete_old=False, out=None):
+    """ Rebuild the index and switch the alias to it.
+    Returns a report dictionary with the keys "index", "count", "changes"
+    (the number of changes replayed), "batches", "errors" (see
+    esbulk.BulkIndexer) and "seconds".
+    If any document failed before the alias was switched, raises
+    esbulk.BulkIndexError instead, leaving the alias alone.  Either way,
+    failed documents are recorded as changes and the checkpoint is kept,
+    so that running again with resume=True retries them.
+    Old indices are only deleted (if delete_old) after a clean switch.
+    """
+    settings = env['registry'].settings
+    request = env['request']
+    root = env['root']
+    conn = settings['es_conn']
+    es_name = settings['es_name']
+    collection = dbutil.get_collection(request, 'content')
+    checkpoints = Checkpoints(dbutil.get_collection(request, COLLECTION_NAME))
+    changes = dbutil.get_collection(request, CHANGES_COLLECTION_NAME)
+
+    checkpoint = checkpoints.get(es_name)
+    if resume and checkpoint:
+        index_name = checkpoint['index']
+        count = checkpoint['count']
+        log.info("resuming %s after %s (%s documents loaded)" % (index_name, checkpoint['last_id'], count))
+    else:
+        index_name = get_new_index_name(es_name)
+        _create_index(conn, index_name)
+        changes.remove({}, safe=True)
+        checkpoint = checkpoints.start(es_name, index_name)
+        count = 0
+        # Give every process time to notice the rebuild and start recording changes.
+        time.sleep(RUNNING_CHECK_INTERVAL)
+
+    spec = {'_id': {'$ne': root._id}, '_in_trash': {'$ne': True}}
+    if checkpoint['last_id'] is not None:
+        spec['_id']['$gt'] = checkpoint['last_id']
+    # Flush at chunk boundaries (not in the middle of a chunk) so that
+    # everything up to a checkpoint has been sent.
+    batch_size = settings.get('es_bulk_size', 500)
+    bulk = BulkIndexer(conn, index_name, batch_size=None, flush_interval=None)
+    chunks = iter_id_chunks(collection, spec, chunk_size)
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (get_worker_settings(settings),))
+        results = pool.imap(_build_chunk, chunks)
+    else:
+        results = ((ids[-1], build_documents(root, ids)) for ids in chunks)
+
+    start = time.time()
+    loaded = 0
+    last_id = checkpoint['last_id']
+    try:
+        for (last_id, docs) in results:
+            for (doctype, _id, doc) in docs:
+                bulk.index(doctype, _id, doc)
+            loaded += len(docs)
+            if bulk.get_pending_count() >= batch_size:
+                bulk.flush()
+                checkpoints.update(es_name, last_id, count + loaded)
+                if out: _print_progress(out, count + loaded, loaded, start)
+        bulk.flush()
+        checkpoints.update(es_name, last_id, count + loaded)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # Catch up with the content changed since the run started, then again
+    # with whatever changed (in the old index) until the alias was switched.
+    bulk.batch_size = batch_size
+    replayed = replay_changes(root, changes, bulk, chunk_size)
+    if bulk.errors:
+        # Don't switch to an incomplete index.
+        _add_failures(collection, changes, bulk.errors)
+        raise BulkIndexError(bulk.get_report())
+    conn.update_settings(index_name, {'index': {'refresh_interval': '1s'}})
+    conn.refresh([index_name])
+    old_indices = switch_alias(conn, es_name, index_name)
+    replayed += replay_changes(root, changes, bulk, chunk_size)
+    report = bulk.close()
+    if report['errors']:
+        _add_failures(collection, changes, report['errors'])
+        log.error("%s documents failed after the switch to %s; keeping the old indices and the checkpoint" % (len(report['errors']), index_name))
+    else:
+        if delete_old:
+            for index in old_indices:
+                log.info("deleting old index %s" % index)
+                conn.delete_index(index)
+        checkpoints.clear(es_name)
+    report['index'] = index_name
+    report['seconds'] = time.time() - start
+    report['count'] = count + loaded
+    report['changes'] = replayed
+    return report
+
+def _create_index(conn, index_name):
+    from cms.resources import Root
+    # Don't refresh while bulk loading.
+    conn.create_index(index_name, {'index': {'refresh_interval': '-1'}})
+    for cls in Root._content_type_factories.values():
+        conn.put_mapping(cls._get_es_doctype(), {'properties':cls._get_es_mapping()}, [index_name])
+
+def switch_alias(conn, alias, index_name):
+    """ Point alias at index_name (and nothing else).
+    Returns a list of the indices the alias pointed to before.
+    """
+    (commands, concrete) = get_alias_commands(conn.get_indices(include_aliases=True), alias, index_name)
+    if concrete:
+        log.warning("deleting index %s to replace it with an alias" % concrete)
+        conn.delete_index(concrete)
+    conn.change_aliases(commands)
+    return [index for (command, index, a) in commands if command == 'remove']
+
+def _print_progress(out, total, loaded, start):
+    elapsed = time.time() - start
+    rate = elapsed and (loaded / elapsed) or 0
+    print >>out, "%s documents loaded (%.1f/sec)" % (total, rate)
+
+def main(argv=None):
+    """ Console script that rebuilds the ElasticSearch index.
+    Usage: recms-reindex config_uri [--resume] [--delete-old] [--processes=N] [--chunk-size=N]
+    """
+    import sys
+    from pyramid.paster import bootstrap
+    if argv is None: argv = sys.argv
+    if len(argv) < 2:
+        print main.__doc__
+        return 2
+    options = dict(x.lstrip('-').split('=', 1) for x in argv[2:] if '=' in x)
+    processes = options.get('processes')
+    if processes: processes = int(processes)
+    else: processes = None
+    chunk_size = int(options.get('chunk-size', DEFAULT_CHUNK_SIZE))
+    env = bootstrap(argv[1])
+    try:
+        report = reindex(env, processes=processes, chunk_size=chunk_size,
+            resume='--resume' in argv[2:], delete_old='--delete-old' in argv[2:], out=sys.stdout)
+    except BulkIndexError, e:
+        print "Not switching to the new index: %s" % e
+        _print_errors(e.report['errors'])
+        print "Run again with --resume to retry them."
+        return 1
+    finally:
+        env['closer']()
+    seconds = report['seconds']
+    print "Loaded %s documents into %s in %s batches (%.1f seconds, %.1f/sec), and replayed %s changes." % (
+        report['count'], report['index'], report['batches'], seconds, seconds and (report['count'] / seconds) or 0, report['changes'])
+    if report['errors']:
+        _print_errors(report['errors'])
+        print "Run again with --resume to retry them."
+        return 1
+    return 0
+
+def _print_errors(errors):
+    print "%s errors:" % len(errors)
+    for error in errors[:20]:
+        print "  %s %s: %s" % (error['op'], error['_id'], error['error'])
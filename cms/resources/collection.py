@@ -1,4 +1,6 @@
-from cms import dbutil
+from cms import dbutil, keysetutil
+from cms.identitymap import get_identity_map
+from summary import ContentSummary
 import string
 from cms.exceptions import Veto
 
@@ -10,6 +12,10 @@ class Collection(object):
 
     _object_type = "collection"
 
+    # Subclasses that hold content objects can set this to True so that
+    # children are cached in the request's identity map (see cms.identitymap).
+    _use_identity_map = False
+
     def __init__(self, request, collection_name, child_class):
         """
         collection_name - name of the MongoDB collection
@@ -22,6 +28,11 @@ class Collection(object):
     def _get_collection(self):
         return dbutil.get_collection(self.request, self._collection_name)
 
+    def _get_identity_map(self):
+        if self._use_identity_map:
+            return get_identity_map(self.request)
+        return None
+
     def _get_child_class(self, doc):
         """ doc is a mongodb document from this collection.
         Not used by the base Collection class, but subclasses could
@@ -41,12 +52,25 @@ class Collection(object):
         return doc is not None
 
     def _construct_child_from_mongo_document(self, doc):
+        imap = self._get_identity_map()
+        if imap is not None:
+            obj = imap.get(doc['_id'])
+            if obj is not None:
+                obj.__parent__ = self
+                return obj
         obj = self._get_child_class(doc)(self.request, **(dbutil.encode_keys(doc)))
         obj.__name__ = doc['__name__']
         obj.__parent__ = self
+        if imap is not None:
+            imap.add(obj, doc['__parent__'], doc['__name__'])
         return obj
 
     def get_child(self, name):
+        imap = self._get_identity_map()
+        if imap is not None:
+            obj = imap.get_by_name(self._id, name)
+            if obj is not None:
+                return obj
         spec = self._morph_spec({'__name__': name})
         doc = self._get_collection().find_one(spec)
         if doc is None:
@@ -59,28 +83,63 @@ class Collection(object):
             raise KeyError
         return child
 
-    def get_children_and_total(self, spec=None, sort=None, skip=0, limit=0):
+    def get_children_and_total(self, spec=None, sort=None, skip=0, limit=0, count=True):
+        """ Return a dictionary with the keys "items" (a list of child objects),
+        "total" and "has_more" (True if there are more matching children after this batch).
+        If count is False (and a limit is given), no separate count query is run;
+        instead limit+1 documents are fetched to find out if there are more,
+        and "total" will be None.
+        """
         spec = self._morph_spec(spec)
-        cursor = self._get_collection().find(spec=spec, sort=sort, skip=skip, limit=limit)
-        total = cursor.count()
-        items = []
-        for doc in cursor:
-            obj = self._construct_child_from_mongo_document(doc)
-            items.append(obj)
-        return dict(total=total, items=items)
+        cursor = self._get_collection().find(spec=spec, sort=sort, skip=skip, limit=dbutil.fetch_limit(limit, count))
+        return dbutil.get_batch(cursor, skip, limit, count, self._construct_child_from_mongo_document)
 
     def get_children(self, spec=None, sort=None, skip=0, limit=0):
-        return self.get_children_and_total(spec, sort, skip, limit)['items']
+        return self.get_children_and_total(spec, sort, skip, limit, count=False)['items']
+
+    def get_child_summaries_and_total(self, spec=None, sort=None, skip=0, limit=0, fields=None, count=True):
+        """ Like get_children_and_total(), but only the specified fields (plus
+        "__name__") are loaded from MongoDB, and the items are lightweight
+        ContentSummary records instead of fully constructed child objects.
+        Handy for listings that don't need large fields (like an article body).
+        """
+        spec = self._morph_spec(spec)
+        fields = list(fields or [])
+        if '__name__' not in fields: fields.append('__name__')
+        cursor = self._get_collection().find(spec=spec, fields=fields, sort=sort, skip=skip, limit=dbutil.fetch_limit(limit, count))
+        return dbutil.get_batch(cursor, skip, limit, count, lambda doc: ContentSummary(self.request, self, doc))
 
-    def get_child_names_and_total(self, spec=None, sort=None, skip=0, limit=0):
+    def get_child_summaries(self, spec=None, sort=None, skip=0, limit=0, fields=None):
+        return self.get_child_summaries_and_total(spec, sort, skip, limit, fields, count=False)['items']
+
+    def get_child_names_and_total(self, spec=None, sort=None, skip=0, limit=0, count=True):
         spec = self._morph_spec(spec)
-        cursor = self._get_collection().find(spec=spec, fields=['__name__'], sort=sort, skip=skip, limit=limit)
-        total = cursor.count()
-        items = [r['__name__'] for r in cursor]
-        return dict(total=total, items=items)
+        cursor = self._get_collection().find(spec=spec, fields=['__name__'], sort=sort, skip=skip, limit=dbutil.fetch_limit(limit, count))
+        return dbutil.get_batch(cursor, skip, limit, count, lambda doc: doc['__name__'])
 
     def get_child_names(self, spec=None, sort=None, skip=0, limit=0):
-        return self.get_child_names_and_total(spec, sort, skip, limit)['items']
+        return self.get_child_names_and_total(spec, sort, skip, limit, count=False)['items']
+
+    def get_children_page(self, spec=None, sort=None, limit=20, token=None):
+        """ Return a page of child objects using keyset pagination
+        (see keysetutil.get_page() for the result and the token argument).
+        Unlike skip-based batches, every page costs about the same to fetch.
+        """
+        spec = self._morph_spec(spec)
+        return keysetutil.get_page(self._get_collection(), spec=spec, sort=sort, limit=limit, token=token, construct=self._construct_child_from_mongo_document)
+
+    def get_child_summaries_page(self, spec=None, sort=None, limit=20, token=None, fields=None):
+        """ Like get_children_page(), but returns ContentSummary records
+        (see get_child_summaries_and_total()).
+        """
+        spec = self._morph_spec(spec)
+        fields = list(fields or [])
+        if '__name__' not in fields: fields.append('__name__')
+        return keysetutil.get_page(self._get_collection(), spec=spec, sort=sort, limit=limit, token=token, fields=fields, construct=lambda doc: ContentSummary(self.request, self, doc))
+
+    def get_child_count(self, spec=None):
+        spec = self._morph_spec(spec)
+        return self._get_collection().find(spec=spec).count()
 
     def get_children_lazily(self, spec=None, sort=None):
         """ Return child objects using a generator.
@@ -137,6 +196,9 @@ class Collection(object):
         if child:
             child._pre_delete()
             self._get_collection().remove(dict(_id=child._id), safe=True)
+            imap = self._get_identity_map()
+            if imap is not None:
+                imap.discard(child._id)
             return 1
         else:
             return 0
@@ -1,8 +1,13 @@
 from object import Object
 import colander, deform
 from cms import dbutil
+from cms.identitymap import get_identity_map
+from cms.authorization import local_roles_cache
+from cms.indexqueue import get_index_queue, INDEX, UNINDEX
 from bson.objectid import ObjectId
-from cms.htmlutil import html_to_text
+from cms.htmlutil import html_text_cache
+from cms.searchcache import search_cache
+from cms.reindex import record_change
 import widgets
 import permissions
 import repoze.workflow
@@ -38,17 +43,42 @@ class Content(Object):
         doc = Object._get_nonschema_mongo_save_document(self)
         doc['_object_type'] = self._object_type
         doc['__parent__'] = self.__parent__ and self.__parent__._id
+        # Materialized list of ancestor ids (root first) so that Root.get_content_by_id()
+        # can load the whole parent chain with a single query.
+        doc['_ancestor_ids'] = self.get_id_path()[:-1]
+        # Materialized (unquoted) path, indexed for single-query traversal.
+        doc['_path'] = self.get_path()
         _pub_state = self.get_pub_state()
         if _pub_state: doc['_pub_state'] = _pub_state
-        doc['_view'] = self._get_view_principals()
+        # Keep the in-memory copy current too (see get_changed_security_fields()).
+        doc['_view'] = self._view = self._get_view_principals()
+        # Position key among the children of an ordered folder (see orderutil).
+        _position = getattr(self, '_position', None)
+        if _position is not None: doc['_position'] = _position
         doc['sortable_title'] = self.sortable_title.lower()
         doc['_in_trash'] = self.in_trash()
+        if self._persist_extracted_text():
+            # Keep the plain text of rich text fields (keyed by html hash)
+            # so that other processes can reindex without parsing the html.
+            texts = {}
+            # Also keep the other text itself for indexing right after this save (see save()).
+            self._saved_other_text = self.get_es_other_text(texts)
+            doc['_extracted_text'] = texts
+            self._extracted_text = texts
         return doc
 
     def _load_nonschema_attributes(self, **kwargs):
         Object._load_nonschema_attributes(self, **kwargs)
         _pub_state = kwargs.get('_pub_state')
         if _pub_state: self._pub_state = _pub_state
+        # Keep the stored view principals around so that unauthenticated traversal
+        # can filter cached objects without another query.
+        _view = kwargs.get('_view')
+        if _view is not None: self._view = _view
+        _position = kwargs.get('_position')
+        if _position is not None: self._position = _position
+        _extracted_text = kwargs.get('_extracted_text')
+        if _extracted_text is not None: self._extracted_text = _extracted_text
 
     def _get_view_principals(self):
         return list(security.principals_allowed_by_permission(self, permissions.VIEW))
@@ -104,22 +134,95 @@ class Content(Object):
         doc['_view'] = self._get_view_principals()
         _pub_state = self.get_pub_state()
         if _pub_state: doc['_pub_state'] = _pub_state
-        doc['other_text'] = self.get_es_other_text()
+        other_text = getattr(self, '_saved_other_text', None)
+        if other_text is None: other_text = self.get_es_other_text()
+        doc['other_text'] = other_text
         return doc
 
-    def index(self):
+    def index(self, bulk=None):
+        search_cache.invalidate()
+        # Don't let a rebuild of the index in progress miss this (see cms.reindex).
+        record_change(self.request, self._id, self._get_es_doctype())
+        # With asynchronous indexing, just tell the worker (see indexqueue).
+        queue = get_index_queue(self.request)
+        if queue is not None:
+            queue.enqueue(self._id, INDEX, self._get_es_doctype())
+            return
+        # If bulk (an esbulk.BulkIndexer) is passed, the document is buffered for a "_bulk" request.
+        if bulk is not None:
+            bulk.index(self._get_es_doctype(), self._id, self._get_es_document())
+            return
         dbutil.get_es_conn(self.request).index(self._get_es_document(), dbutil.get_es_index_name(self.request), self._get_es_doctype(), str(self._id))
 
-    def unindex(self):
+    def unindex(self, bulk=None):
+        search_cache.invalidate()
+        record_change(self.request, self._id, self._get_es_doctype())
+        queue = get_index_queue(self.request)
+        if queue is not None:
+            queue.enqueue(self._id, UNINDEX, self._get_es_doctype())
+            return
+        if bulk is not None:
+            bulk.delete(self._get_es_doctype(), self._id)
+            return
         try:
             dbutil.get_es_conn(self.request).delete(dbutil.get_es_index_name(self.request), self._get_es_doctype(), str(self._id))
         except pyes.exceptions.NotFoundException, e:
             pass
 
-    def get_es_other_text(self):
-        return '\n'.join(self._get_text_values_for_schema_node(self.get_schema(), self.get_schema_values()))
+    def _get_security_fields(self):
+        """ Return a dictionary of the stored fields that depend on the
+        workflow state and ACL of this object (and its ancestors).
+        """
+        fields = dict(_view=self._get_view_principals())
+        _pub_state = self.get_pub_state()
+        if _pub_state: fields['_pub_state'] = _pub_state
+        return fields
+
+    def get_changed_security_fields(self):
+        """ Return a dictionary of the security fields whose stored values are out of date. """
+        result = {}
+        for (name, value) in self._get_security_fields().items():
+            old = getattr(self, name, None)
+            if name == '_view':
+                if sorted(old or []) != sorted(value): result[name] = value
+            elif old != value:
+                result[name] = value
+        return result
+
+    def update_index(self, fields, bulk=None):
+        """ Update just the given fields of this object's ElasticSearch document. """
+        search_cache.invalidate()
+        record_change(self.request, self._id, self._get_es_doctype())
+        queue = get_index_queue(self.request)
+        if queue is not None:
+            queue.enqueue(self._id, INDEX, self._get_es_doctype())
+            return
+        own_bulk = bulk is None
+        if own_bulk: bulk = dbutil.get_es_bulk_indexer(self.request)
+        # If the document is missing from the index, index the whole thing.
+        bulk.update(self._get_es_doctype(), self._id, fields, self._get_es_document)
+        if own_bulk: bulk.close(check=True)
+
+    def update_security_fields(self, bulk=None):
+        """ Bring the stored "_view" and "_pub_state" fields up to date
+        (in both mongo and elastic) without saving or reindexing the whole object.
+        Returns True if anything changed.
+        """
+        fields = self.get_changed_security_fields()
+        if not fields: return False
+        self._get_collection().update({'_id': self._id}, {'$set': fields}, safe=True)
+        for (name, value) in fields.items(): setattr(self, name, value)
+        self.update_index(fields, bulk=bulk)
+        return True
+
+    def get_es_other_text(self, texts=None):
+        """ Return the text of all the schema fields to be indexed in "other_text".
+        If texts (a dictionary) is passed, the plain text of each rich text field
+        is added to it, keyed by html hash.
+        """
+        return '\n'.join(self._get_text_values_for_schema_node(self.get_schema(), self.get_schema_values(), texts))
 
-    def _get_text_values_for_schema_node(self, node, value):
+    def _get_text_values_for_schema_node(self, node, value, texts=None):
         result = []
         if not value: return result
         if type(node.typ) == colander.Mapping:
@@ -127,26 +230,45 @@ class Content(Object):
                 name = cnode.name
                 val = value.get(name, None)
                 if val:
-                    result += self._get_text_values_for_schema_node(cnode, val)
+                    result += self._get_text_values_for_schema_node(cnode, val, texts)
         elif type(node.typ) == colander.Sequence:
             if node.children:
                 cnode = node.children[0]
                 for val in value:
-                    result += self._get_text_values_for_schema_node(cnode, val)
+                    result += self._get_text_values_for_schema_node(cnode, val, texts)
         elif type(node.typ) == colander.String:
             if getattr(node, 'include_in_other_text', True):
                 if type(node.widget) == deform.widget.RichTextWidget:
-                    value = html_to_text(value, 0)
+                    value = self._html_to_text(value, texts)
                 if value: result.append(value)
         elif type(node.typ) == deform.FileData:
             pass # FIXME: handle PDF, Word, etc
         return result
 
-    def save(self, set_modified=True, index=True):
-        # Set pull_parent_from_old_files=False since we want to keep old
-        # files around for the edit history log.
-        Object.save(self, set_modified=set_modified, pull_parent_from_old_files=False)
-        if index: self.index()
+    def _html_to_text(self, html, texts=None):
+        """ Return the plain text of html, reusing the text extracted when this
+        object was last saved (if persisted) or cached in this process.
+        """
+        key = html_text_cache.get_key(html, 0)
+        text = (getattr(self, '_extracted_text', None) or {}).get(key)
+        if text is None: text = html_text_cache.html_to_text(html, 0)
+        if texts is not None: texts[key] = text
+        return text
+
+    def _persist_extracted_text(self):
+        settings = self.request.registry.settings or {}
+        return settings.get('persist_extracted_text', False)
+
+    def save(self, set_modified=True, index=True, bulk=None):
+        try:
+            # Set pull_parent_from_old_files=False since we want to keep old
+            # files around for the edit history log.
+            Object.save(self, set_modified=set_modified, pull_parent_from_old_files=False)
+            # Keep the request's identity map in sync (this object may be new, renamed or moved).
+            get_identity_map(self.request).add(self, self.__parent__ and self.__parent__._id, self.__name__)
+            if index: self.index(bulk=bulk)
+        finally:
+            self._saved_other_text = None
 
     def get_id_path(self):
         ids = []
@@ -158,6 +280,17 @@ class Content(Object):
         ids.append(self._id)
         return ids
 
+    def get_path(self):
+        """ Return the path of this object as a string of unquoted names
+        separated by slashes (the root's path is "/").
+        """
+        names = []
+        obj = self
+        while obj.__parent__ is not None:
+            names.insert(0, obj.__name__)
+            obj = obj.__parent__
+        return '/' + '/'.join(names)
+
     def _pre_delete(self):
         self.unindex()
         Object._pre_delete(self)
@@ -186,19 +319,31 @@ class Content(Object):
             return []
         return workflow.get_transitions(self, self.request)
 
-    def pub_workflow_transition(self, transition):
+    def pub_workflow_transition(self, transition, bulk=None):
         workflow = get_publication_workflow(self)
         workflow.transition(self, self.request, transition)
-        self.save()
+        self.save(bulk=bulk)
 
     def in_trash(self):
         return self.find_interface(ITrash) is not None
 
-    def _get_acl(self):
+    def _get_acl(self, in_trash=None, workflows=None):
+        """ Return the acl for this object's pub state (if any).
+        Callers that evaluate many siblings at once (see
+        ACLAuthorizationPolicyWithLocalRoles.permits_many()) can pass in_trash
+        (shared by all children of the same parent) and a dictionary in which
+        publication workflows are memoized by _object_type.
+        """
         # If we're in the trash, we shouldn't have any acl (and inherit the trash acl).
-        if self.in_trash(): return None
-        # Return the acl for our pub state (if any).
-        state = self.get_pub_state()
+        if in_trash is None: in_trash = self.in_trash()
+        if in_trash: return None
+        if workflows is None:
+            state = self.get_pub_state()
+        else:
+            if self._object_type not in workflows:
+                workflows[self._object_type] = get_publication_workflow(self)
+            workflow = workflows[self._object_type]
+            state = workflow and workflow.state_of(self)
         #log.debug("in _get_acl(); state=%s" % repr(state))
         if state:
             return permissions.acl_by_state.get(state, None)
@@ -216,8 +361,8 @@ class Content(Object):
     def _get_merged_local_roles(self):
         """ Recurse up from self to root looking for local roles.
         Merge the values together to discover all local roles that apply to self.
-        (Note that this method will only compute the result once and cache it;
-        later calls will return the cached result.)
+        (Note that this method will only compute the result once per instance;
+        results are also shared across requests via authorization.local_roles_cache.)
         Returns a dictionary where each key is a principal name with one or more
         local roles; each value is a set of system-level group principal names.
         """
@@ -226,19 +371,23 @@ class Content(Object):
         lr = {}
         if hasattr(self, 'get_local_roles'):
             lr = self.get_local_roles()
-        merged = {}
+        parent_merged = None
         if self.__parent__:
-            merged.update(self.__parent__._get_merged_local_roles())
-            if lr:
-                for (principal, sysgroup) in lr.items():
-                    local_sysgroups = merged.get(principal, set())
-                    local_sysgroups.add(sysgroup)
-                    merged[principal] = local_sysgroups
-        else:
-            merged = lr
+            parent_merged = self.__parent__._get_merged_local_roles()
+        merged = local_roles_cache.get_merged_local_roles(self._id, lr, parent_merged)
         self._merged_local_roles = merged
         return merged
 
+    def _get_inverted_local_roles(self):
+        """ Return a dictionary where each key is a system-level group principal name
+        and each value is a set of principal names with that local role.
+        """
+        return local_roles_cache.get_inverted_local_roles(self._id, self._get_merged_local_roles())
+
+def join_path(parent_path, name):
+    if parent_path == '/': return '/' + name
+    return parent_path + '/' + name
+
 def get_publication_workflow(context):
     return repoze.workflow.get_workflow(context, 'publication', context)
 
@@ -1,10 +1,19 @@
-from content import Content
+from content import Content, join_path
 from collection import Collection
 import colander, deform
 from pyramid import security
-from cms import orderutil
+from cms import orderutil, dbutil
+from cms.sortindexes import get_sort_from_settings, check_sort_index
 import widgets
 from cms.exceptions import NonOrderedFolderException, Veto
+from cms.authorization import local_roles_cache
+
+# Sort for listing the children of an ordered folder (see orderutil).
+ORDERED_SORT = [('_position', 1)]
+
+# Maximum number of ids in the "$in" lists (and of bulk updates per round trip)
+# of update_security_recursively() and update_paths_recursively().
+UPDATE_BATCH_SIZE = 1000
 
 class BaseFolder(Content, Collection):
     """ A Content object that can also behave like a Collection.
@@ -16,9 +25,11 @@ class BaseFolder(Content, Collection):
 
     _object_type = 'base folder'
 
+    _use_identity_map = True
+
     def get_class_schema(cls, request=None):
         schema = Content.get_class_schema(request)
-        schema.add(colander.SchemaNode(colander.Boolean(), name='_is_ordered', title="Enable child ordering?", default=False, missing=False, description="Enable this option if you need explicit control over ordering of child objects.  Please avoid enabling this option on folders with a large number of children where sorting is more appropriate."))
+        schema.add(colander.SchemaNode(colander.Boolean(), name='_is_ordered', title="Enable child ordering?", default=False, missing=False, description="Enable this option if you need explicit control over ordering of child objects (instead of sorting them)."))
 
         return schema
     get_class_schema = classmethod(get_class_schema)
@@ -41,15 +52,17 @@ class BaseFolder(Content, Collection):
     def _get_nonschema_mongo_save_document(self):
         doc = Content._get_nonschema_mongo_save_document(self)
         doc['_local_roles'] = self.get_local_roles()
-        doc['_ordered_names'] = self.get_ordered_names()
         return doc
 
     def _load_nonschema_attributes(self, **kwargs):
         Content._load_nonschema_attributes(self, **kwargs)
         _local_roles = kwargs.get('_local_roles')
         if _local_roles: self._local_roles = _local_roles
+        # Folders saved before children had position keys stored a list of names.
         _ordered_names = kwargs.get('_ordered_names')
-        if _ordered_names is not None: self._ordered_names = _ordered_names
+        if _ordered_names is not None: self._legacy_ordered_names = _ordered_names
+        # Whether ordering was already enabled when this folder was loaded (see save()).
+        self._was_ordered = bool(kwargs.get('_is_ordered'))
 
     def _morph_spec(self, spec):
         if spec is None: spec = {}
@@ -66,6 +79,13 @@ class BaseFolder(Content, Collection):
         return spec
 
     def get_viewable_child(self, name):
+        child = self._get_identity_map().get_by_name(self._id, name)
+        if (child is not None) and hasattr(child, '_view'):
+            # Check the "_view" principals that were loaded with the cached child.
+            principals = security.effective_principals(self.request)
+            if ('group:superuser' in principals) or set(principals).intersection(child._view):
+                return child
+            return None
         spec = self._morph_spec({'__name__': name})
         spec = self._add_view_to_spec(spec)
         doc = self._get_collection().find_one(spec)
@@ -86,17 +106,17 @@ class BaseFolder(Content, Collection):
             raise KeyError
         return child
 
-    def get_viewable_children_and_total(self, spec=None, sort=None, skip=0, limit=0):
+    def get_viewable_children_and_total(self, spec=None, sort=None, skip=0, limit=0, count=True):
         spec = self._add_view_to_spec(spec)
-        return Collection.get_children_and_total(self, spec=spec, sort=sort, skip=skip, limit=limit)
+        return Collection.get_children_and_total(self, spec=spec, sort=sort, skip=skip, limit=limit, count=count)
 
     def get_viewable_children(self, spec=None, sort=None, skip=0, limit=0):
         spec = self._add_view_to_spec(spec)
         return Collection.get_children(self, spec=spec, sort=sort, skip=skip, limit=limit)
 
-    def get_viewable_child_names_and_total(self, spec=None, sort=None, skip=0, limit=0):
+    def get_viewable_child_names_and_total(self, spec=None, sort=None, skip=0, limit=0, count=True):
         spec = self._add_view_to_spec(spec)
-        return Collection.get_child_names_and_total(self, spec=spec, sort=sort, skip=skip, limit=limit)
+        return Collection.get_child_names_and_total(self, spec=spec, sort=sort, skip=skip, limit=limit, count=count)
 
     def get_viewable_child_names(self, spec=None, sort=None, skip=0, limit=0):
         spec = self._add_view_to_spec(spec)
@@ -106,84 +126,196 @@ class BaseFolder(Content, Collection):
         spec = self._add_view_to_spec(spec)
         return Collection.get_children_lazily(self, spec=spec, sort=sort)
 
-    def get_ordered_children(self):
-        names = self.get_ordered_names()
-        if names is None: raise NonOrderedFolderException()
-        children = self.get_children()
-        return _order_objects_by_names(children, names)
+    def _check_ordered(self):
+        if not self.is_ordered(): raise NonOrderedFolderException()
+        if hasattr(self, '_legacy_ordered_names'): self._init_child_positions()
+
+    def get_ordered_children(self, limit=0):
+        self._check_ordered()
+        return self.get_children(sort=ORDERED_SORT, limit=limit)
+
+    def get_viewable_ordered_children(self, limit=0):
+        self._check_ordered()
+        return self.get_viewable_children(sort=ORDERED_SORT, limit=limit)
 
-    def get_viewable_ordered_children(self):
-        names = self.get_ordered_names()
-        if names is None: raise NonOrderedFolderException()
-        children = self.get_viewable_children()
-        return _order_objects_by_names(children, names)
+    def get_viewable_ordered_child_summaries(self, fields=None, limit=0):
+        self._check_ordered()
+        return self.get_viewable_child_summaries(sort=ORDERED_SORT, limit=limit, fields=fields)
+
+    def get_ordered_children_page(self, limit=20, token=None):
+        self._check_ordered()
+        return Collection.get_children_page(self, sort=ORDERED_SORT, limit=limit, token=token)
+
+    def get_viewable_ordered_child_summaries_page(self, limit=20, token=None, fields=None):
+        self._check_ordered()
+        spec = self._add_view_to_spec(None)
+        return Collection.get_child_summaries_page(self, spec=spec, sort=ORDERED_SORT, limit=limit, token=token, fields=fields)
+
+    def get_viewable_child_summaries_and_total(self, spec=None, sort=None, skip=0, limit=0, fields=None, count=True):
+        spec = self._add_view_to_spec(spec)
+        return Collection.get_child_summaries_and_total(self, spec=spec, sort=sort, skip=skip, limit=limit, fields=fields, count=count)
+
+    def get_viewable_child_summaries(self, spec=None, sort=None, skip=0, limit=0, fields=None):
+        return self.get_viewable_child_summaries_and_total(spec, sort, skip, limit, fields, count=False)['items']
 
     def add_child(self, name, child):
+        # New children of an ordered folder go to the bottom.
+        if self.is_ordered():
+            child._position = orderutil.key_between(self._get_end_position(last=True), None)
+        else:
+            child._position = None
         Collection.add_child(self, name, child)
-        names = self.get_ordered_names()
-        if names is not None:
-            names.append(name)
-            self._ordered_names = names
-            self.save()
-
-    def delete_child(self, name):
-        Collection.delete_child(self, name)
-        self._child_removed(name)
-
-    def _child_removed(self, name):
-        names = self.get_ordered_names()
-        if (names is not None) and (name in names):
-            names.remove(name)
-            self._ordered_names = names
-            self.save()
 
     def rename_child(self, name, newname, _validate=True):
         if Collection.rename_child(self, name, newname, _validate=_validate):
-            names = self.get_ordered_names()
-            if names is not None:
-                idx = names.index(name)
-                names[idx] = newname
-                self._ordered_names = names
-                self.save()
+            update_paths_recursively(self.get_child(newname))
             return 1
         else:
             return 0
 
-    def reorder_names_up(self, names_to_reorder, delta=1):
-        names = self.get_ordered_names()
-        if names is None: raise NonOrderedFolderException()
-        reordered_names = orderutil.reorder_ids_up(names, names_to_reorder, delta)
-        if reordered_names:
-            self._ordered_names = names
-            self.save()
+    def save(self, set_modified=True, index=True, bulk=None):
+        Content.save(self, set_modified=set_modified, index=index, bulk=bulk)
+        # Children only lack a position if ordering was just enabled (or the
+        # folder still has a legacy list of names), so don't query them otherwise.
+        if self.is_ordered() and ((not self._was_ordered) or hasattr(self, '_legacy_ordered_names')):
+            self._init_child_positions()
+        self._was_ordered = self.is_ordered()
+
+    # Ordering support.
+    # Each child of an ordered folder has a "_position" key (see orderutil).
+    # Reordering only updates the children that move.
+
+    def _get_end_position(self, last=False):
+        """ Return the position key of the first (or last) child, or None. """
+        dir = 1
+        if last: dir = -1
+        spec = self._morph_spec({'_position': {'$ne': None}})
+        for doc in self._get_collection().find(spec, fields=['_position'], sort=[('_position', dir)], limit=1):
+            return doc['_position']
+        return None
+
+    def _set_child_position(self, _id, position):
+        self._get_collection().update({'_id': _id}, {'$set': {'_position': position}}, safe=True)
+        # Keep an instance in the request's identity map from saving a stale position later.
+        imap = self._get_identity_map()
+        if _id in imap: imap.get(_id)._position = position
+
+    def _init_child_positions(self):
+        """ Give a position to each child that doesn't have one (after the
+        others), such as when ordering was just enabled.
+        Folders saved with the old list of ordered names are converted.
+        """
+        legacy_names = getattr(self, '_legacy_ordered_names', None)
+        docs = list(self._get_collection().find(self._morph_spec({'_position': None}), fields=['__name__']))
+        if docs:
+            order = {}
+            for (idx, name) in enumerate(legacy_names or []):
+                order[name] = idx
+            docs.sort(key=lambda doc: (order.get(doc['__name__'], len(order)), doc['__name__']))
+            keys = orderutil.keys_between(self._get_end_position(last=True), None, len(docs))
+            for (doc, key) in zip(docs, keys):
+                self._set_child_position(doc['_id'], key)
+        if legacy_names is not None:
+            self._get_collection().update({'_id': self._id}, {'$unset': {'_ordered_names': 1}}, safe=True)
+            del self._legacy_ordered_names
+
+    def _respace_child_positions(self):
+        """ Give all children evenly spaced positions (keeping their order).
+        This is only needed once keys have grown long from many moves into the same spot.
+        """
+        docs = list(self._get_collection().find(self._morph_spec(None), fields=['_id'], sort=ORDERED_SORT + [('_id', 1)]))
+        keys = orderutil.keys_between(None, None, len(docs))
+        for (doc, key) in zip(docs, keys):
+            self._set_child_position(doc['_id'], key)
+
+    def _get_position_docs(self, names):
+        """ Return a list of documents (with _id, __name__ and _position) for
+        the named children, in the same order as the names.
+        """
+        docs_by_name = {}
+        for doc in self._get_collection().find(self._morph_spec({'__name__': {'$in': list(names)}}), fields=['__name__', '_position']):
+            docs_by_name[doc['__name__']] = doc
+        result = []
+        for name in names:
+            doc = docs_by_name.pop(name, None)
+            if doc: result.append(doc)
+        return result
+
+    def _reorder_by_delta(self, names_to_reorder, delta):
+        """ Move the named children by delta positions
+        (negative delta moves them towards the top).
+        Returns a list of the names that actually moved.
+        """
+        self._check_ordered()
+        # Logic borrowed from Zope/lib/python/OFS/OrderSupport.py
+        # (children that reach the end stack up there in the given order).
+        if delta > 0:
+            (op, dir) = ('$gt', 1)
+            docs = self._get_position_docs(list(reversed(names_to_reorder)))
+        else:
+            (op, dir) = ('$lt', -1)
+            docs = self._get_position_docs(names_to_reorder)
+        steps = abs(delta)
+        collection = self._get_collection()
+        boundary = None
+        reordered_names = []
+        new_keys = []
+        for doc in docs:
+            position = doc.get('_position')
+            if position is None: continue
+            range_spec = {op: position}
+            if boundary is not None:
+                range_spec[{'$gt': '$lt', '$lt': '$gt'}[op]] = boundary
+            # The children we'd pass, plus the one we'd land next to.
+            passed = [x['_position'] for x in collection.find(self._morph_spec({'_position': range_spec}), fields=['_position'], sort=[('_position', dir)], limit=steps+1)]
+            if not passed:
+                # Already at the end (or next to the previous child that stopped there).
+                boundary = position
+                continue
+            if len(passed) > steps:
+                (near, far) = (passed[steps-1], passed[steps])
+            else:
+                # Stop at the end (or next to the previous child that stopped there).
+                (near, far) = (passed[-1], boundary)
+            if dir == -1: key = orderutil.key_between(far, near)
+            else: key = orderutil.key_between(near, far)
+            if len(passed) <= steps: boundary = key
+            self._set_child_position(doc['_id'], key)
+            reordered_names.append(doc['__name__'])
+            new_keys.append(key)
+        if orderutil.needs_respacing(new_keys): self._respace_child_positions()
         return reordered_names
 
+    def reorder_names_up(self, names_to_reorder, delta=1):
+        return self._reorder_by_delta(names_to_reorder, -delta)
+
     def reorder_names_down(self, names_to_reorder, delta=1):
-        names = self.get_ordered_names()
-        if names is None: raise NonOrderedFolderException()
-        reordered_names = orderutil.reorder_ids_down(names, names_to_reorder, delta)
-        if reordered_names:
-            self._ordered_names = names
-            self.save()
+        return self._reorder_by_delta(names_to_reorder, delta)
+
+    def _reorder_to_end(self, names_to_reorder, last):
+        self._check_ordered()
+        docs = self._get_position_docs(names_to_reorder)
+        if not docs: return []
+        # Figure out which ones will actually move...
+        if last:
+            current = [x['_id'] for x in self._get_collection().find(self._morph_spec(None), fields=['_id'], sort=[('_position', -1), ('_id', -1)], limit=len(docs))]
+            current.reverse()
+        else:
+            current = [x['_id'] for x in self._get_collection().find(self._morph_spec(None), fields=['_id'], sort=ORDERED_SORT + [('_id', 1)], limit=len(docs))]
+        reordered_names = [doc['__name__'] for (doc, _id) in zip(docs, current) if doc['_id'] != _id]
+        if not reordered_names: return reordered_names
+        if last: keys = orderutil.keys_between(self._get_end_position(last=True), None, len(docs))
+        else: keys = orderutil.keys_between(None, self._get_end_position(), len(docs))
+        for (doc, key) in zip(docs, keys):
+            self._set_child_position(doc['_id'], key)
+        if orderutil.needs_respacing(keys): self._respace_child_positions()
         return reordered_names
 
     def reorder_names_to_top(self, names_to_reorder):
-        names = self.get_ordered_names()
-        if names is None: raise NonOrderedFolderException()
-        reordered_names = orderutil.reorder_ids_to_top(names, names_to_reorder)
-        if reordered_names:
-            self._ordered_names = names
-            self.save()
-        return reordered_names
+        return self._reorder_to_end(names_to_reorder, last=False)
 
     def reorder_names_to_bottom(self, names_to_reorder):
-        names = self.get_ordered_names()
-        if names is None: raise NonOrderedFolderException()
-        reordered_names = orderutil.reorder_ids_to_bottom(names, names_to_reorder)
-        if reordered_names:
-            self._ordered_names = names
-            self.save()
-        return reordered_names
+        return self._reorder_to_end(names_to_reorder, last=True)
 
     def _pre_delete(self):
         # If I'm being deleted, my kids are going down with me.
@@ -229,11 +361,9 @@ class BaseFolder(Content, Collection):
         if obj.__parent__._id == self._id: return 0
         error = self.veto_move_child(obj)
         if error: raise Veto(error)
-        orig_parent = obj.__parent__
         self.add_child(obj.__name__, obj)
+        update_paths_recursively(obj)
         index_recursively(obj, include_self=False)
-        # Notify old parent that child was moved (gives ordered folders an opportunity to update their ordered name list).
-        orig_parent._child_removed(obj.__name__)
         return 1
 
     def veto_move_children(self, objects):
@@ -269,8 +399,10 @@ class BaseFolder(Content, Collection):
         In that case, try "NAME-1", "NAME-2", etc.
         Return the copy object.
         """
-        root = self.find_root()
-        newchild = root.get_content_by_id(obj._id)
+        # Construct a fresh instance from the database (rather than one from the
+        # request's identity map) since we're about to turn it into a new object.
+        doc = self._get_collection().find_one({'_id': obj._id})
+        newchild = self._get_child_class(doc)(self.request, **(dbutil.encode_keys(doc)))
         newchild._id = None
         newchild._created = None
         # Clear _pub_state, if any.
@@ -308,38 +440,46 @@ class BaseFolder(Content, Collection):
             result.append((obj, new_obj))
         return result
 
-    def pub_workflow_transition(self, transition, save_children=True):
+    def pub_workflow_transition(self, transition, save_children=True, bulk=None):
         """ Apply a workflow transition to this Folder, and (unless save_children==False)
-        we also want to update "_view" fields of all children in both mongo and elastic by
-        calling their save() method.
+        we also want to update "_view" fields of all children in both mongo and elastic
+        (see update_security_recursively()).
         """
-        Content.pub_workflow_transition(self, transition)
+        Content.pub_workflow_transition(self, transition, bulk=bulk)
         if save_children:
-            save_recursively(self, include_self=False, set_modified=False)
+            update_security_recursively(self, include_self=False, bulk=bulk)
 
-    def pub_workflow_transition_recursively(self, transition, include_self=True):
+    def pub_workflow_transition_recursively(self, transition, include_self=True, bulk=None):
         """ Apply a workflow transition to this Folder (unless include_self==False)
         and recurse into children trying to apply the same transition if it applies.
         Returns a set of ObjectIds for the objects that were transitioned.
+        All the reindexing is done in bulk.
         """
+        own_bulk = bulk is None
+        if own_bulk: bulk = dbutil.get_es_bulk_indexer(self.request)
         result = set()
-        if include_self:
-            self.pub_workflow_transition(transition, save_children=False)
-            result.add(self._id)
-        for child in self.get_children_lazily():
-            transition_applies = transition in [x['name'] for x in child.get_pub_workflow_transitions()]
-            is_folder = isinstance(child, Folder)
-            if transition_applies:
-                if is_folder:
-                    result.update(child.pub_workflow_transition_recursively(transition))
+        try:
+            if include_self:
+                self.pub_workflow_transition(transition, save_children=False, bulk=bulk)
+                result.add(self._id)
+            for child in self.get_children_lazily():
+                transition_applies = transition in [x['name'] for x in child.get_pub_workflow_transitions()]
+                is_folder = isinstance(child, Folder)
+                if transition_applies:
+                    if is_folder:
+                        result.update(child.pub_workflow_transition_recursively(transition, bulk=bulk))
+                    else:
+                        child.pub_workflow_transition(transition, bulk=bulk)
+                        result.add(child._id)
                 else:
-                    child.pub_workflow_transition(transition)
-                    result.add(child._id)
-            else:
-                # We want the child's "_view" field to be updated in both mongo and elastic.
-                child.save(set_modified=False)
-                if is_folder:
-                    result.update(child.pub_workflow_transition_recursively(transition, include_self=False))
+                    # We want the child's "_view" field to be updated in both mongo and elastic.
+                    child.update_security_fields(bulk=bulk)
+                    if is_folder:
+                        result.update(child.pub_workflow_transition_recursively(transition, include_self=False, bulk=bulk))
+        except:
+            if own_bulk: bulk.close()
+            raise
+        if own_bulk: bulk.close(check=True)
         return result
 
     def get_local_roles(self):
@@ -350,10 +490,8 @@ class BaseFolder(Content, Collection):
 
     def get_ordered_names(self):
         if self.is_ordered():
-            if not hasattr(self, '_ordered_names'):
-                # This folder must have just had ordering enabled.  Initialize the ordered list.
-                self._ordered_names = self.get_child_names()
-            return getattr(self, '_ordered_names')
+            self._check_ordered()
+            return self.get_child_names(sort=ORDERED_SORT)
         else:
             return None
 
@@ -364,6 +502,8 @@ class BaseFolder(Content, Collection):
         """
         self._local_roles = local_roles
         self.save(set_modified=False)
+        local_roles_cache.invalidate()
+        if hasattr(self, '_merged_local_roles'): del self._merged_local_roles
         # FIXME: A recursive save is only necessary if view permission is only allowed to certain authenticated users/groups.
         # Consider adding an ".ini" setting for sites that require such strict access control of the view perm.
         #save_recursively(self, include_self=False, set_modified=False)
@@ -379,35 +519,121 @@ def recurse_content(obj, include_self=True):
                     yield result
     return visit(obj, include_self)
 
-def index_content(obj):
+def index_content(obj, bulk=None):
     if isinstance(obj, Content):
-        obj.index()
+        obj.index(bulk=bulk)
 
-def unindex_content(obj):
+def unindex_content(obj, bulk=None):
     if isinstance(obj, Content):
-        obj.unindex()
-
-def index_recursively(obj, include_self=True):
-    for node in recurse_content(obj, include_self=include_self):
-        index_content(node)
-
-def unindex_recursively(obj, include_self=True):
-    for node in recurse_content(obj, include_self=include_self):
-        unindex_content(node)
-
-def save_recursively(obj, include_self=True, set_modified=True, index=True):
-    for node in recurse_content(obj, include_self=include_self):
-        node.save(set_modified=set_modified, index=index)
-
-def _order_objects_by_names(objects, names):
-    objects_by_name = {}
-    for obj in objects:
-        objects_by_name[obj.__name__] = obj
-    result = []
-    for name in names:
-        obj = objects_by_name.get(name, None)
-        if obj: result.append(obj)
-    return result
+        obj.unindex(bulk=bulk)
+
+# The recursive helpers below send the ElasticSearch updates in "_bulk"
+# batches (see esbulk).  Unless an open BulkIndexer is passed in, they
+# return the bulk report (see BulkIndexer.close()), or raise
+# esbulk.BulkIndexError if any document couldn't be (un)indexed.
+# (Whoever passes in a BulkIndexer is responsible for checking it.)
+
+def _with_bulk(obj, bulk, func):
+    if bulk is not None:
+        func(bulk)
+        return None
+    bulk = dbutil.get_es_bulk_indexer(obj.request)
+    try:
+        func(bulk)
+    except:
+        # Still send what's been buffered, but don't mask the original error.
+        bulk.close()
+        raise
+    return bulk.close(check=True)
+
+def index_recursively(obj, include_self=True, bulk=None):
+    def func(bulk):
+        for node in recurse_content(obj, include_self=include_self):
+            index_content(node, bulk=bulk)
+    return _with_bulk(obj, bulk, func)
+
+def unindex_recursively(obj, include_self=True, bulk=None):
+    def func(bulk):
+        for node in recurse_content(obj, include_self=include_self):
+            unindex_content(node, bulk=bulk)
+    return _with_bulk(obj, bulk, func)
+
+def save_recursively(obj, include_self=True, set_modified=True, index=True, bulk=None):
+    def func(bulk):
+        for node in recurse_content(obj, include_self=include_self):
+            node.save(set_modified=set_modified, index=index, bulk=bulk)
+    return _with_bulk(obj, bulk, func)
+
+def update_security_recursively(obj, include_self=True, bulk=None):
+    """ Bring the stored "_view" and "_pub_state" fields of obj and its
+    descendants up to date after a workflow or ACL change, without re-saving
+    or reindexing whole documents.
+    Objects whose fields haven't changed are skipped.  MongoDB is updated with
+    one multi-document "$set" per distinct set of new values, and
+    ElasticSearch with partial bulk updates.
+    Returns the number of objects updated.
+    """
+    collection = obj._get_collection()
+    groups = {}
+    counts = dict(updated=0, pending=0)
+    def flush():
+        for (key, ids) in groups.items():
+            fields = dict([(name, isinstance(value, tuple) and list(value) or value) for (name, value) in key])
+            collection.update({'_id': {'$in': ids}}, {'$set': fields}, multi=True, safe=True)
+        groups.clear()
+        counts['pending'] = 0
+    def func(bulk):
+        for node in recurse_content(obj, include_self=include_self):
+            if not isinstance(node, Content): continue
+            fields = node.get_changed_security_fields()
+            if not fields: continue
+            for (name, value) in fields.items(): setattr(node, name, value)
+            key = tuple(sorted([(name, isinstance(value, list) and tuple(value) or value) for (name, value) in fields.items()]))
+            groups.setdefault(key, []).append(node._id)
+            node.update_index(fields, bulk=bulk)
+            counts['updated'] += 1
+            counts['pending'] += 1
+            if counts['pending'] >= UPDATE_BATCH_SIZE: flush()
+        flush()
+    _with_bulk(obj, bulk, func)
+    return counts['updated']
+
+def update_paths_recursively(obj):
+    """ Refresh the materialized "_ancestor_ids" and "_path" stored on every
+    descendant of obj (needed after obj has been moved or renamed).
+    The tree is walked one level at a time, with one "$in" query on
+    "__parent__" per UPDATE_BATCH_SIZE folders of that level, and the new
+    values are written with unordered bulk updates (UPDATE_BATCH_SIZE per
+    round trip), without loading full documents.
+    """
+    if not isinstance(obj, BaseFolder): return
+    collection = obj._get_collection()
+    root = obj.find_root()
+    folder_types = [t for (t, cls) in root._content_type_factories.items() if issubclass(cls, BaseFolder)]
+    pending = []
+    def flush():
+        if not pending: return
+        bulk = collection.initialize_unordered_bulk_op()
+        for (_id, fields) in pending:
+            bulk.find({'_id': _id}).update_one({'$set': fields})
+        bulk.execute()
+        del pending[:]
+    # Maps the _id of each folder on the current level to its (id path, path).
+    level = {obj._id: (obj.get_id_path(), obj.get_path())}
+    while level:
+        next_level = {}
+        parent_ids = level.keys()
+        for i in range(0, len(parent_ids), UPDATE_BATCH_SIZE):
+            spec = {'__parent__': {'$in': parent_ids[i:i+UPDATE_BATCH_SIZE]}}
+            for doc in collection.find(spec, fields=['__name__', '__parent__', '_object_type']):
+                (ancestor_ids, path) = level[doc['__parent__']]
+                child_path = join_path(path, doc['__name__'])
+                pending.append((doc['_id'], {'_ancestor_ids': ancestor_ids, '_path': child_path}))
+                if len(pending) >= UPDATE_BATCH_SIZE: flush()
+                if doc['_object_type'] in folder_types:
+                    next_level[doc['_id']] = (ancestor_ids + [doc['_id']], child_path)
+        level = next_level
+    flush()
 
 class Folder(BaseFolder):
     """ Extends BaseFolder adding schema attributes that allow a CMS user to customize a folder's default view.
@@ -481,7 +707,7 @@ class Folder(BaseFolder):
         child_list_settings.add(colander.SchemaNode(colander.String(), name='other_display_date', include_in_other_text=False, title="Other display date", widget=widgets.get_wide_text_widget(), default='', missing='', description="The name of another date field (when the date to display is set to \"other\")."))
         child_list_settings.add(colander.SchemaNode(colander.String(), name='intro', widget=widgets.get_html_widget(), default='', missing='', description="Any content entered here will be displayed before the list of child objects."))
         child_list_settings.add(colander.SchemaNode(colander.String(), name='outro', widget=widgets.get_html_widget(), default='', missing='', description="Any content entered here will be displayed after the list of child objects."))
-        child_list_settings.add(colander.SchemaNode(colander.Boolean(), name='intro_outro_first_page_only', title="Show intro and outro on first page only?", default=False, missing=False, description="For unordered folders, large numbers of children will be split across multiple pages.  In such a case, the intro and outro will be displayed on all pages unless you enable this option."))
+        child_list_settings.add(colander.SchemaNode(colander.Boolean(), name='intro_outro_first_page_only', title="Show intro and outro on first page only?", default=False, missing=False, description="Large numbers of children will be split across multiple pages.  In such a case, the intro and outro will be displayed on all pages unless you enable this option."))
         child_list_settings.validator = child_list_settings_validator
         schema.add(child_list_settings)
         schema.add(colander.SchemaNode(colander.String(), name='specific_child_name', include_in_other_text=False, title="Name of child to display", widget=widgets.get_wide_text_widget(), default='index', missing='', description="The name of a specific child to try to display (when the view style is \"display specific child\")."))
@@ -492,35 +718,70 @@ class Folder(BaseFolder):
     get_class_schema = classmethod(get_class_schema)
 
     def get_default_sort(self):
-        result = []
-        for i in (1, 2):
-            settings = getattr(self, "sort%s_settings" % i, None)
-            if settings:
-                field = settings.get('field')
-                if field:
-                    if field == '_other':
-                        field = settings.get('other')
-                if field:
-                    dir = settings.get('dir', 'asc')
-                    if dir == 'desc': dir = -1
-                    else: dir = 1
-                    result.append((field, dir))
-        return result
+        return get_sort_from_settings(getattr(self, 'sort1_settings', None), getattr(self, 'sort2_settings', None))
 
-    def get_sorted_children_and_total(self, spec=None, skip=0, limit=0):
-        return Collection.get_children_and_total(self, spec=spec, sort=self.get_default_sort(), skip=skip, limit=limit)
+    def save(self, set_modified=True, index=True, bulk=None):
+        BaseFolder.save(self, set_modified=set_modified, index=index, bulk=bulk)
+        # Warn if the child listing will need an in-memory sort.
+        if not self.is_ordered():
+            check_sort_index(self._get_collection(), self.get_default_sort())
+
+    def get_sorted_children_and_total(self, spec=None, skip=0, limit=0, count=True):
+        return Collection.get_children_and_total(self, spec=spec, sort=self.get_default_sort(), skip=skip, limit=limit, count=count)
 
     def get_sorted_children(self, spec=None, skip=0, limit=0):
         return Collection.get_children(self, spec=spec, sort=self.get_default_sort(), skip=skip, limit=limit)
 
-    def get_viewable_sorted_children_and_total(self, spec=None, skip=0, limit=0):
+    def get_viewable_sorted_children_and_total(self, spec=None, skip=0, limit=0, count=True):
         spec = self._add_view_to_spec(spec)
-        return Collection.get_children_and_total(self, spec=spec, sort=self.get_default_sort(), skip=skip, limit=limit)
+        return Collection.get_children_and_total(self, spec=spec, sort=self.get_default_sort(), skip=skip, limit=limit, count=count)
 
     def get_viewable_sorted_children(self, spec=None, skip=0, limit=0):
         spec = self._add_view_to_spec(spec)
         return Collection.get_children(self, spec=spec, sort=self.get_default_sort(), skip=skip, limit=limit)
 
+    def get_viewable_sorted_child_summaries_and_total(self, spec=None, skip=0, limit=0, fields=None, count=True):
+        return self.get_viewable_child_summaries_and_total(spec=spec, sort=self.get_default_sort(), skip=skip, limit=limit, fields=fields, count=count)
+
+    def get_viewable_sorted_child_summaries_page(self, spec=None, limit=20, token=None, fields=None):
+        spec = self._add_view_to_spec(spec)
+        return Collection.get_child_summaries_page(self, spec=spec, sort=self.get_default_sort(), limit=limit, token=token, fields=fields)
+
+    def get_list_item_fields(self):
+        """ Return a list of the item fields ("title", "description" and/or "date")
+        to display for each child, based on child_list_settings['list_item_style'].
+        """
+        list_item_style = self.child_list_settings['list_item_style']
+        list_item_fields = ['title']
+        if list_item_style == 'title_description':
+            list_item_fields.append('description')
+        elif list_item_style == 'title_date':
+            list_item_fields.append('date')
+        elif list_item_style == 'title_date_description':
+            list_item_fields.append('date')
+            list_item_fields.append('description')
+        elif list_item_style == 'title_description_date':
+            list_item_fields.append('description')
+            list_item_fields.append('date')
+        return list_item_fields
+
+    def get_display_date_name(self):
+        display_date = self.child_list_settings['display_date']
+        if display_date == '_other': display_date = self.child_list_settings['other_display_date']
+        return display_date
+
+    def get_child_listing_projection(self):
+        """ Return the MongoDB fields that need to be loaded to list children
+        (see get_list_item_fields()).
+        """
+        fields = ['__name__', '__parent__', '_object_type']
+        for field in self.get_list_item_fields():
+            if field == 'date':
+                fields.append(self.get_display_date_name())
+            else:
+                fields.append(field)
+        return fields
+
 def schema_validator(form, value):
     errors = {}
     view_style = value['view_style']
@@ -1,10 +1,104 @@
-from cms import dbutil, diffutil, htmlutil
+from cms import dbutil, diffutil, htmlutil, keysetutil
 from cms.dateutil import utcnow
 from pyramid.security import authenticated_userid
 from cms.thirdparty import diff_match_patch
+from copy import deepcopy
+import collections
+import threading
+import logging
+log = logging.getLogger(__name__)
 
 dmp = diff_match_patch.diff_match_patch()
 
+# History actions that record changes to schema values.
+EDIT_ACTIONS = ('edit', 'revert')
+
+# Defaults for how often a full snapshot of the schema values (a "keyframe")
+# is stored with an edit record: after this many edits, or once the patches
+# logged since the last keyframe add up to this many characters.
+KEYFRAME_INTERVAL = 50
+KEYFRAME_SIZE = 256 * 1024
+
+# Fields of history records needed to reconstruct old versions.
+RECONSTRUCTION_FIELDS = ['_id', 'time', 'action', 'changes', 'snapshot']
+
+class RevisionCache(object):
+    """ A process-wide LRU cache of reconstructed schema values (the values
+    just after a history event), keyed by (content _id, history _id), so
+    that flipping between the snapshot and diff views of the same revisions
+    doesn't replay the same patches again.
+    The cache is capped both by number of entries (max_size) and by the
+    approximate total size of the cached values in characters (max_chars).
+    Entries for an object are dropped when an edit to it is logged in this
+    process.  (Old revisions don't really change with newer edits, except
+    for schema values they didn't have, which are taken from the current
+    object.)
+    """
+
+    def __init__(self, max_size=100, max_chars=10*1024*1024):
+        self.max_size = max_size
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self.chars = 0
+        self._entries = collections.OrderedDict()
+        self._keys_by_object = {}
+        # Requests are handled in several threads.
+        self._lock = threading.Lock()
+
+    def get(self, object_id, history_id):
+        """ Return a tuple of (history event time, schema values) or None. """
+        with self._lock:
+            entry = self._entries.pop((object_id, history_id), None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[(object_id, history_id)] = entry
+        (time, values, size) = entry
+        return (time, deepcopy(values))
+
+    def set(self, object_id, history_id, time, values):
+        if not self.max_size: return
+        size = diffutil.get_patch_size(diffutil.flatten_dictionary(values).items())
+        if self.max_chars and size > self.max_chars: return
+        values = deepcopy(values)
+        with self._lock:
+            self._remove((object_id, history_id))
+            self._entries[(object_id, history_id)] = (time, values, size)
+            self._keys_by_object.setdefault(object_id, set()).add(history_id)
+            self.chars += size
+            while (len(self._entries) > self.max_size) or (self.max_chars and self.chars > self.max_chars):
+                self._remove(self._entries.iterkeys().next())
+
+    def _remove(self, key):
+        # Callers must hold the lock.
+        entry = self._entries.pop(key, None)
+        if entry is None: return
+        self.chars -= entry[2]
+        (object_id, history_id) = key
+        history_ids = self._keys_by_object[object_id]
+        history_ids.discard(history_id)
+        if not history_ids: del self._keys_by_object[object_id]
+
+    def invalidate(self, object_id):
+        with self._lock:
+            for history_id in list(self._keys_by_object.get(object_id, ())):
+                self._remove((object_id, history_id))
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self._entries), chars=self.chars, hits=self.hits, misses=self.misses,
+                    hit_rate=lookups and (float(self.hits) / lookups) or 0.0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_object.clear()
+            self.chars = 0
+
+revision_cache = RevisionCache()
+
 class HistoryCollection(object):
 
     def __init__(self, request):
@@ -23,34 +117,124 @@ class HistoryCollection(object):
         )
         doc.update(**kwargs)
         self._get_collection().save(doc, safe=True)
+        if action in EDIT_ACTIONS:
+            for _id in ids:
+                revision_cache.invalidate(_id)
 
-    def get_history(self, spec=None, sort=None, skip=0, limit=0):
-        cursor = self._get_collection().find(spec=spec, sort=sort, skip=skip, limit=limit)
-        total = cursor.count()
-        return dict(total=total, items=list(cursor))
+    def get_history(self, spec=None, sort=None, skip=0, limit=0, count=True):
+        # See dbutil.get_batch() for the result and the count argument.
+        cursor = self._get_collection().find(spec=spec, sort=sort, skip=skip, limit=dbutil.fetch_limit(limit, count))
+        return dbutil.get_batch(cursor, skip, limit, count)
 
-    def get_history_for_id(self, _id, skip=0, limit=20):
-        return self.get_history(spec={'ids':_id}, sort=[('time', -1)], skip=skip, limit=limit)
+    def iter_history(self, spec=None, sort=None, fields=None, batch_size=100):
+        """ Yield history records one at a time (fetching them from the
+        database in batches of batch_size as needed), with only the given
+        fields.  Handy when the caller may stop before the end.
+        """
+        cursor = self._get_collection().find(spec=spec, sort=sort, fields=fields)
+        cursor.batch_size(batch_size)
+        for history in cursor:
+            yield history
+
+    def get_history_for_id(self, _id, skip=0, limit=20, count=True):
+        return self.get_history(spec={'ids':_id}, sort=[('time', -1)], skip=skip, limit=limit, count=count)
+
+    def get_history_for_user(self, username, skip=0, limit=20, count=True):
+        return self.get_history(spec={'user':username}, sort=[('time', -1)], skip=skip, limit=limit, count=count)
 
-    def get_history_for_user(self, username, skip=0, limit=20):
-        return self.get_history(spec={'user':username}, sort=[('time', -1)], skip=skip, limit=limit)
+    def get_history_page(self, spec=None, sort=None, limit=20, token=None):
+        # Keyset pagination; see keysetutil.get_page() for the result and the token argument.
+        return keysetutil.get_page(self._get_collection(), spec=spec, sort=sort, limit=limit, token=token)
+
+    def get_history_page_for_id(self, _id, limit=20, token=None):
+        return self.get_history_page(spec={'ids':_id}, sort=[('time', -1)], limit=limit, token=token)
+
+    def get_history_page_for_user(self, username, limit=20, token=None):
+        return self.get_history_page(spec={'user':username}, sort=[('time', -1)], limit=limit, token=token)
 
     def get_history_item(self, _id):
         return self._get_collection().find_one(dict(_id=_id))
 
+    def get_keyframe_fields(self, object_id, changes, values):
+        """ Return a dictionary of extra fields for the history record of an
+        edit (or revert) of the object with the given _id, where changes is
+        the logged patch and values are the object's new schema values.
+        Every so often the result includes a "snapshot" of the values (a
+        keyframe), so that reconstructing an old version never has to
+        replay more than a bounded number of patches.
+        "chain_length" and "chain_size" count the edits and patch characters
+        since the last keyframe (they're 0 for a keyframe).
+        """
+        settings = self.request.registry.settings or {}
+        interval = settings.get('history_keyframe_interval', KEYFRAME_INTERVAL)
+        max_size = settings.get('history_keyframe_size', KEYFRAME_SIZE)
+        length = 1
+        size = diffutil.get_patch_size(changes)
+        previous = self._get_collection().find_one({'ids':object_id, 'action':{'$in':list(EDIT_ACTIONS)}},
+            fields=['chain_length', 'chain_size'], sort=[('time', -1), ('_id', -1)])
+        if previous:
+            # Records logged before keyframes existed don't have these fields.
+            length += previous.get('chain_length', 0)
+            size += previous.get('chain_size', 0)
+        if (interval and length >= interval) or (max_size and size >= max_size):
+            return dict(snapshot=values, chain_length=0, chain_size=0)
+        return dict(chain_length=length, chain_size=size)
+
+    def _get_reconstruction_history(self, obj, history_ids):
+        """ Return an iterator of the history records (newest first) that have
+        to be walked to reconstruct the schema values of obj at the specified
+        history events.
+        If there's a keyframe at or after the latest of the events, the
+        records start there instead of at the object's latest change.
+        Records are streamed, so callers that stop at their target don't load
+        anything older.
+        """
+        spec = {'ids':obj._id}
+        targets = list(self._get_collection().find({'_id':{'$in':history_ids}}, fields=['time', 'chain_length']))
+        if targets and len(targets) == len(set(history_ids)):
+            latest = max(targets, key=lambda x: (x['time'], x['_id']))
+            if latest.get('chain_length') == 0:
+                time = latest['time']
+            else:
+                # Strictly later, so that the walk can't reach the target before the keyframe.
+                keyframe = self._get_collection().find_one({'ids':obj._id, 'chain_length':0, 'time':{'$gt':latest['time']}},
+                    fields=['time'], sort=[('time', 1), ('_id', 1)])
+                time = keyframe and keyframe['time']
+            if time:
+                spec['time'] = {'$lte':time}
+        # Only the edit records (and the targets) matter, and only the fields used for patching.
+        spec['$or'] = [{'action':{'$in':list(EDIT_ACTIONS)}}, {'_id':{'$in':history_ids}}]
+        return self.iter_history(spec=spec, sort=[('time', -1), ('_id', -1)], fields=RECONSTRUCTION_FIELDS)
+
+    def _get_keyframe_values(self, obj, snapshot):
+        # Schema values that didn't exist when the keyframe was logged keep
+        # their current values (as they do when replaying patches).
+        values = obj.get_schema_values()
+        values.update(snapshot)
+        return values
+
     def apply_history(self, obj, history_id):
         """ Given a content object and the _id of a history record, apply
         changes from the edit history such that the object has the schema
         values it had just after the specified history event.
         Note that this method modifies the content object in place.
         """
+        cached = revision_cache.get(obj._id, history_id)
+        if cached is not None:
+            obj.update(**cached[1])
+            return
+        values = obj.get_schema_values()
         patches = []
-        for history in self.get_history_for_id(obj._id)['items']:
+        for history in self._get_reconstruction_history(obj, [history_id]):
+            if 'snapshot' in history:
+                values = self._get_keyframe_values(obj, history['snapshot'])
+                patches = []
             if history['_id'] == history_id:
-                data = diffutil.patch_dictionary_multi(obj.get_schema_values(), patches)
+                data = diffutil.patch_dictionary_multi(values, patches)
+                self._cache_revision(obj, history, data)
                 obj.update(**data)
                 return
-            if history['action'] not in ('edit', 'revert'): continue
+            if history['action'] not in EDIT_ACTIONS: continue
             patch = history['changes']
             if patch: patches.append(patch)
         raise ValueError("Didn't find specified history record.")
@@ -85,28 +269,48 @@ class HistoryCollection(object):
             history_ids.append(history_id2)
         else:
             after = obj.get_schema_values()
+        if after_earlier_event:
+            cached = [revision_cache.get(obj._id, x) for x in history_ids]
+            if None not in cached:
+                if after is None:
+                    cached.sort()
+                    after = cached[1][1]
+                return diff_dictionaries(cached[0][1], after)
+        # Applying patches to values gives the values just after the
+        # history event being walked.
+        values = obj.get_schema_values()
         patches = []
-        for history in self.get_history_for_id(obj._id)['items']:
+        for history in self._get_reconstruction_history(obj, history_ids):
+            if 'snapshot' in history:
+                values = self._get_keyframe_values(obj, history['snapshot'])
+                patches = []
+
             if history['_id'] in history_ids:
                 if after:
                     if after_earlier_event:
-                        before = diffutil.patch_dictionary_multi(after, patches)
+                        before = diffutil.patch_dictionary_multi(values, patches)
+                        self._cache_revision(obj, history, before)
                         return diff_dictionaries(before, after)
                 else:
-                    after = diffutil.patch_dictionary_multi(obj.get_schema_values(), patches)
+                    after = values = diffutil.patch_dictionary_multi(values, patches)
+                    self._cache_revision(obj, history, after)
                     patches = []
 
-            if history['action'] in ('edit', 'revert'):
+            if history['action'] in EDIT_ACTIONS:
                 patch = history['changes']
                 if patch: patches.append(patch)
 
             if history['_id'] in history_ids:
                 if after and not after_earlier_event:
-                    before = diffutil.patch_dictionary_multi(after, patches)
+                    before = diffutil.patch_dictionary_multi(values, patches)
                     return diff_dictionaries(before, after)
 
         raise ValueError("Didn't find specified history record.")
 
+    def _cache_revision(self, obj, history, values):
+        revision_cache.set(obj._id, history['_id'], history.get('time'), values)
+        log.debug("revision cache stats: %r", revision_cache.get_stats())
+
     def get_edit_history_diffs(self, obj, history_id):
         return self.get_history_diffs(obj, history_id, history_id, after_earlier_event=False)
 
@@ -1,15 +1,28 @@
-from folder import Folder
+from folder import Folder, BaseFolder
+from content import join_path
 from article import Article
 import permissions
 from pyramid import security
 
 from bson.objectid import ObjectId
+import datetime
+import pytz
 import pyes
-from cms import dbutil
+import pyes.facets
+from cms import dbutil, keysetutil, searchafter
+from cms.identitymap import get_identity_map
+from cms.authorization import local_roles_cache, get_principal_buckets
+from cms.searchcache import search_cache
 
 from users import UserCollection, GroupCollection, User, generate_random_password
 from trash import Trash
 
+# Search facets (see Root.search_raw()).
+FACETS = ('_object_type', '_pub_state', '_section', '_modified')
+MAX_TERM_FACETS = 50
+MAX_SECTION_FACETS = 50
+MODIFIED_FACET_INTERVAL = 'month'
+
 class Root(Folder):
     
     _object_type = 'root'
@@ -29,21 +42,92 @@ class Root(Folder):
         self.__parent__ = None
         self.__acl__ = permissions.root_acl
 
-    def index(self):
+    def index(self, bulk=None):
         # Don't index the root.
         pass
 
+    def update_index(self, fields, bulk=None):
+        pass
+
     def get_content_factory(self, object_type):
         return self._content_type_factories.get(object_type)
 
     def get_content_by_id(self, _id):
+        """ Return the content object with the given _id (with its chain of
+        __parent__ objects all the way up to the root), or None.
+        The ancestors are loaded with a single "$in" query using the
+        "_ancestor_ids" list stored on each document.
+        Objects already in the request's identity map are reused.
+        """
         if _id == 'trash':
             return self['trash']
         if _id == self._id:
             return self
-        doc = self._get_collection().find_one({'_id': _id})
+        imap = get_identity_map(self.request)
+        obj = imap.get(_id)
+        if obj is not None:
+            return obj
+        collection = self._get_collection()
+        doc = collection.find_one({'_id': _id})
         if doc is None:
             return None
+        ancestor_ids = doc.get('_ancestor_ids')
+        if (not ancestor_ids) or (ancestor_ids[0] != self._id):
+            # Document was saved before ancestor ids were tracked.
+            return self._get_content_by_id_recursively(doc)
+        docs_by_id = {}
+        ids_to_load = [x for x in ancestor_ids[1:] if (x != 'trash') and (x not in imap)]
+        if ids_to_load:
+            for item in collection.find({'_id': {'$in': ids_to_load}}):
+                docs_by_id[item['_id']] = item
+        parent = self
+        for ancestor_id in ancestor_ids[1:] + [_id]:
+            if ancestor_id == 'trash':
+                obj = self['trash']
+            elif ancestor_id in imap:
+                obj = imap.get(ancestor_id)
+                if obj.__parent__._id != parent._id:
+                    return self._get_content_by_id_recursively(doc)
+            else:
+                item = docs_by_id.get(ancestor_id, doc)
+                if (item['_id'] != ancestor_id) or (item['__parent__'] != parent._id):
+                    # Either an ancestor was deleted or the ancestor ids are stale
+                    # (something moved between calls); fall back to the slow way.
+                    return self._get_content_by_id_recursively(doc)
+                obj = self._construct_child_from_mongo_document(item)
+                obj.__parent__ = parent
+                if parent._id == 'trash':
+                    obj.__name__ = str(obj._id)
+            parent = obj
+        return obj
+
+    def preload_path(self, names):
+        """ Given a sequence of names (such as the segments of a request path),
+        load every content object along that path with a single query on the
+        "_path" index and register them in the request's identity map, so that
+        traversal can resolve them without another round trip per level.
+        Stops at the first name that isn't a content child (a view name, for example).
+        Returns the deepest object loaded (possibly the root itself).
+        """
+        paths = []
+        path = '/'
+        for name in names:
+            path = join_path(path, name)
+            paths.append(path)
+        if not paths: return self
+        docs_by_path = {}
+        for doc in self._get_collection().find({'_path': {'$in': paths}}):
+            docs_by_path[doc['_path']] = doc
+        obj = self
+        for path in paths:
+            doc = docs_by_path.get(path)
+            if (doc is None) or (doc['__parent__'] != obj._id) or (not isinstance(obj, BaseFolder)):
+                break
+            obj = obj._construct_child_from_mongo_document(doc)
+        return obj
+
+    def _get_content_by_id_recursively(self, doc):
+        # Load the parent chain one find_one() per level.
         obj = self._construct_child_from_mongo_document(doc)
         pid = doc['__parent__']
         if pid == self._id:
@@ -60,7 +144,7 @@ class Root(Folder):
         return obj
 
     # FIXME: add more options to allow searching a specific doctype with extra type-specific filters?
-    def search_raw(self, fulltext=None, title=None, description=None, __name__=None, _object_type=None, _pub_state=None, path_id=None, start=0, size=10, fields=None, highlight_fields=None, viewable_only=False, default_operator='AND', sort=None):
+    def search_raw(self, fulltext=None, title=None, description=None, __name__=None, _object_type=None, _pub_state=None, path_id=None, start=0, size=10, fields=None, highlight_fields=None, viewable_only=False, default_operator='AND', sort=None, search_after=None, scroll=None, scroll_id=None, facets=None):
         """
         fulltext, title and description should be query strings and may contain
         boolean operators and wildcards
@@ -73,6 +157,23 @@ class Root(Folder):
         sort should be a pyes-style sort string, in other words a comma-delimited list of field names each with the options suffix ":asc" or ":desc"
         (example: "_object_type,_created:desc")
 
+        search_after may be a list of the sort values of a hit (one per sort field);
+        only hits that come after it in the sort order are returned (see cms.searchafter).
+        Facets still count all the matching documents, but result['hits']['total']
+        only counts the hits after search_after.
+
+        If scroll is specified (a time such as "5m"), ElasticSearch keeps a
+        scroll cursor for the search open for that long and the result has a
+        "_scroll_id" key.  To get the next batch of hits, call this again with
+        just scroll and that scroll_id.
+
+        facets may be a sequence of facet names (see FACETS) to count the
+        matching documents by, in the same request.  The result then has a
+        "facets" key (see get_search_facets() for a friendlier format).
+
+        Results may come from the search cache (see cms.searchcache), so callers
+        must not modify them.
+
         Returns a pyes result dictionary.
         Keys are [u'hits', u'_shards', u'took', u'timed_out'].
         result['hits'] has the keys: [u'hits', u'total', u'max_score']
@@ -99,6 +200,23 @@ class Root(Folder):
             _pub_state = [_pub_state]
         if type(path_id) == ObjectId:
             path_id = [path_id]
+        conn = dbutil.get_es_conn(self.request)
+        if scroll_id:
+            return conn._send_request('GET', '_search/scroll', scroll_id, dict(scroll=scroll or '5m'))
+
+        principals = None
+        if viewable_only:
+            principals = security.effective_principals(self.request)
+
+        cache_key = None
+        if search_cache.is_enabled() and not scroll:
+            cache_key = search_cache.get_key(index=dbutil.get_es_index_name(self.request), fulltext=fulltext, title=title, description=description,
+                __name__=__name__, _object_type=_object_type, _pub_state=_pub_state, path_id=path_id, start=start, size=size,
+                source=fields is None, fields=fields, highlight_fields=highlight_fields, principals=principals,
+                default_operator=default_operator, sort=sort, search_after=search_after, facets=facets)
+            result = search_cache.get(cache_key)
+            if result is not None: return result
+            generation = search_cache.generation
 
         query = pyes.MatchAllQuery()
         if fulltext or title or description:
@@ -119,7 +237,7 @@ class Root(Folder):
             # Convert ObjectIds to strings
             filters.append(pyes.TermsFilter('_id_path', [str(x) for x in path_id]))
         if viewable_only:
-            filters.append(pyes.TermsFilter('_view', security.effective_principals(self.request)))
+            filters.append(self._get_view_filter(principals))
 
         if filters:
             query = pyes.FilteredQuery(query, pyes.ANDFilter(filters))
@@ -128,17 +246,88 @@ class Root(Folder):
         if highlight_fields:
             for field in highlight_fields:
                 search.add_highlight(field)
+        if facets:
+            search.facet.facets.extend(self._get_facets(facets))
+        body = search.serialize()
+        if search_after:
+            # A top-level filter only filters the hits (not the facets).
+            body['filter'] = searchafter.get_search_after_filter(searchafter.parse_sort(sort), search_after).serialize()
         # FIXME: use new search() method???
-        return dbutil.get_es_conn(self.request).search_raw(search, dbutil.get_es_index_name(self.request), sort=sort or '_score')
+        params = {}
+        if scroll: params['scroll'] = scroll
+        result = conn.search_raw(body, dbutil.get_es_index_name(self.request), sort=sort or '_score', **params)
+        if cache_key: search_cache.set(cache_key, result, generation)
+        return result
 
-    def search(self, fulltext=None, title=None, description=None, __name__=None, _object_type=None, _pub_state=None, path_id=None, start=0, size=10, highlight_fields=None, viewable_only=False, default_operator='AND', sort=None):
+    def _get_facets(self, names):
+        result = []
+        for name in names:
+            if name in ('_object_type', '_pub_state'):
+                result.append(pyes.facets.TermFacet(field=name, size=MAX_TERM_FACETS))
+            elif name == '_modified':
+                result.append(pyes.facets.DateHistogramFacet(name, field=name, interval=MODIFIED_FACET_INTERVAL))
+            elif name == '_section':
+                # One facet per top-level folder (the second id in _id_path).
+                for section in self._get_sections():
+                    result.append(pyes.facets.FilterFacet('_section:%s' % section['_id'], pyes.TermFilter('_id_path', str(section['_id']))))
+            else:
+                raise ValueError("Unknown facet %s" % name)
+        return result
+
+    def _get_sections(self):
+        if not hasattr(self, '_facet_sections'):
+            self._facet_sections = list(self._get_collection().find({'__parent__': self._id}, fields=['__name__', 'title'], sort=[('__name__', 1)], limit=MAX_SECTION_FACETS))
+        return self._facet_sections
+
+    def get_search_facets(self, result):
+        """ Return a dictionary of the facet counts of a search_raw() result, with these keys
+        (for the facets that were requested):
+        "_object_type", "_pub_state" - lists of (term, count) tuples
+        "_section" - a list of dictionaries with the keys "_id", "__name__", "title" and "count"
+        "_modified" - a list of (datetime, count) tuples, one per MODIFIED_FACET_INTERVAL
+        Terms and sections that have no matches are left out.
+        """
+        raw = result.get('facets') or {}
+        facets = {}
+        for name in ('_object_type', '_pub_state'):
+            if name in raw:
+                facets[name] = [(x['term'], x['count']) for x in raw[name]['terms']]
+        if '_modified' in raw:
+            facets['_modified'] = [(datetime.datetime.fromtimestamp(x['time'] / 1000, pytz.utc), x['count']) for x in raw['_modified']['entries']]
+        sections = []
+        has_sections = [x for x in raw.keys() if x.startswith('_section:')]
+        for section in has_sections and self._get_sections() or []:
+            facet = raw.get('_section:%s' % section['_id'])
+            if facet and facet['count']:
+                sections.append(dict(_id=section['_id'], __name__=section['__name__'], title=section.get('title'), count=facet['count']))
+        if sections: facets['_section'] = sections
+        return facets
+
+    def _get_view_filter(self, principals):
+        """ Return a filter that matches documents viewable by any of the principals.
+        The principals of each user (their userid) make a plain terms filter
+        unique to the user, so if the "search_principal_buckets" setting is
+        enabled, the principals are split into system, group and user-specific
+        buckets (see authorization.get_principal_buckets()) with one terms
+        filter each, and the filters for the shared buckets are cached and
+        reused across users by ElasticSearch.
+        """
+        settings = self.request.registry.settings or {}
+        if not settings.get('search_principal_buckets'):
+            return pyes.TermsFilter('_view', principals)
+        filters = [pyes.TermsFilter('_view', bucket) for bucket in get_principal_buckets(principals)]
+        if len(filters) == 1: return filters[0]
+        return pyes.ORFilter(filters)
+
+    def search(self, fulltext=None, title=None, description=None, __name__=None, _object_type=None, _pub_state=None, path_id=None, start=0, size=10, highlight_fields=None, viewable_only=False, default_operator='AND', sort=None, facets=None):
         # Return a dictionary with the keys:
         # "total": total number of matching hits
         # "took": search time in ms
         # "items": a list of child objects and highlights for the specified batch of hits
+        # "facets": facet counts, if facets were requested (see get_search_facets())
 
         # We just need the _id values (not _source, etc), so set fields=[]
-        result = self.search_raw(fulltext=fulltext, title=title, description=description, __name__=__name__, _object_type=_object_type, _pub_state=_pub_state, path_id=path_id, start=start, size=size, fields=[], highlight_fields=highlight_fields, viewable_only=viewable_only, default_operator='AND', sort=sort)
+        result = self.search_raw(fulltext=fulltext, title=title, description=description, __name__=__name__, _object_type=_object_type, _pub_state=_pub_state, path_id=path_id, start=start, size=size, fields=[], highlight_fields=highlight_fields, viewable_only=viewable_only, default_operator='AND', sort=sort, facets=facets)
         items = []
         for hit in result['hits']['hits']:
             _id = ObjectId(hit['_id'])
@@ -149,8 +338,73 @@ class Root(Folder):
             items = items,
             total = result['hits']['total'],
             took = result['took'],
+            facets = self.get_search_facets(result),
+        )
+
+    def search_page(self, sort, size=20, token=None, **kwargs):
+        """ Like search(), but for results sorted by fields (sort is a pyes-style
+        sort string that doesn't use "_score"), paged with cursor tokens instead
+        of start offsets (see cms.searchafter), so that deep pages are as fast
+        as the first one.
+        Other keyword arguments are passed to search_raw().
+        Returns a dictionary with the keys "items", "total", "took", "facets",
+        "has_prev", "has_next", "prev_token" and "next_token" (see keysetutil.get_page()).
+        The total is the number of hits when the first page was fetched.
+        """
+        full_sort = searchafter.get_full_sort(searchafter.parse_sort(sort))
+        direction = keysetutil.NEXT
+        values = None
+        decoded = keysetutil.decode_token(token, full_sort)
+        if decoded: (direction, values) = decoded
+        query_sort = full_sort
+        if direction == keysetutil.PREV: query_sort = keysetutil.reverse_sort(full_sort)
+        result = self.search_raw(sort=searchafter.format_sort(query_sort), size=size+1, fields=[], search_after=values, **kwargs)
+        total = result['hits']['total']
+        if values is not None:
+            # ElasticSearch only counted the hits after the cursor;
+            # the total of the first page is passed along in the tokens.
+            token_total = keysetutil.get_token_total(token)
+            if token_total is not None: total = token_total
+        hits = result['hits']['hits']
+        has_more = len(hits) > size
+        hits = hits[:size]
+        if direction == keysetutil.PREV:
+            hits.reverse()
+            (has_prev, has_next) = (has_more, True)
+        else:
+            (has_prev, has_next) = (values is not None, has_more)
+        items = []
+        for hit in hits:
+            obj = self.get_content_by_id(ObjectId(hit['_id']))
+            if obj:
+                items.append(dict(object=obj, highlight=hit.get('highlight')))
+        prev_token = next_token = None
+        if hits and has_prev: prev_token = keysetutil.encode_token(full_sort, hits[0]['sort'], keysetutil.PREV, total)
+        if hits and has_next: next_token = keysetutil.encode_token(full_sort, hits[-1]['sort'], keysetutil.NEXT, total)
+        return dict(
+            items = items,
+            total = total,
+            took = result['took'],
+            facets = self.get_search_facets(result),
+            has_prev = bool(prev_token),
+            has_next = bool(next_token),
+            prev_token = prev_token,
+            next_token = next_token,
         )
 
+    def iter_search_hits(self, batch_size=500, scroll='5m', **kwargs):
+        """ Generate all the hits of a search, fetching them in batches
+        with a scroll cursor (so they're never all in memory).
+        Keyword arguments are passed to search_raw().
+        """
+        result = self.search_raw(size=batch_size, scroll=scroll, **kwargs)
+        while True:
+            hits = result['hits']['hits']
+            if not hits: break
+            for hit in hits:
+                yield hit
+            result = self.search_raw(scroll=scroll, scroll_id=result['_scroll_id'])
+
     def __getitem__(self, name):
         if name == 'users':
             users = UserCollection(self.request)
@@ -203,4 +457,7 @@ class Root(Folder):
 
     def _remove_local_roles_for_principal(self, principal):
         self._get_collection().update({'_local_roles.%s' % principal: {"$exists": 1}}, {'$unset': {'_local_roles.%s' % principal: 1}}, multi=True)
+        local_roles_cache.invalidate()
+        # Objects loaded earlier in this request may have stale local roles.
+        get_identity_map(self.request).clear()
 
@@ -0,0 +1,38 @@
+from cms import dateutil
+
+class ContentSummary(object):
+    """ A slim, read-only stand-in for a child object, built from a projected
+    MongoDB document (see Collection.get_child_summaries_and_total()).
+    It's location-aware (has __name__ and __parent__) so it can be passed to
+    request.resource_url(), and any loaded field is available as an attribute.
+    """
+
+    __slots__ = ('request', '_id', '__name__', '__parent__', '_object_type', '_values')
+
+    def __init__(self, request, parent, doc):
+        self.request = request
+        self.__parent__ = parent
+        self.__name__ = doc['__name__']
+        self._id = doc.get('_id')
+        self._object_type = doc.get('_object_type')
+        self._values = doc
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def localize_datetime_attribute(self, name):
+        value = getattr(self, name, None)
+        if value:
+            return dateutil.convert_from_utc(value, dateutil.get_timezone_for_request(self.request))
+        else:
+            return None
+
+    def format_localized_datetime_attribute(self, name, format='%x %X %Z', missing=''):
+        dt = self.localize_datetime_attribute(name)
+        if dt:
+            return dt.strftime(format)
+        else:
+            return missing
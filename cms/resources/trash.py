@@ -1,4 +1,4 @@
-from folder import unindex_recursively
+from folder import unindex_recursively, update_paths_recursively
 from collection import Collection
 import zope.interface
 from interfaces import ITrash
@@ -24,6 +24,8 @@ class Trash(Collection):
 
     _object_type = "trash"
 
+    _use_identity_map = True
+
     def __init__(self, request):
         self.request = request
         self._collection_name = "content"
@@ -55,12 +57,8 @@ class Trash(Collection):
         obj.__parent__ = self
         obj.__name__ = str(obj._id)
         obj.save()  # FIXME: set_modified=False?
+        update_paths_recursively(obj)
         unindex_recursively(obj, include_self=True)
-        # Notify old parent that child was moved (gives ordered folders an opportunity to update their ordered name list).
-        orig_parent._child_removed(orig_name)
-    
-    def _child_removed(self, name):
-        pass # Like I care?  I'm trash!
 
     def dememento_child(self, child):
         child.__name__ = child._memento['orig_name']
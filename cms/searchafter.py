@@ -0,0 +1,60 @@
+""" "Search after" paging of ElasticSearch results sorted by fields.
+
+Paging with start/size makes ElasticSearch collect and sort start+size
+hits on every shard, so deep pages get slower and slower.  When results
+are sorted by fields, the sort values of the last hit of a page can be
+used instead to filter the next page ("values after these"), much like
+keysetutil does for MongoDB listings.  An "_uid" tiebreaker is added to
+the sort so that the order is total.  The cursor tokens are the same as
+keysetutil's.
+
+Caveats: results sorted by relevance (_score) can't be paged this way, and
+documents that have no value for a sort field are left out of pages after
+the first.
+"""
+
+import pyes
+
+TIEBREAKER = '_uid'
+
+def parse_sort(sort):
+    """ Convert a pyes-style sort string (such as "_object_type,_created:desc")
+    into a list of (field, direction) tuples (where direction is 1 or -1).
+    """
+    result = []
+    for item in (sort or '').split(','):
+        item = item.strip()
+        if not item: continue
+        if ':' in item:
+            (field, dir) = item.split(':', 1)
+        else:
+            (field, dir) = (item, 'asc')
+        result.append((field.strip(), dir.strip().lower() == 'desc' and -1 or 1))
+    return result
+
+def format_sort(sort):
+    return ','.join(['%s:%s' % (field, dir == -1 and 'desc' or 'asc') for (field, dir) in sort])
+
+def can_search_after(sort):
+    return bool(sort) and ('_score' not in [x[0] for x in sort])
+
+def get_full_sort(sort):
+    """ Return sort with the tiebreaker appended (in the direction of the last field). """
+    sort = list(sort)
+    if TIEBREAKER not in [x[0] for x in sort]:
+        sort.append((TIEBREAKER, sort and sort[-1][1] or 1))
+    return sort
+
+def get_search_after_filter(sort, values):
+    """ Return a filter for the hits that come after a hit with the
+    given sort values (in the given sort order).
+    """
+    clauses = []
+    for i in range(len(sort)):
+        filters = [pyes.TermFilter(sort[j][0], values[j]) for j in range(i)]
+        (field, dir) = sort[i]
+        filters.append(pyes.RangeFilter(pyes.ESRangeOp(field, dir == -1 and 'lt' or 'gt', values[i])))
+        if len(filters) == 1: clauses.append(filters[0])
+        else: clauses.append(pyes.ANDFilter(filters))
+    if len(clauses) == 1: return clauses[0]
+    return pyes.ORFilter(clauses)
@@ -0,0 +1,109 @@
+""" Caching of ElasticSearch search results.
+
+Root.search_raw() looks up results in a process-wide SearchCache before
+querying ElasticSearch.  Entries are keyed by the normalized search
+parameters (including the effective principals for viewable_only searches)
+and expire after "search_cache_ttl" seconds.
+
+Content.index() and unindex() (and bulk flushes) bump the cache's
+generation, which makes all existing entries stale.  Since ElasticSearch
+only makes changes searchable after its next refresh, results aren't
+cached for "settle" seconds after an invalidation either.
+
+The generation is per process, so a change made by another process
+(another app server, or the recms-index-worker) is only seen once the
+entries expire.  Keep the TTL short.
+"""
+
+import time
+import json
+import hashlib
+import threading
+import collections
+
+# Sequence parameters whose order (and exact values) matter.
+EXACT_PARAMS = ('search_after',)
+
+class SearchCache(object):
+
+    def __init__(self, max_size=1000, ttl=0, settle=1.0):
+        """ A ttl of 0 disables the cache. """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.settle = settle
+        self.generation = 0
+        self._invalidated = 0
+        self._entries = collections.OrderedDict()
+        # Requests are handled in several threads.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_enabled(self):
+        return bool(self.ttl and self.max_size)
+
+    def get_key(self, **kwargs):
+        """ Return a cache key for the given search parameters.
+        Sequences are treated as sets (the search ORs their items) and
+        None/empty values are dropped.  The search_after cursor is the
+        exception: its values are positional and are kept exactly as given.
+        """
+        params = {}
+        for (name, value) in kwargs.items():
+            if (value is None) or (value == '') or (value == []) or (value == ()): continue
+            if name in EXACT_PARAMS:
+                value = [_exact(x) for x in value]
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                value = sorted(set([_normalize(x) for x in value]))
+            else:
+                value = _normalize(value)
+            params[name] = value
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if (entry is None) or (entry[0] != self.generation) or (entry[1] < time.time()):
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Put it back at the end (most recently used).
+            self._entries[key] = entry
+            return entry[2]
+
+    def set(self, key, result, generation=None):
+        """ generation should be the value of self.generation from before the
+        search was run, so that results of a search that raced with an
+        invalidation aren't cached.
+        """
+        now = time.time()
+        with self._lock:
+            if generation is None: generation = self.generation
+            if generation != self.generation: return
+            if now - self._invalidated < self.settle: return
+            self._entries.pop(key, None)
+            self._entries[key] = (generation, now + self.ttl, result)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._invalidated = time.time()
+            self._entries.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self._entries), hits=self.hits, misses=self.misses,
+                    hit_rate=lookups and (float(self.hits) / lookups) or 0.0, generation=self.generation)
+
+def _exact(value):
+    if isinstance(value, (basestring, int, long, float, bool)) or (value is None): return value
+    return str(value)
+
+def _normalize(value):
+    if isinstance(value, basestring): return ' '.join(value.split())
+    if isinstance(value, (int, long, float, bool)): return value
+    return str(value)
+
+search_cache = SearchCache()
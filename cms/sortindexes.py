@@ -0,0 +1,205 @@
+""" Compound MongoDB indexes for sorted child listings.
+
+Unordered folders list their children sorted by the folder's primary and
+secondary sort settings (see Folder.get_default_sort()).  Without an index
+on (__parent__, sort fields...) MongoDB has to load and sort every child
+in memory.  SortIndexManager derives the set of indexes needed from the
+sort settings actually used by folders (and the SORT_CHOICES offered by
+each content type), creates the missing ones, drops the ones it created
+that are no longer needed, and reports listings that aren't indexed.
+
+Indexes created here are named with the MANAGED_PREFIX so that other
+indexes are never dropped.
+"""
+
+import pymongo
+import logging
+log = logging.getLogger(__name__)
+
+MANAGED_PREFIX = 'sort__'
+
+# MongoDB allows at most 64 indexes per collection; leave a few for others.
+MAX_INDEXES = 60
+
+def get_sort_from_settings(sort1_settings, sort2_settings):
+    """ Given a folder's sort1_settings and sort2_settings dictionaries,
+    return a list of mongo sort tuples.
+    """
+    result = []
+    for settings in (sort1_settings, sort2_settings):
+        if settings:
+            field = settings.get('field')
+            if field:
+                if field == '_other':
+                    field = settings.get('other')
+            if field:
+                dir = settings.get('dir', 'asc')
+                if dir == 'desc': dir = -1
+                else: dir = 1
+                result.append((field, dir))
+    return result
+
+def get_index_key(sort):
+    """ Return the index key for listing children in the given sort order
+    (with the _id tiebreaker used by keysetutil).
+    An index can be walked in either direction, so the key is normalized
+    such that the first sort field is ascending.
+    """
+    sort = list(sort)
+    if '_id' not in [x[0] for x in sort]:
+        sort.append(('_id', sort and sort[-1][1] or 1))
+    if sort[0][1] == -1:
+        sort = [(field, -dir) for (field, dir) in sort]
+    return [('__parent__', pymongo.ASCENDING)] + sort
+
+def get_index_name(key):
+    return MANAGED_PREFIX + '_'.join(['%s_%s' % (field, dir) for (field, dir) in key[1:]])
+
+def index_covers_sort(index_key, sort):
+    """ Return True if an index with the given key can be used to list
+    children in the given sort order (in either direction).
+    """
+    index_key = [(field, dir) for (field, dir) in index_key]
+    if (not index_key) or (index_key[0][0] != '__parent__'): return False
+    sort = [x for x in sort if x[0] != '_id']
+    fields = index_key[1:len(sort)+1]
+    if not sort: return True
+    if len(fields) != len(sort): return False
+    if fields == list(sort): return True
+    return fields == [(field, -dir) for (field, dir) in sort]
+
+# Sorts already checked by check_sort_index() in this process.
+_checked_sorts = set()
+
+def check_sort_index(collection, sort):
+    """ Log a warning if no index covers the given child sort order.
+    Indexes aren't built here (that would block the request, and every
+    editor's choice of sort would add another index to the collection);
+    the recms-sort-indexes script reports and creates them.
+    Each sort is only checked once per process.
+    """
+    sort = tuple([tuple(x) for x in sort])
+    if (not sort) or (sort in _checked_sorts): return
+    _checked_sorts.add(sort)
+    keys = [info['key'] for info in collection.index_information().values()]
+    if not [k for k in keys if index_covers_sort(k, sort)]:
+        log.warning("no index for child listings sorted by %s (see recms-sort-indexes)" % (list(sort),))
+
+class SortIndexManager(object):
+
+    def __init__(self, collection, content_types=()):
+        """ collection - the pymongo content collection
+        content_types - content classes; the SORT_CHOICES of each (if any) are indexed too
+        """
+        self.collection = collection
+        self.content_types = content_types
+
+    def get_folder_sorts(self):
+        """ Return a dictionary mapping each sort (as a tuple of sort tuples)
+        used by an unordered folder to a list of paths of folders that use it.
+        """
+        spec = {'_is_ordered': {'$ne': True}, '$or': [{'sort1_settings.field': {'$nin': ['', None]}}, {'sort2_settings.field': {'$nin': ['', None]}}]}
+        result = {}
+        for doc in self.collection.find(spec, fields=['_path', 'sort1_settings', 'sort2_settings']):
+            sort = tuple(get_sort_from_settings(doc.get('sort1_settings'), doc.get('sort2_settings')))
+            if sort: result.setdefault(sort, []).append(doc.get('_path', doc['_id']))
+        return result
+
+    def get_choice_sorts(self):
+        """ Return a list of single-field sorts for the SORT_CHOICES of the content types. """
+        result = []
+        for cls in self.content_types:
+            for (field, title) in getattr(cls, 'SORT_CHOICES', ()):
+                if field and (field != '_other') and ((field, 1) not in result):
+                    result.append((field, 1))
+        return [[x] for x in result]
+
+    def get_existing_indexes(self):
+        """ Return a dictionary mapping index names to index keys. """
+        result = {}
+        for (name, info) in self.collection.index_information().items():
+            result[name] = info['key']
+        return result
+
+    def get_wanted_indexes(self, include_folders=True):
+        """ Return a dictionary mapping index names to index keys for all
+        the sorts that need an index.
+        """
+        sorts = self.get_choice_sorts()
+        if include_folders: sorts.extend(self.get_folder_sorts().keys())
+        result = {}
+        for sort in sorts:
+            key = get_index_key(sort)
+            result[get_index_name(key)] = key
+        return result
+
+    def sync(self, drop=True, include_folders=True):
+        """ Create the wanted indexes that don't already exist (unless an
+        unmanaged index already covers the sort).  If drop is True, also drop
+        managed indexes that are no longer wanted.
+        Returns a dictionary with lists of the "created" and "dropped" index names.
+        """
+        existing = self.get_existing_indexes()
+        wanted = self.get_wanted_indexes(include_folders=include_folders)
+        created = []
+        dropped = []
+        unmanaged_keys = [key for (name, key) in existing.items() if not name.startswith(MANAGED_PREFIX)]
+        count = len(existing)
+        for (name, key) in wanted.items():
+            if name in existing: continue
+            sort = key[1:]
+            if [k for k in unmanaged_keys if index_covers_sort(k, sort)]: continue
+            if count >= MAX_INDEXES:
+                log.warning("not creating index %s (the collection has %s indexes)" % (name, count))
+                continue
+            count += 1
+            log.info("creating index %s" % name)
+            self.collection.ensure_index(key, name=name)
+            created.append(name)
+        if drop:
+            for name in existing.keys():
+                if name.startswith(MANAGED_PREFIX) and (name not in wanted):
+                    log.info("dropping index %s" % name)
+                    self.collection.drop_index(name)
+                    dropped.append(name)
+        return dict(created=created, dropped=dropped)
+
+    def get_unindexed_listings(self):
+        """ Return a list of (sort, paths) tuples for folder sorts
+        that no existing index covers.
+        """
+        keys = self.get_existing_indexes().values()
+        result = []
+        for (sort, paths) in self.get_folder_sorts().items():
+            if not [k for k in keys if index_covers_sort(k, sort)]:
+                result.append((list(sort), paths))
+        return result
+
+def main(argv=None):
+    """ Console script to report on and synchronize the sort indexes.
+    Usage: recms-sort-indexes config_uri [--sync] [--no-drop]
+    """
+    import sys
+    from pyramid.paster import bootstrap
+    from cms.resources import Root
+    if argv is None: argv = sys.argv
+    if len(argv) < 2:
+        print main.__doc__
+        return 2
+    env = bootstrap(argv[1])
+    try:
+        settings = env['registry'].settings
+        collection = settings['db_conn'][settings['db_name']]['content']
+        manager = SortIndexManager(collection, Root._content_type_factories.values())
+        if '--sync' in argv[2:]:
+            result = manager.sync(drop='--no-drop' not in argv[2:])
+            print "Created: %s" % (', '.join(result['created']) or 'none')
+            print "Dropped: %s" % (', '.join(result['dropped']) or 'none')
+        unindexed = manager.get_unindexed_listings()
+        if not unindexed:
+            print "All folder listings are indexed."
+        for (sort, paths) in unindexed:
+            print "Not indexed: %s (%s folders, e.g. %s)" % (sort, len(paths), ', '.join([str(x) for x in paths[:3]]))
+    finally:
+        env['closer']()
+    return 0
@@ -59,6 +59,1573 @@ class RootTests(unittest.TestCase):
         self.assertEqual(instance.__name__, "")
         self.assertEqual(instance.__parent__, None)
 
+class IdentityMapTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from cms.identitymap import IdentityMap
+        return IdentityMap()
+
+    def _makeObject(self, _id):
+        class Dummy(object): pass
+        obj = Dummy()
+        obj._id = _id
+        return obj
+
+    def test_get_counts_hits_and_misses(self):
+        imap = self._makeOne()
+        obj = self._makeObject(1)
+        self.assertEqual(imap.get(1), None)
+        imap.add(obj, 0, "foo")
+        self.assertTrue(imap.get(1) is obj)
+        self.assertTrue(imap.get_by_name(0, "foo") is obj)
+        self.assertEqual(imap.get_stats(), dict(hits=2, misses=1, size=1))
+
+    def test_rename_drops_old_name(self):
+        imap = self._makeOne()
+        obj = self._makeObject(1)
+        imap.add(obj, 0, "foo")
+        imap.add(obj, 0, "bar")
+        self.assertEqual(imap.get_by_name(0, "foo"), None)
+        self.assertTrue(imap.get_by_name(0, "bar") is obj)
+
+    def test_discard(self):
+        imap = self._makeOne()
+        imap.add(self._makeObject(1), 0, "foo")
+        imap.discard(1)
+        self.assertFalse(1 in imap)
+        self.assertEqual(imap.get_by_name(0, "foo"), None)
+
+class MergedLocalRolesCacheTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from cms.authorization import MergedLocalRolesCache
+        return MergedLocalRolesCache()
+
+    def test_merge_and_reuse(self):
+        cache = self._makeOne()
+        root = cache.get_merged_local_roles(1, {}, None)
+        parent = cache.get_merged_local_roles(2, {'group:news': 'group:publisher'}, root)
+        child = cache.get_merged_local_roles(3, {'group:news': 'group:submitter'}, parent)
+        self.assertEqual(parent, {'group:news': set(['group:publisher'])})
+        self.assertEqual(child, {'group:news': set(['group:publisher', 'group:submitter'])})
+        self.assertTrue(cache.get_merged_local_roles(3, {'group:news': 'group:submitter'}, parent) is child)
+        self.assertEqual(cache.get_inverted_local_roles(3, child), {'group:publisher': set(['group:news']), 'group:submitter': set(['group:news'])})
+
+    def test_invalidate(self):
+        cache = self._makeOne()
+        merged = cache.get_merged_local_roles(1, {}, None)
+        cache.invalidate()
+        self.assertFalse(cache.get_merged_local_roles(1, {}, None) is merged)
+
+    def test_changed_local_roles_not_reused(self):
+        cache = self._makeOne()
+        cache.get_merged_local_roles(1, {'group:news': 'group:publisher'}, None)
+        self.assertEqual(cache.get_merged_local_roles(1, {}, None), {})
+
+class ACLAuthorizationPolicyWithLocalRolesTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from cms.authorization import ACLAuthorizationPolicyWithLocalRoles
+        return ACLAuthorizationPolicyWithLocalRoles()
+
+    def _makeTree(self):
+        from pyramid.security import Allow, Deny, Everyone
+        class Dummy(object): pass
+        root = Dummy()
+        root.__parent__ = None
+        root.__acl__ = [(Allow, 'group:editor', ('edit', 'view')), (Allow, Everyone, 'view')]
+        children = []
+        for acl in ([], [(Deny, Everyone, 'view')]):
+            child = Dummy()
+            child.__parent__ = root
+            if acl: child.__acl__ = acl
+            children.append(child)
+        return root, children
+
+    def test_permits_many_matches_permits(self):
+        policy = self._makeOne()
+        (root, children) = self._makeTree()
+        for permission in ('view', 'edit'):
+            for principals in (['system.Everyone'], ['system.Everyone', 'group:editor']):
+                expected = [bool(policy.permits(c, principals, permission)) for c in children]
+                self.assertEqual([bool(x) for x in policy.permits_many(children, principals, permission)], expected)
+
+    def test_permitted_permissions(self):
+        policy = self._makeOne()
+        (root, children) = self._makeTree()
+        self.assertEqual(policy.permitted_permissions(children[0], ['system.Everyone'], ('view', 'edit')), set(['view']))
+        self.assertEqual(policy.permitted_permissions(children[1], ['system.Everyone'], ('view', 'edit')), set())
+
+class PrincipalBucketsTests(unittest.TestCase):
+
+    def test_get_principal_buckets(self):
+        from cms.authorization import get_principal_buckets
+        self.assertEqual(get_principal_buckets(['system.Everyone']), [['system.Everyone']])
+        principals = ['bob', 'group:news', 'system.Authenticated', 'group:editor', 'system.Everyone']
+        self.assertEqual(get_principal_buckets(principals),
+            [['system.Authenticated', 'system.Everyone'], ['group:editor', 'group:news'], ['bob']])
+
+class ContentSummaryTests(unittest.TestCase):
+
+    def test_attributes(self):
+        from cms.resources.summary import ContentSummary
+        request = testing.DummyRequest()
+        parent = object()
+        summary = ContentSummary(request, parent, dict(_id=1, __name__='foo', _object_type='article', title='Foo'))
+        self.assertEqual(summary.__name__, 'foo')
+        self.assertTrue(summary.__parent__ is parent)
+        self.assertEqual(summary.title, 'Foo')
+        self.assertFalse(hasattr(summary, 'description'))
+        self.assertEqual(summary.format_localized_datetime_attribute('_created', missing='none'), 'none')
+
+class DummyCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.counted = False
+    def count(self):
+        self.counted = True
+        return len(self.docs)
+    def __iter__(self):
+        return iter(self.docs)
+
+class DummyMongoCollection(object):
+    """ An in-memory stand-in for a pymongo collection that supports just
+    the queries and updates used by the content classes.
+    """
+    def __init__(self):
+        self.docs = {}
+        self.finds = []
+        self.updates = []
+        self.bulk_executes = 0
+    def _get(self, doc, field):
+        value = doc
+        for part in field.split('.'):
+            if not isinstance(value, dict): return None
+            value = value.get(part)
+        return value
+    def _matches(self, doc, spec):
+        for (key, cond) in (spec or {}).items():
+            value = self._get(doc, key)
+            values = [value]
+            if isinstance(value, list): values = value + [value]
+            if isinstance(cond, dict) and cond and cond.keys()[0].startswith('$'):
+                for (op, arg) in cond.items():
+                    if op == '$in': ok = [x for x in values if x in arg]
+                    elif op == '$ne': ok = arg not in values
+                    elif op == '$exists': ok = (value is not None) == bool(arg)
+                    elif op == '$gt': ok = (value is not None) and value > arg
+                    elif op == '$lt': ok = (value is not None) and value < arg
+                    else: raise ValueError(op)
+                    if not ok: return False
+            elif cond not in values:
+                return False
+        return True
+    def find(self, spec=None, fields=None, sort=None, skip=0, limit=0):
+        import copy
+        self.finds.append(spec)
+        docs = [copy.deepcopy(doc) for doc in self.docs.values() if self._matches(doc, spec)]
+        docs.sort(key=lambda doc: doc['_id'])
+        for (field, dir) in reversed(sort or []):
+            docs.sort(key=lambda doc: self._get(doc, field), reverse=(dir == -1))
+        docs = docs[skip:]
+        if limit: docs = docs[:limit]
+        return DummyCursor(docs)
+    def find_one(self, spec=None):
+        for doc in self.find(spec, limit=1):
+            return doc
+        return None
+    def save(self, doc, safe=False):
+        import copy
+        from bson.objectid import ObjectId
+        if doc.get('_id') is None: doc['_id'] = ObjectId()
+        self.docs[doc['_id']] = copy.deepcopy(doc)
+        return doc['_id']
+    def update(self, spec, document, upsert=False, multi=False, safe=False):
+        import copy
+        self.updates.append((spec, document, multi))
+        docs = [doc for doc in self.docs.values() if self._matches(doc, spec)]
+        if upsert and not docs:
+            doc = dict([(key, value) for (key, value) in spec.items() if not isinstance(value, dict)])
+            self.save(doc)
+            docs = [self.docs[doc['_id']]]
+        if not multi: docs = docs[:1]
+        for doc in docs:
+            for (op, fields) in document.items():
+                for (name, value) in fields.items():
+                    if op == '$set': doc[name] = copy.deepcopy(value)
+                    elif op == '$unset': doc.pop(name, None)
+                    elif op == '$inc': doc[name] = doc.get(name, 0) + value
+                    else: raise ValueError(op)
+    def remove(self, spec, safe=False):
+        for doc in self.docs.values():
+            if self._matches(doc, spec): del self.docs[doc['_id']]
+    def initialize_unordered_bulk_op(self):
+        collection = self
+        ops = []
+        class Bulk(object):
+            def find(self, spec):
+                class Op(object):
+                    def update_one(self, document):
+                        ops.append((spec, document))
+                return Op()
+            def execute(self):
+                collection.bulk_executes += 1
+                for (spec, document) in ops:
+                    collection.update(spec, document)
+        return Bulk()
+
+class DummyMongoDB(dict):
+    def __missing__(self, name):
+        collection = self[name] = DummyMongoCollection()
+        return collection
+
+def _makeContentRequest(db):
+    """ Return a request whose settings point at db (a DummyMongoDB). """
+    request = testing.DummyRequest()
+    request.registry.settings = dict(db_conn={'cms': db}, db_name='cms', es_async_indexing=True,
+                                     es_conn=DummyESConnection(), es_name='test')
+    class DummyGridFS(object): pass
+    request._grid_fs = DummyGridFS()
+    request._grid_fs._GridFS__files = db['fs.files']
+    return request
+
+def _makeContentRoot(request, _id):
+    root = _makeOneRoot(request)
+    root._id = _id
+    return root
+
+class GetBatchTests(unittest.TestCase):
+
+    def test_without_count(self):
+        from cms.dbutil import fetch_limit, get_batch
+        self.assertEqual(fetch_limit(10, False), 11)
+        cursor = DummyCursor(range(11))
+        result = get_batch(cursor, 0, 10, count=False)
+        self.assertEqual(result, dict(total=None, items=range(10), has_more=True))
+        self.assertFalse(cursor.counted)
+        result = get_batch(DummyCursor(range(3)), 20, 10, count=False)
+        self.assertEqual(result, dict(total=None, items=range(3), has_more=False))
+
+    def test_with_count(self):
+        from cms.dbutil import fetch_limit, get_batch
+        self.assertEqual(fetch_limit(10, True), 10)
+        result = get_batch(DummyCursor(range(5)), 0, 5, construct=str)
+        self.assertEqual(result, dict(total=5, items=['0', '1', '2', '3', '4'], has_more=False))
+
+class KeysetUtilTests(unittest.TestCase):
+
+    def test_full_sort(self):
+        from cms.keysetutil import get_full_sort
+        self.assertEqual(get_full_sort(None), [('_id', 1)])
+        self.assertEqual(get_full_sort([('time', -1)]), [('time', -1), ('_id', -1)])
+        self.assertEqual(get_full_sort([('_id', -1)]), [('_id', -1)])
+
+    def test_keyset_spec(self):
+        from cms.keysetutil import get_keyset_spec
+        spec = get_keyset_spec([('title', 1), ('_id', 1)], ['foo', 5])
+        self.assertEqual(spec, {'$or': [{'title': {'$gt': 'foo'}}, {'title': 'foo', '_id': {'$gt': 5}}]})
+        # Missing values sort first, so they come last when descending.
+        spec = get_keyset_spec([('title', -1), ('_id', -1)], ['foo', 5])
+        self.assertEqual(spec, {'$or': [{'title': {'$lt': 'foo'}}, {'title': None}, {'title': 'foo', '_id': {'$lt': 5}}, {'title': 'foo', '_id': None}]})
+        spec = get_keyset_spec([('title', 1), ('_id', 1)], [None, 5])
+        self.assertEqual(spec, {'$or': [{'title': {'$ne': None}}, {'title': None, '_id': {'$gt': 5}}]})
+
+    def test_token(self):
+        from cms.keysetutil import encode_token, decode_token, NEXT
+        import datetime
+        sort = [('_created', -1), ('_id', -1)]
+        when = datetime.datetime(2012, 3, 4, 5, 6, 7)
+        token = encode_token(sort, [when, 'abc'], NEXT)
+        (direction, values) = decode_token(token, sort)
+        self.assertEqual(direction, NEXT)
+        self.assertEqual(values[0].replace(tzinfo=None), when)
+        self.assertEqual(values[1], 'abc')
+        self.assertEqual(decode_token(token, [('_modified', -1), ('_id', -1)]), None)
+        self.assertEqual(decode_token('garbage', sort), None)
+
+class SortIndexesTests(unittest.TestCase):
+
+    def test_sort_from_settings(self):
+        from cms.sortindexes import get_sort_from_settings
+        self.assertEqual(get_sort_from_settings(dict(field='_created', dir='desc'), dict(field='_other', other='dateline')), [('_created', -1), ('dateline', 1)])
+        self.assertEqual(get_sort_from_settings(dict(field=''), None), [])
+
+    def test_index_key(self):
+        from cms.sortindexes import get_index_key, get_index_name
+        key = get_index_key([('_created', -1), ('sortable_title', 1)])
+        self.assertEqual(key, [('__parent__', 1), ('_created', 1), ('sortable_title', -1), ('_id', -1)])
+        self.assertEqual(get_index_name(key), 'sort___created_1_sortable_title_-1__id_-1')
+
+    def test_index_covers_sort(self):
+        from cms.sortindexes import index_covers_sort
+        key = [('__parent__', 1), ('_created', 1), ('_id', 1)]
+        self.assertTrue(index_covers_sort(key, [('_created', -1)]))
+        self.assertTrue(index_covers_sort(key, [('_created', 1), ('_id', 1)]))
+        self.assertFalse(index_covers_sort(key, [('_modified', 1)]))
+        self.assertFalse(index_covers_sort(key, [('_created', 1), ('title', 1)]))
+        self.assertFalse(index_covers_sort([('_created', 1)], [('_created', 1)]))
+
+    def test_check_sort_index(self):
+        from cms import sortindexes
+        class DummyCollection(object):
+            calls = 0
+            def index_information(self):
+                self.calls += 1
+                return {'_id_': dict(key=[('_id', 1)]), 'sort___created_1__id_1': dict(key=[('__parent__', 1), ('_created', 1), ('_id', 1)])}
+            def ensure_index(self, *args, **kwargs):
+                raise AssertionError("indexes must not be built on save")
+        collection = DummyCollection()
+        sortindexes._checked_sorts.clear()
+        sortindexes.check_sort_index(collection, [('_created', -1)])
+        sortindexes.check_sort_index(collection, [('_created', -1)])
+        sortindexes.check_sort_index(collection, [('title', 1)])
+        self.assertEqual(collection.calls, 2)
+        sortindexes._checked_sorts.clear()
+
+    def test_sync_index_limit(self):
+        from cms import sortindexes
+        class DummyCollection(object):
+            created = []
+            def find(self, *args, **kwargs):
+                return [dict(_id=i, sort1_settings=dict(field='f%s' % i)) for i in range(5)]
+            def index_information(self):
+                return dict([('i%s' % i, dict(key=[('x%s' % i, 1)])) for i in range(sortindexes.MAX_INDEXES - 2)])
+            def ensure_index(self, key, name=None):
+                self.created.append(name)
+        collection = DummyCollection()
+        result = sortindexes.SortIndexManager(collection).sync(drop=False)
+        self.assertEqual(len(result['created']), 2)
+        self.assertEqual(collection.created, result['created'])
+
+class OrderUtilTests(unittest.TestCase):
+
+    def test_key_between(self):
+        from cms.orderutil import key_between
+        first = key_between(None, None)
+        after = key_between(first, None)
+        before = key_between(None, first)
+        self.assertTrue(before < first < after)
+        middle = key_between(first, after)
+        self.assertTrue(first < middle < after)
+        self.assertRaises(ValueError, key_between, after, first)
+
+    def test_keys_stay_short(self):
+        from cms.orderutil import key_between
+        key = None
+        for x in range(5000):
+            new_key = key_between(key, None)
+            self.assertTrue((key is None) or (key < new_key))
+            key = new_key
+        self.assertTrue(len(key) <= 4)
+
+    def test_keys_between(self):
+        from cms.orderutil import keys_between
+        keys = keys_between('a1', 'a2', 20)
+        self.assertEqual(len(set(keys)), 20)
+        self.assertEqual(keys, sorted(keys))
+        self.assertTrue('a1' < keys[0] and keys[-1] < 'a2')
+
+class DummyESConnection(object):
+    def __init__(self, fail_ids=(), sources=None):
+        import json
+        self.encoder = json.JSONEncoder
+        self.fail_ids = fail_ids
+        self.sources = sources or {}
+        self.requests = []
+    def _send_request(self, method, path, body=None, params={}):
+        import json
+        if path == '/_mget':
+            docs = []
+            for doc in body['docs']:
+                source = self.sources.get(doc['_id'])
+                if source is None: docs.append(dict(_id=doc['_id'], exists=False))
+                else: docs.append(dict(_id=doc['_id'], _type=doc['_type'], exists=True, _source=dict(source)))
+            return dict(docs=docs)
+        lines = [json.loads(x) for x in body.strip().split('\n')]
+        self.requests.append(lines)
+        items = []
+        for line in lines:
+            for (op, action) in line.items():
+                if op in ('index', 'delete'):
+                    result = dict(_id=action['_id'], ok=True)
+                    if action['_id'] in self.fail_ids: result = dict(_id=action['_id'], error='MapperParsingException')
+                    items.append({op: result})
+        return dict(items=items)
+
+class BulkIndexerTests(unittest.TestCase):
+
+    def _makeOne(self, conn, batch_size=2):
+        from cms.esbulk import BulkIndexer
+        return BulkIndexer(conn, 'test', batch_size=batch_size, flush_interval=60)
+
+    def test_batches(self):
+        conn = DummyESConnection()
+        bulk = self._makeOne(conn)
+        bulk.index('article', 1, dict(title='One'))
+        self.assertEqual(conn.requests, [])
+        bulk.index('article', 2, dict(title='Two'))
+        bulk.delete('article', 3)
+        report = bulk.close()
+        self.assertEqual(len(conn.requests), 2)
+        self.assertEqual(conn.requests[0][0], {'index': {'_index': 'test', '_type': 'article', '_id': '1'}})
+        self.assertEqual(conn.requests[0][1], {'title': 'One'})
+        self.assertEqual(conn.requests[1], [{'delete': {'_index': 'test', '_type': 'article', '_id': '3'}}])
+        self.assertEqual(report, dict(count=3, batches=2, errors=[]))
+
+    def test_errors(self):
+        bulk = self._makeOne(DummyESConnection(fail_ids=('2',)), batch_size=10)
+        bulk.index('article', 1, dict(title='One'))
+        bulk.index('article', 2, dict(title='Two'))
+        report = bulk.close()
+        self.assertEqual(report['errors'], [dict(batch=1, op='index', _id='2', error='MapperParsingException')])
+
+    def test_close_check(self):
+        from cms.esbulk import BulkIndexError
+        bulk = self._makeOne(DummyESConnection(fail_ids=('2',)), batch_size=10)
+        bulk.index('article', 2, dict(title='Two'))
+        self.assertRaises(BulkIndexError, bulk.close, check=True)
+        self.assertEqual(self._makeOne(DummyESConnection()).close(check=True)['errors'], [])
+
+    def test_recursive_helpers_raise(self):
+        from cms.esbulk import BulkIndexError
+        from cms.resources.folder import _with_bulk
+        testing.setUp(settings=dict(es_conn=DummyESConnection(fail_ids=('2',)), es_name='test'))
+        try:
+            class DummyContent(object):
+                request = testing.DummyRequest()
+            def func(bulk):
+                bulk.index('article', 1, dict(title='One'))
+                bulk.index('article', 2, dict(title='Two'))
+            self.assertRaises(BulkIndexError, _with_bulk, DummyContent(), None, func)
+        finally:
+            testing.tearDown()
+
+    def test_update(self):
+        conn = DummyESConnection(sources={'1': dict(title='One', _view=['system.Everyone'])})
+        bulk = self._makeOne(conn, batch_size=10)
+        bulk.update('article', 1, dict(_view=['group:editor']))
+        bulk.update('article', 2, dict(_view=['group:editor']))
+        report = bulk.close()
+        # Updates are sent as index actions of the merged source.
+        self.assertEqual(conn.requests[0], [{'index': dict(_index='test', _type='article', _id='1')}, dict(title='One', _view=['group:editor'])])
+        self.assertEqual(report['errors'], [dict(batch=1, op='update', _id='2', error='DocumentMissingException')])
+
+    def test_update_missing_document(self):
+        conn = DummyESConnection()
+        bulk = self._makeOne(conn, batch_size=10)
+        bulk.update('article', 1, dict(_view=['group:editor']), lambda: dict(title='One', _view=['group:editor']))
+        report = bulk.close()
+        # The full document is indexed instead.
+        self.assertEqual(conn.requests[0], [{'index': dict(_index='test', _type='article', _id='1')}, dict(title='One', _view=['group:editor'])])
+        self.assertEqual(report['errors'], [])
+
+    def test_update_buffered_document(self):
+        conn = DummyESConnection()
+        bulk = self._makeOne(conn, batch_size=10)
+        bulk.index('article', 1, dict(title='One', _view=['system.Everyone']))
+        bulk.update('article', 1, dict(_view=['group:editor']))
+        bulk.close()
+        self.assertEqual(conn.requests[0][1], dict(title='One', _view=['group:editor']))
+
+class DummyIndexQueue(object):
+    def __init__(self, records):
+        self.records = records
+        self.finished = []
+        self.retried = []
+    def get_batch(self, size):
+        return self.records[:size]
+    def done(self, record):
+        self.finished.append(record['_id'])
+    def retry(self, record, error):
+        self.retried.append(record['_id'])
+
+class IndexQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = DummyESConnection(fail_ids=('2',))
+        self.config = testing.setUp(settings=dict(es_conn=self.conn, es_name='test'))
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_process_batch(self):
+        from cms.indexqueue import process_batch, INDEX, UNINDEX
+        class DummyContent(object):
+            def __init__(self, _id): self._id = _id
+            def in_trash(self): return False
+            def _get_es_doctype(self): return 'article'
+            def _get_es_document(self): return dict(title=str(self._id))
+        class DummyRoot(object):
+            request = testing.DummyRequest()
+            def get_content_by_id(self, _id):
+                if _id != 3: return DummyContent(_id)
+        queue = DummyIndexQueue([dict(_id=1, op=INDEX, doctype='article'), dict(_id=2, op=INDEX, doctype='article'), dict(_id=3, op=INDEX, doctype='article'), dict(_id=4, op=UNINDEX, doctype='article')])
+        self.assertEqual(process_batch(queue, DummyRoot(), 10), 4)
+        self.assertEqual(len(self.conn.requests), 1)
+        # Content that no longer exists is unindexed.
+        self.assertEqual([x.keys()[0] for x in self.conn.requests[0] if x.keys()[0] in ('index', 'delete')], ['index', 'index', 'delete', 'delete'])
+        self.assertEqual(queue.finished, [1, 3, 4])
+        self.assertEqual(queue.retried, [2])
+
+    def test_process_batch_bad_record(self):
+        from cms.indexqueue import process_batch, INDEX
+        class DummyContent(object):
+            def __init__(self, _id): self._id = _id
+            def in_trash(self): return False
+            def _get_es_doctype(self): return 'article'
+            def _get_es_document(self):
+                if self._id == 5: raise ValueError("bad document")
+                return dict(title=str(self._id))
+        class DummyRoot(object):
+            request = testing.DummyRequest()
+            def get_content_by_id(self, _id):
+                if _id == 6: raise KeyError(_id)
+                return DummyContent(_id)
+        queue = DummyIndexQueue([dict(_id=x, op=INDEX, doctype='article') for x in (1, 5, 6, 7)])
+        self.assertEqual(process_batch(queue, DummyRoot(), 10), 4)
+        # The rest of the batch is still sent.
+        self.assertEqual([x['index']['_id'] for x in self.conn.requests[0] if 'index' in x], ['1', '7'])
+        self.assertEqual(queue.finished, [1, 7])
+        self.assertEqual(queue.retried, [5, 6])
+
+class ReindexTests(unittest.TestCase):
+
+    def test_get_new_index_name(self):
+        import datetime
+        from cms.reindex import get_new_index_name
+        self.assertEqual(get_new_index_name('cms', datetime.datetime(2012, 3, 4, 5, 6, 7)), 'cms_20120304050607')
+
+    def test_get_alias_commands(self):
+        from cms.reindex import get_alias_commands
+        # First run: es_name is a real index.
+        self.assertEqual(get_alias_commands(dict(cms=dict(num_docs=5)), 'cms', 'cms_2'), ([('add', 'cms_2', 'cms')], 'cms'))
+        indices = dict(cms_1=dict(num_docs=5), cms=dict(num_docs=5, alias_for=['cms_1']))
+        self.assertEqual(get_alias_commands(indices, 'cms', 'cms_2'), ([('remove', 'cms_1', 'cms'), ('add', 'cms_2', 'cms')], None))
+        self.assertEqual(get_alias_commands({}, 'cms', 'cms_2'), ([('add', 'cms_2', 'cms')], None))
+
+    def test_iter_id_chunks(self):
+        from cms.reindex import iter_id_chunks
+        class DummyCollection(object):
+            def find(self, spec, fields=None, sort=None):
+                return [dict(_id=x) for x in range(5)]
+        self.assertEqual(list(iter_id_chunks(DummyCollection(), {}, 2)), [[0, 1], [2, 3], [4]])
+
+    def test_get_worker_settings(self):
+        from cms.reindex import get_worker_settings
+        settings = dict(db_conn=object(), es_conn=object(), db_uri=['localhost'], es_name='cms')
+        self.assertEqual(get_worker_settings(settings), dict(db_uri=['localhost'], es_name='cms'))
+
+    def _makeTree(self):
+        from bson.objectid import ObjectId
+        from cms.resources import Folder, Article
+        db = DummyMongoDB()
+        root = _makeContentRoot(_makeContentRequest(db), ObjectId())
+        root.add_child('f', Folder(root.request, title='F', description=''))
+        root['f'].add_child('a', Article(root.request, title='A', description='', body=''))
+        root['f'].add_child('b', Article(root.request, title='B', description='', body=''))
+        return (db, root)
+
+    def test_record_change(self):
+        from cms import reindex
+        (db, root) = self._makeTree()
+        self.assertEqual(db['reindex_changes'].docs, {})
+        saved = reindex.RUNNING_CHECK_INTERVAL
+        reindex.RUNNING_CHECK_INTERVAL = 0
+        try:
+            reindex.Checkpoints(db['reindex_checkpoints']).start('test', 'test_1')
+            a = root['f']['a']
+            a.save()
+            # Partial updates of the security fields are recorded too.
+            a._view = ['group:editor']
+            a.update_security_fields()
+            root['f'].delete_child('b')
+        finally:
+            reindex.RUNNING_CHECK_INTERVAL = saved
+            reindex._running.update(checked=0)
+        changes = db['reindex_changes'].docs
+        self.assertEqual(sorted([(x['doctype'], x['version']) for x in changes.values()]), [('article', 1), ('article', 2)])
+        self.assertTrue(a._id in changes)
+
+    def test_replay_changes(self):
+        from bson.objectid import ObjectId
+        from cms.esbulk import BulkIndexer
+        from cms.reindex import replay_changes
+        (db, root) = self._makeTree()
+        a = root['f']['a']
+        root['trash'].move_child(root['f']['b'])
+        changes = db['reindex_changes']
+        missing_id = ObjectId()
+        for (_id, version) in ((a._id, 1), (self._getId(db, 'B'), 3), (missing_id, 1)):
+            changes.save(dict(_id=_id, doctype='article', version=version))
+        from pyes.es import ESJsonEncoder
+        conn = DummyESConnection()
+        # The documents have dates.
+        conn.encoder = ESJsonEncoder
+        bulk = BulkIndexer(conn, 'test_1', batch_size=None, flush_interval=None)
+        self.assertEqual(replay_changes(root, changes, bulk), 3)
+        actions = dict([(action.values()[0]['_id'], action.keys()[0]) for action in conn.requests[0] if action.keys()[0] in ('index', 'delete')])
+        self.assertEqual(actions, {str(a._id): 'index', str(self._getId(db, 'B')): 'delete', str(missing_id): 'delete'})
+        self.assertEqual(changes.docs, {})
+
+    def _reindex(self, fail_titles=()):
+        from pyes.es import ESJsonEncoder
+        from cms import reindex
+        (db, root) = self._makeTree()
+        calls = []
+        class DummyConn(DummyESConnection):
+            def __getattr__(self, name):
+                if name not in ('create_index', 'put_mapping', 'update_settings', 'refresh', 'change_aliases', 'delete_index'):
+                    raise AttributeError(name)
+                return lambda *args: calls.append(name)
+            def get_indices(self, include_aliases=False):
+                return dict(test_0=dict(num_docs=3), test=dict(num_docs=3, alias_for=['test_0']))
+        conn = DummyConn(fail_ids=[str(self._getId(db, title)) for title in fail_titles])
+        conn.encoder = ESJsonEncoder
+        root.request.registry.settings.update(es_conn=conn)
+        env = dict(registry=root.request.registry, request=root.request, root=root)
+        saved = reindex.RUNNING_CHECK_INTERVAL
+        reindex.RUNNING_CHECK_INTERVAL = 0
+        try:
+            try:
+                report = reindex.reindex(env, processes=1, delete_old=True)
+            except reindex.BulkIndexError, e:
+                report = e
+        finally:
+            reindex.RUNNING_CHECK_INTERVAL = saved
+            reindex._running.update(checked=0)
+        return (db, calls, report)
+
+    def test_reindex(self):
+        (db, calls, report) = self._reindex()
+        self.assertEqual(report['count'], 3)
+        self.assertEqual(report['errors'], [])
+        self.assertTrue('change_aliases' in calls)
+        self.assertTrue('delete_index' in calls)
+        self.assertEqual(db['reindex_checkpoints'].docs, {})
+
+    def test_reindex_errors_keep_the_old_index(self):
+        from cms.esbulk import BulkIndexError
+        (db, calls, error) = self._reindex(fail_titles=['A'])
+        self.assertTrue(isinstance(error, BulkIndexError))
+        self.assertEqual([x['_id'] for x in error.report['errors']], [str(self._getId(db, 'A'))])
+        self.assertFalse('change_aliases' in calls)
+        self.assertFalse('delete_index' in calls)
+        # The checkpoint is kept, and the failed document will be retried.
+        self.assertEqual(db['reindex_checkpoints'].docs.keys(), ['test'])
+        self.assertEqual(db['reindex_changes'].docs.keys(), [self._getId(db, 'A')])
+
+    def _getId(self, db, title):
+        return [x['_id'] for x in db['content'].docs.values() if x['title'] == title][0]
+
+class HTMLTextCacheTests(unittest.TestCase):
+
+    def _makeOne(self, max_size=2):
+        from cms.htmlutil import HTMLTextCache
+        return HTMLTextCache(max_size)
+
+    def test_html_to_text(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.html_to_text('<p>One</p>', 0), 'One')
+        self.assertEqual(cache.html_to_text('<p>One</p>', 0), 'One')
+        self.assertEqual(cache.get_stats(), dict(size=1, hits=1, misses=1))
+        # The key depends on show_link_urls.
+        self.assertNotEqual(cache.get_key('<p>One</p>', 0), cache.get_key('<p>One</p>', 1))
+
+    def test_lru(self):
+        cache = self._makeOne()
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+
+def _htmllib_html_to_text(html, show_link_urls=1):
+    # The original htmllib-based converter (before htmlutil.html_to_text()
+    # was rewritten to use a regular expression), for comparison.
+    import htmllib, formatter, cStringIO, htmlentitydefs, re
+    class Parser(htmllib.HTMLParser):
+        def __init__(self, formatter):
+            htmllib.HTMLParser.__init__(self, formatter)
+            self.last_href = None
+            self.skip_flag = 0
+        def handle_starttag(self, tag, method, attrs):
+            if tag in ('head', 'script'): self.skip_flag += 1
+            if self.skip_flag: return
+            if tag == 'a':
+                self.last_href = dict(attrs).get('href')
+            if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p'): self.formatter.add_literal_data("\n\n")
+            elif tag == 'br': self.formatter.add_literal_data("\n")
+            elif tag == 'li': self.formatter.add_literal_data("\n\n- ")
+        def handle_endtag(self, tag, method):
+            if tag in ('head', 'script'):
+                if self.skip_flag: self.skip_flag -= 1
+                return
+            if self.skip_flag: return
+            if show_link_urls and tag == 'a' and self.last_href:
+                self.formatter.add_literal_data(" [%s]" % self.last_href)
+            if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'): self.formatter.add_literal_data("\n\n")
+        def unknown_starttag(self, tag, attrs):
+            return self.handle_starttag(tag, None, attrs)
+        def unknown_endtag(self, tag):
+            return self.handle_endtag(tag, None)
+        def handle_data(self, data):
+            if self.skip_flag: return
+            self.formatter.add_literal_data(data.replace('\xc2\xa0', ' '))
+        def handle_charref(self, ref):
+            self.handle_data(unichr(int(ref)).encode('utf-8'))
+        def handle_entityref(self, ref):
+            match = htmlentitydefs.name2codepoint.get(ref, None)
+            if match: self.handle_charref(match)
+    textout = cStringIO.StringIO()
+    parser = Parser(formatter.AbstractFormatter(formatter.DumbWriter(textout)))
+    # htmllib doesn't handle self-closing tags without a space (such as "<br/>").
+    parser.feed(re.sub(r'(\S)/>', r'\1 />', html))
+    parser.close()
+    return textout.getvalue().strip()
+
+class HTMLToTextTests(unittest.TestCase):
+
+    # (html, text without link urls, text with link urls) as the original htmllib-based converter returned them.
+    SAMPLES = [
+        ('<p>One &amp; two</p><p>Three&nbsp;four</p>', 'One & two\n\nThree four', 'One & two\n\nThree four'),
+        ('<h2>Title</h2>Text<br/>more <a href="http://example.com/?a=1&amp;b=2">link</a>.', 'Title\n\nText\nmore link.', 'Title\n\nText\nmore link [http://example.com/?a=1&b=2].'),
+        ('<ul><li>One</li><li><strong>Two</strong></li></ul>', '- One\n\n- Two', '- One\n\n- Two'),
+        ('<head><title>Skip</title></head><script>var x = "<p>";</script><p>Body &eacute;&#233;&bogus;</p>', 'Body \xc3\xa9\xc3\xa9', 'Body \xc3\xa9\xc3\xa9'),
+        ('<!-- comment --><p class="intro">Caf\xc3\xa9</p>', 'Caf\xc3\xa9', 'Caf\xc3\xa9'),
+    ]
+
+    def _get_lorem_bodies(self):
+        import os
+        path = os.path.join(os.path.dirname(__file__), '..', 'lorem.txt')
+        if not os.path.exists(path): self.skipTest("lorem.txt not found")
+        lorem = [x for x in open(path).read().split('\n') if x]
+        bodies = []
+        for n in range(0, len(lorem) - 1, 2):
+            html = '<p>%s</p>\n<p>%s <a href="http://example.com/%s">more</a> &amp; <em>stuff</em></p>' % (lorem[n], lorem[n+1], n)
+            bodies.append((html, '%s\n\n\n%s more & stuff' % (lorem[n], lorem[n+1])))
+        return bodies
+
+    def test_samples(self):
+        from cms.htmlutil import html_to_text
+        for (html, text, text_with_urls) in self.SAMPLES:
+            self.assertEqual(html_to_text(html, 0), text)
+            self.assertEqual(html_to_text(html, 1), text_with_urls)
+        self.assertEqual(html_to_text(u'<p>Caf\xe9</p>'), u'Caf\xe9')
+
+    def test_unterminated_reference_at_end(self):
+        from cms.htmlutil import html_to_text
+        self.assertEqual(html_to_text('foo&bar'), 'foo&bar')
+        self.assertEqual(html_to_text('&amp'), '&amp')
+        self.assertEqual(html_to_text('x&#65'), 'x&#65')
+        self.assertEqual(html_to_text('a &amp b &amp;'), 'a & b &')
+        self.assertEqual(html_to_text('<p>a &amp</p>'), 'a &')
+
+    def test_lorem_bodies(self):
+        from cms.htmlutil import html_to_text
+        for (html, text) in self._get_lorem_bodies():
+            self.assertEqual(html_to_text(html, 0), text)
+
+    def test_htmllib_equivalence(self):
+        from cms.htmlutil import html_to_text
+        corpus = [html for (html, text, text_with_urls) in self.SAMPLES] + [
+            # Entities and character references.
+            '<p>&amp; &lt;tag&gt; &quot;q&quot; &nbsp;x&#160;y &#x41; &#65;&#66;x &eacute; &bogus; &copy;2012</p>',
+            'AT&T and a&b; c &amp d &#8212; &mdash; &hellip;',
+            '<a href="/a?x=1&amp;y=2&#65;&#233;&bogus;&#x41;">l</a> <a href=/u&amp;v>l</a>',
+            # Nested block tags.
+            '<div><h1>Head <em>em</em></h1><div><p>One <strong>two <em>three</em></strong></p><blockquote><p>Quote</p></blockquote></div></div>',
+            '<ol><li>One<ul><li>Inner <a href="/x">x</a></li></ul></li><li>Two</li></ol>',
+            '<table><tr><td>A</td><td>B<br>C</td></tr></table>',
+            '<h2><a href="http://example.com/a?b=1&amp;c=2">Link <b>bold</b></a></h2>After',
+            # Script, style and head.
+            '<script type="text/javascript">if (a < b && c > d) { document.write("<p>x</p>"); }</script><p>Text</p>',
+            '<style>p { color: red; }</style><p>Styled</p>',
+            '<head><title>T</title><script>x</script></head><body><p>B</p></body>',
+            '<p>a</p><script>one</script>between<script>two</script><p>c</p><script><!-- x </script>y',
+            # Malformed markup.
+            '<p>Unclosed <b>bold <i>italic</p><p>next',
+            '<p>Stray </em> end</b> tags</p>',
+            '<a href="/one">one <a href="/two">two</a> three',
+            '<p>1 < 2 and 3 > 2</p><b>x</b >y',
+            '<p class=unquoted title=\'single\'>attrs</p><img src=x.png/><br/>a<br />b',
+            '<p>Trailing &amp',
+            '<!-- unterminated comment <p>x</p>',
+            '<![CDATA[data]]><?php echo 1 ?><!DOCTYPE html><p>y</p><?xml bad',
+            '<P>Upper <BR>case</P><A HREF="/u">U</A>',
+            '<ul><li>a<li>b</ul><h1>open heading <p>para</h1>',
+        ]
+        for html in corpus:
+            for show_link_urls in (0, 1):
+                self.assertEqual(html_to_text(html, show_link_urls), _htmllib_html_to_text(html, show_link_urls))
+
+class SearchCacheTests(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        from cms.searchcache import SearchCache
+        return SearchCache(ttl=60, settle=0, **kwargs)
+
+    def test_get_key(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get_key(fulltext=' foo  bar', _object_type=['folder', 'article'], start=0),
+                         cache.get_key(fulltext='foo bar', _object_type=['article', 'folder'], start=0, title=None))
+        self.assertNotEqual(cache.get_key(fulltext='foo', start=0), cache.get_key(fulltext='foo', start=10))
+        # Cursors are positional.
+        self.assertNotEqual(cache.get_key(search_after=[100, 200, 'a#1']), cache.get_key(search_after=[200, 100, 'a#1']))
+        self.assertNotEqual(cache.get_key(search_after=['foo  bar', 'a#1']), cache.get_key(search_after=['foo bar', 'a#1']))
+        self.assertNotEqual(cache.get_key(search_after=[1, 1, 'a#1']), cache.get_key(search_after=[1, 'a#1']))
+
+    def test_get_set(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', dict(took=1))
+        self.assertEqual(cache.get('a'), dict(took=1))
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+
+    def test_invalidate(self):
+        cache = self._makeOne()
+        cache.set('a', dict(took=1))
+        cache.invalidate()
+        self.assertEqual(cache.get('a'), None)
+        # Not cached while ElasticSearch may still be refreshing.
+        cache.settle = 60
+        cache.set('a', dict(took=1))
+        self.assertEqual(cache.get('a'), None)
+        # Results of a search that started before an invalidation aren't cached.
+        cache.settle = 0
+        generation = cache.generation
+        cache.invalidate()
+        cache.set('a', dict(took=1), generation)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_expiry_and_size(self):
+        cache = self._makeOne(max_size=1)
+        cache.set('a', dict(took=1))
+        cache.set('b', dict(took=2))
+        self.assertEqual(cache.get('a'), None)
+        cache.ttl = -1
+        cache.set('c', dict(took=3))
+        self.assertEqual(cache.get('c'), None)
+
+class SearchAfterTests(unittest.TestCase):
+
+    def test_parse_sort(self):
+        from cms.searchafter import parse_sort, format_sort, get_full_sort, can_search_after
+        sort = parse_sort('_object_type, _created:desc')
+        self.assertEqual(sort, [('_object_type', 1), ('_created', -1)])
+        self.assertEqual(format_sort(get_full_sort(sort)), '_object_type:asc,_created:desc,_uid:desc')
+        self.assertTrue(can_search_after(sort))
+        self.assertFalse(can_search_after(parse_sort('_score')))
+        self.assertFalse(can_search_after(parse_sort(None)))
+
+    def test_get_search_after_filter(self):
+        from cms.searchafter import get_search_after_filter
+        f = get_search_after_filter([('_created', -1), ('_uid', -1)], [1000, 'article#1'])
+        self.assertEqual(f.serialize(), {'or': [
+            {'range': {'_created': {'to': 1000, 'include_upper': False}}},
+            {'and': [{'term': {'_created': 1000}}, {'range': {'_uid': {'to': 'article#1', 'include_upper': False}}}]},
+        ]})
+
+class SearchPageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_total_and_facets_ignore_cursor(self):
+        from cms.resources import Root
+        hits = [dict(_id='%024x' % i, sort=[1000 - i, 'article#%s' % i]) for i in range(5)]
+        bodies = []
+        class DummyConn(object):
+            def search_raw(self, body, index, sort=None):
+                bodies.append(body)
+                if 'filter' in body:
+                    # Like ElasticSearch, only count the hits after the cursor.
+                    result = hits[2:]
+                else:
+                    result = hits
+                return dict(took=1, hits=dict(total=len(result), hits=result[:body['size']]),
+                            facets={'_object_type': dict(terms=[dict(term='article', count=5)])})
+        request = testing.DummyRequest()
+        request.registry.settings = dict(es_conn=DummyConn(), es_name='cms')
+        root = Root(request)
+        root.get_content_by_id = lambda _id: _id
+        page1 = root.search_page('_created:desc', size=2, facets=['_object_type'])
+        page2 = root.search_page('_created:desc', size=2, token=page1['next_token'], facets=['_object_type'])
+        self.assertEqual((page1['total'], page2['total']), (5, 5))
+        self.assertEqual(page2['facets'], page1['facets'])
+        self.assertEqual([str(x['object']) for x in page2['items']], [hits[2]['_id'], hits[3]['_id']])
+        # The cursor is a top-level filter (which facets ignore), not part of the query.
+        self.assertEqual(bodies[1]['query'], bodies[0]['query'])
+        self.assertTrue('filter' in bodies[1])
+        prev = root.search_page('_created:desc', size=2, token=page2['prev_token'], facets=['_object_type'])
+        self.assertEqual(prev['total'], 5)
+
+class AdvancedSearchExportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_anonymous_export_leaves_out_private_content(self):
+        import json
+        from bson.objectid import ObjectId
+        from webob.multidict import MultiDict
+        from cms.views import advanced_search_export
+        self.config.testing_securitypolicy(userid=None)
+        db = DummyMongoDB()
+        views = dict(public=['system.Everyone'], private=['group:editor'])
+        hits = []
+        for name in ('public', 'private'):
+            _id = db['content'].save(dict(_path='/' + name, _object_type='article', _view=views[name]))
+            hits.append(dict(_id=str(_id), _view=views[name]))
+        def find_view_terms(node):
+            if isinstance(node, dict):
+                if '_view' in node.get('terms', {}): return node['terms']['_view']
+                node = node.values()
+            if isinstance(node, list):
+                for x in node:
+                    terms = find_view_terms(x)
+                    if terms is not None: return terms
+            return None
+        class DummyConn(object):
+            def search_raw(self, body, index, sort=None, scroll=None):
+                principals = find_view_terms(body)
+                result = [x for x in hits if (principals is None) or set(principals).intersection(x['_view'])]
+                return dict(hits=dict(total=len(result), hits=result), _scroll_id='1')
+            def _send_request(self, method, path, body=None, params={}):
+                return dict(hits=dict(total=0, hits=[]), _scroll_id='1')
+        request = _makeContentRequest(db)
+        request.registry.settings.update(es_conn=DummyConn())
+        request.params = MultiDict(format='json')
+        root = _makeContentRoot(request, ObjectId())
+        response = advanced_search_export(root, request)
+        rows = json.loads(''.join(response.app_iter))
+        self.assertEqual([x['path'] for x in rows], ['/public'])
+
+class SearchFacetsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_get_search_facets(self):
+        import datetime, pytz
+        from cms.resources import Root
+        root = Root(testing.DummyRequest())
+        root._facet_sections = [dict(_id=1, __name__='news', title='News'), dict(_id=2, __name__='about', title='About')]
+        result = dict(facets={
+            '_object_type': dict(terms=[dict(term='article', count=5), dict(term='folder', count=2)]),
+            '_modified': dict(entries=[dict(time=1325376000000, count=7)]),
+            '_section:1': dict(count=6),
+            '_section:2': dict(count=0),
+        })
+        facets = root.get_search_facets(result)
+        self.assertEqual(facets['_object_type'], [('article', 5), ('folder', 2)])
+        self.assertEqual(facets['_modified'], [(datetime.datetime(2012, 1, 1, tzinfo=pytz.utc), 7)])
+        self.assertEqual(facets['_section'], [dict(_id=1, __name__='news', title='News', count=6)])
+        self.assertFalse('_pub_state' in facets)
+        self.assertEqual(root.get_search_facets(dict(hits={})), {})
+
+class HistoryKeyframeTests(unittest.TestCase):
+
+    def setUp(self):
+        from cms.resources.history import revision_cache
+        revision_cache.clear()
+
+    def _makeOne(self, previous=None, items=()):
+        from cms.resources.history import HistoryCollection
+        class DummyCollection(object):
+            def find_one(self, spec, **kwargs):
+                return previous
+        class DummyHistoryCollection(HistoryCollection):
+            def _get_collection(self):
+                return DummyCollection()
+            def _get_reconstruction_history(self, obj, history_ids):
+                return list(items)
+        return DummyHistoryCollection(testing.DummyRequest())
+
+    def test_get_keyframe_fields(self):
+        changes = [('title', 'Old')]
+        self.assertEqual(self._makeOne().get_keyframe_fields(1, changes, {}), dict(chain_length=1, chain_size=8))
+        hc = self._makeOne(dict(chain_length=3, chain_size=100))
+        self.assertEqual(hc.get_keyframe_fields(1, changes, {}), dict(chain_length=4, chain_size=108))
+        hc = self._makeOne(dict(chain_length=49, chain_size=100))
+        self.assertEqual(hc.get_keyframe_fields(1, changes, dict(title='New')), dict(snapshot=dict(title='New'), chain_length=0, chain_size=0))
+        hc = self._makeOne(dict(chain_length=1, chain_size=256 * 1024))
+        self.assertTrue('snapshot' in hc.get_keyframe_fields(1, changes, {}))
+
+    def test_apply_history_from_keyframe(self):
+        class DummyContent(object):
+            _id = 'a'
+            title = 'Three'
+            body = 'Body'
+            def get_schema_values(self):
+                return dict(title=self.title, body=self.body)
+            def update(self, **kwargs):
+                self.__dict__.update(kwargs)
+        items = [
+            dict(_id=3, action='edit', changes=[('title', 'Two')]),
+            # A bogus patch before the keyframe shows that it isn't replayed.
+            dict(_id=2, action='edit', changes=[('title', 'One')], snapshot=dict(title='Two (keyframe)')),
+            dict(_id=1, action='create'),
+        ]
+        obj = DummyContent()
+        self._makeOne(items=items).apply_history(obj, 2)
+        self.assertEqual((obj.title, obj.body), ('Two (keyframe)', 'Body'))
+        obj = DummyContent()
+        self._makeOne(items=items).apply_history(obj, 1)
+        self.assertEqual(obj.title, 'One')
+        diffs = self._makeOne(items=items).get_history_diffs(DummyContent(), 1, 2)
+        self.assertEqual(diffs['title']['after'], 'Two (keyframe)')
+        self.assertRaises(ValueError, self._makeOne(items=items).apply_history, DummyContent(), 4)
+
+class HistoryStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        from cms.resources.history import revision_cache
+        revision_cache.clear()
+
+    def test_reconstruction_history(self):
+        from cms.resources.history import HistoryCollection, RECONSTRUCTION_FIELDS
+        test = self
+        class StreamingCursor(DummyCursor):
+            fetched = 0
+            def batch_size(self, size):
+                self.size = size
+            def __iter__(self):
+                for doc in self.docs:
+                    self.fetched += 1
+                    yield doc
+        cursor = StreamingCursor([dict(_id=3, action='edit', changes=[('title', 'Two')]), dict(_id=2, action='edit', changes=[('title', 'One')]), dict(_id=1, action='edit', changes=[])])
+        class DummyCollection(object):
+            def find(self, spec=None, sort=None, fields=None):
+                if fields == ['time', 'chain_length']: return []
+                test.assertEqual(spec['$or'], [{'action':{'$in':['edit', 'revert']}}, {'_id':{'$in':[2]}}])
+                test.assertEqual(fields, RECONSTRUCTION_FIELDS)
+                return cursor
+        class DummyHistoryCollection(HistoryCollection):
+            def _get_collection(self):
+                return DummyCollection()
+        class DummyContent(object):
+            _id = 'a'
+            title = 'Three'
+            def get_schema_values(self):
+                return dict(title=self.title)
+            def update(self, **kwargs):
+                self.__dict__.update(kwargs)
+        obj = DummyContent()
+        DummyHistoryCollection(testing.DummyRequest()).apply_history(obj, 2)
+        self.assertEqual(obj.title, 'Two')
+        # Stopped at the target.
+        self.assertEqual(cursor.fetched, 2)
+        self.assertFalse(cursor.counted)
+
+class RevisionCacheTests(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        from cms.resources.history import RevisionCache
+        return RevisionCache(**kwargs)
+
+    def test_get_set(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('a', 1), None)
+        values = dict(title='One', tags=['x'])
+        cache.set('a', 1, 10, values)
+        (time, cached) = cache.get('a', 1)
+        self.assertEqual((time, cached), (10, values))
+        # Callers get copies.
+        cached['tags'].append('y')
+        self.assertEqual(cache.get('a', 1)[1], values)
+        self.assertEqual(cache.get_stats()['hits'], 2)
+        self.assertEqual(cache.get_stats()['misses'], 1)
+
+    def test_limits(self):
+        cache = self._makeOne(max_size=2, max_chars=100)
+        cache.set('a', 1, 10, dict(title='One'))
+        cache.set('a', 2, 20, dict(title='Two'))
+        cache.get('a', 1)
+        cache.set('b', 1, 30, dict(title='Three'))
+        self.assertEqual(cache.get('a', 2), None)
+        self.assertNotEqual(cache.get('a', 1), None)
+        cache.set('c', 1, 40, dict(body='x' * 95))
+        self.assertEqual(cache.get_stats()['size'], 1)
+        self.assertTrue(cache.get_stats()['chars'] <= 100)
+        cache.set('c', 2, 40, dict(body='x' * 200))
+        self.assertEqual(cache.get('c', 2), None)
+
+    def test_invalidate(self):
+        cache = self._makeOne()
+        cache.set('a', 1, 10, dict(title='One'))
+        cache.set('a', 2, 20, dict(title='Two'))
+        cache.set('b', 1, 30, dict(title='Three'))
+        cache.invalidate('a')
+        self.assertEqual(cache.get('a', 1), None)
+        self.assertEqual(cache.get('a', 2), None)
+        self.assertNotEqual(cache.get('b', 1), None)
+        self.assertEqual(cache.get_stats()['chars'], len('title') + len('Three'))
+
+    def test_history_collection_uses_cache(self):
+        from cms.resources.history import HistoryCollection, revision_cache
+        revision_cache.clear()
+        class DummyHistoryCollection(HistoryCollection):
+            walked = 0
+            def _get_reconstruction_history(self, obj, history_ids):
+                self.walked += 1
+                return [dict(_id=2, time=20, action='edit', changes=[('title', 'One')]), dict(_id=1, time=10, action='create')]
+        class DummyContent(object):
+            _id = 'a'
+            title = 'Two'
+            def get_schema_values(self):
+                return dict(title=self.title)
+            def update(self, **kwargs):
+                self.__dict__.update(kwargs)
+        hc = DummyHistoryCollection(testing.DummyRequest())
+        diffs = hc.get_history_diffs(DummyContent(), 2, 1)
+        self.assertEqual((diffs['title']['before'], diffs['title']['after']), ('One', 'Two'))
+        self.assertEqual(hc.get_history_diffs(DummyContent(), 1, 2), diffs)
+        obj = DummyContent()
+        hc.apply_history(obj, 1)
+        self.assertEqual(obj.title, 'One')
+        self.assertEqual(hc.walked, 1)
+        revision_cache.clear()
+
+class PatchDictionaryTests(unittest.TestCase):
+
+    def _reference_patch(self, fd, patch):
+        # The former copy-and-scan implementation of patch_flattened_dictionary().
+        import copy
+        from cms.diffutil import dmp
+        patched = copy.copy(fd)
+        lengths = {}
+        for (name, value) in patch:
+            if name.endswith('__len__'):
+                lengths[name[:-8]] = value
+            elif type(value) in (str, unicode) and value.startswith('@@ '):
+                value = dmp.patch_apply(dmp.patch_fromText(value), patched.get(name, ''))[0]
+            patched[name] = value
+        for (listname, length) in lengths.items():
+            prefix = listname + '['
+            for name in patched.keys():
+                if name.startswith(prefix):
+                    tmp = name[len(prefix):]
+                    if int(tmp[:tmp.index(']')]) >= length: del patched[name]
+        return patched
+
+    def _get_versions(self):
+        versions = []
+        for i in range(30):
+            versions.append(dict(
+                title = 'Version %s' % i,
+                body = 'Lorem ipsum dolor sit amet. ' * 20 + str(i),
+                attachments = [dict(name='file%s' % j, sizes=[j, i]) for j in range(200 - i * 5)],
+            ))
+        return versions
+
+    def test_patch_dictionary_multi(self):
+        from cms.diffutil import diff_dictionaries, flatten_dictionary, patch_flattened_dictionary_multi, patch_dictionary_multi
+        versions = self._get_versions()
+        # Reverse patches, as logged in the edit history.
+        patches = [diff_dictionaries(versions[i], versions[i+1]) for i in range(len(versions) - 1)]
+        patches.reverse()
+        fd = flatten_dictionary(versions[-1])
+        expected = fd
+        for patch in patches:
+            expected = self._reference_patch(expected, patch)
+        self.assertEqual(patch_flattened_dictionary_multi(fd, patches), expected)
+        self.assertEqual(fd, flatten_dictionary(versions[-1]))
+        self.assertEqual(patch_dictionary_multi(versions[-1], patches)['attachments'], versions[0]['attachments'])
+
+    def test_nested_list_truncation(self):
+        from cms.diffutil import patch_flattened_dictionary
+        fd = {'a.__len__':2, 'a[0].b.__len__':2, 'a[0].b[0]':1, 'a[0].b[1]':2, 'a[1].b.__len__':1, 'a[1].b[0]':3, 'c[x]':4}
+        self.assertEqual(patch_flattened_dictionary(fd, [('a.__len__', 1), ('a[0].b.__len__', 1)]),
+            {'a.__len__':1, 'a[0].b.__len__':1, 'a[0].b[0]':1, 'c[x]':4})
+
+    def test_list_item_changes(self):
+        # Inserting, removing and moving list items (identified by key)
+        # patches the same with the index as without it.
+        from cms.diffutil import diff_dictionaries, flatten_dictionary, patch_flattened_dictionary_multi, patch_dictionary_multi
+        items = [dict(key='k%s' % i, tags=['t%s' % i] * (i % 3)) for i in range(20)]
+        versions = [dict(items=list(items))]
+        for step in range(10):
+            items = list(items)
+            items.insert(step * 2, dict(key='new%s' % step, tags=['new']))        # insert
+            del items[-1 - step]                                                    # remove
+            items.append(items.pop(step))                                           # move to the end
+            items.insert(0, items.pop(len(items) // 2))                             # move to the start
+            if step % 3 == 0: del items[5:8]                                        # remove several
+            versions.append(dict(items=items))
+        patches = [diff_dictionaries(versions[i], versions[i+1]) for i in range(len(versions) - 1)]
+        patches.reverse()
+        fd = flatten_dictionary(versions[-1])
+        expected = fd
+        for patch in patches:
+            expected = self._reference_patch(expected, patch)
+        self.assertEqual(patch_flattened_dictionary_multi(fd, patches), expected)
+        self.assertEqual(patch_dictionary_multi(versions[-1], patches), versions[0])
+
+    def test_list_key_index(self):
+        from cms.diffutil import ListKeyIndex
+        index = ListKeyIndex(['a.__len__', 'a[0].b', 'a[1].b', 'a[1].c[0]', 'a[3].b', 'x'])
+        self.assertEqual(sorted(index.pop_items('a', 1)), ['a[1].b', 'a[1].c[0]', 'a[3].b'])
+        self.assertEqual(index.pop_items('a', 1), [])
+        self.assertEqual(index.pop_items('a[1].c', 0), [])
+        index.add('a[2].b')
+        self.assertEqual(index.pop_items('a', 0), ['a[0].b', 'a[2].b'])
+
+class DiffStrategyTests(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        from cms.diffutil import DiffStrategy
+        return DiffStrategy(**kwargs)
+
+    def test_get_change(self):
+        from cms.diffutil import patch_flattened_dictionary
+        strategy = self._makeOne(line_mode_size=1000)
+        old = ''.join(['<p>Paragraph %s of the old body.</p>\n' % i for i in range(100)])
+        new = old.replace('Paragraph 50 of the old', 'Paragraph 50 of the new')
+        self.assertEqual(strategy.get_strategy(old, new), 'lines')
+        self.assertEqual(strategy.get_strategy('Short', 'Shorter'), 'value')
+        self.assertEqual(strategy.get_strategy(old.replace('\n', ''), new.replace('\n', '')), 'chars')
+        for (before, after) in ((old, new), (old.replace('\n', ''), new.replace('\n', ''))):
+            change = strategy.get_change('body', before, after)
+            self.assertTrue(change.startswith('@@ '))
+            self.assertEqual(patch_flattened_dictionary({'body':after}, [('body', change)]), {'body':before})
+        # A patch bigger than the old value isn't worth it.
+        self.assertEqual(strategy.get_change('title', 'A fairly long title', 'Something else entirely'), 'A fairly long title')
+        self.assertEqual(strategy.get_change('title', 'Title', 'Other'), 'Title')
+        stats = strategy.get_stats()
+        self.assertEqual(stats['fields']['body']['count'], 2)
+        self.assertEqual(stats['fields']['title']['count'], 1)
+        self.assertEqual(stats['strategies'], dict(lines=1, chars=1, value=1))
+
+    def test_diff_flattened_dictionaries(self):
+        from cms.diffutil import diff_dictionaries, patch_dictionary, diff_strategy
+        diff_strategy.clear()
+        old = dict(title='Old title', body='Lorem ipsum dolor sit amet. ' * 50, attachments=[dict(name='a')])
+        new = dict(title='New title', body=old['body'] + 'More.', attachments=[dict(name='b')])
+        patch = diff_dictionaries(old, new)
+        self.assertEqual(patch_dictionary(new, patch), old)
+        self.assertEqual(diff_strategy.get_stats()['fields'].keys(), ['body'])
+        diff_strategy.clear()
+
+class ContentPathTests(unittest.TestCase):
+
+    def setUp(self):
+        from bson.objectid import ObjectId
+        from cms.resources import Folder, Article
+        self.config = testing.setUp()
+        self.db = DummyMongoDB()
+        self.root_id = ObjectId()
+        root = self._makeRoot()
+        root.add_child('a', Folder(root.request, title='A'))
+        root['a'].add_child('b', Folder(root.request, title='B'))
+        root['a']['b'].add_child('c', Article(root.request, title='C', body='<p>C</p>'))
+        root.add_child('x', Folder(root.request, title='X'))
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _makeRoot(self):
+        # A fresh request (so a fresh identity map) on the same database.
+        return _makeContentRoot(_makeContentRequest(self.db), self.root_id)
+
+    def _getDoc(self, name):
+        return [doc for doc in self.db['content'].docs.values() if doc['__name__'] == name][0]
+
+    def _assertPaths(self, expected):
+        for (name, path) in expected.items():
+            doc = self._getDoc(name)
+            self.assertEqual(doc['_path'], path)
+            ids = [self.root_id]
+            for ancestor in path.split('/')[1:-1]:
+                if ancestor == 'trash': ids.append('trash')
+                else: ids.append([x['_id'] for x in self.db['content'].docs.values() if (x['__name__'] == ancestor) or (str(x['_id']) == ancestor)][0])
+            self.assertEqual(doc['_ancestor_ids'], ids)
+
+    def test_preload_path(self):
+        root = self._makeRoot()
+        collection = self.db['content']
+        collection.finds = []
+        obj = root.preload_path(('a', 'b', 'c', 'edit'))
+        self.assertEqual(obj.get_path(), '/a/b/c')
+        self.assertEqual(len(collection.finds), 1)
+        self.assertTrue(root['a']['b']['c'] is obj)
+        self.assertEqual(len(collection.finds), 1)
+
+    def test_preload_path_stops_at_mismatch(self):
+        root = self._makeRoot()
+        self.assertEqual(root.preload_path(('x', 'b')).get_path(), '/x')
+        self.assertEqual(root.preload_path(('nope', 'a')), root)
+        self.assertEqual(root.preload_path(()), root)
+
+    def test_traverser(self):
+        from cms.traversal import ContentPathTraverser
+        root = self._makeRoot()
+        collection = self.db['content']
+        collection.finds = []
+        request = root.request
+        request.environ['PATH_INFO'] = '/a/b/c/edit'
+        info = ContentPathTraverser(root)(request)
+        self.assertEqual(info['context'].get_path(), '/a/b/c')
+        self.assertEqual(info['view_name'], 'edit')
+        self.assertEqual(len(collection.finds), 1)
+
+    def test_rename(self):
+        self._makeRoot().rename_child('a', 'z')
+        self._assertPaths({'z': '/z', 'b': '/z/b', 'c': '/z/b/c', 'x': '/x'})
+
+    def test_move(self):
+        root = self._makeRoot()
+        root['x'].move_child(root['a']['b'])
+        self._assertPaths({'a': '/a', 'b': '/x/b', 'c': '/x/b/c'})
+        root = self._makeRoot()
+        self.assertEqual(root.get_content_by_id(self._getDoc('c')['_id']).get_path(), '/x/b/c')
+
+    def test_trash(self):
+        root = self._makeRoot()
+        a_id = self._getDoc('a')['_id']
+        root['trash'].move_child(root['a'])
+        self._assertPaths({str(a_id): '/trash/%s' % a_id, 'b': '/trash/%s/b' % a_id, 'c': '/trash/%s/b/c' % a_id})
+
+    def test_update_paths_in_batches(self):
+        from cms.resources import folder
+        collection = self.db['content']
+        # Rename "a" behind the descendants' backs.
+        collection.docs[self._getDoc('a')['_id']]['__name__'] = 'z'
+        a = self._makeRoot()['z']
+        collection.finds = []
+        saved = folder.UPDATE_BATCH_SIZE
+        folder.UPDATE_BATCH_SIZE = 1
+        try:
+            folder.update_paths_recursively(a)
+        finally:
+            folder.UPDATE_BATCH_SIZE = saved
+        self._assertPaths({'b': '/z/b', 'c': '/z/b/c'})
+        # One query per level of folders, one bulk round trip per UPDATE_BATCH_SIZE updates.
+        self.assertEqual(len(collection.finds), 2)
+        self.assertEqual(collection.bulk_executes, 2)
+
+class GetContentByIdTests(unittest.TestCase):
+
+    def setUp(self):
+        from bson.objectid import ObjectId
+        from cms.resources import Folder, Article
+        self.config = testing.setUp()
+        self.db = DummyMongoDB()
+        self.root_id = ObjectId()
+        root = self._makeRoot()
+        root.add_child('a', Folder(root.request, title='A'))
+        root['a'].add_child('b', Folder(root.request, title='B'))
+        root['a']['b'].add_child('c', Article(root.request, title='C', body=''))
+        root.add_child('x', Folder(root.request, title='X'))
+        self.ids = dict([(doc['title'], doc['_id']) for doc in self.db['content'].docs.values()])
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _makeRoot(self):
+        return _makeContentRoot(_makeContentRequest(self.db), self.root_id)
+
+    def test_consistent_chain(self):
+        root = self._makeRoot()
+        collection = self.db['content']
+        collection.finds = []
+        obj = root.get_content_by_id(self.ids['C'])
+        self.assertEqual(obj.get_path(), '/a/b/c')
+        self.assertEqual(obj.get_id_path(), [self.root_id, self.ids['A'], self.ids['B'], self.ids['C']])
+        # The document, then all of its ancestors at once.
+        self.assertEqual(len(collection.finds), 2)
+        self.assertTrue(root.get_content_by_id(self.ids['C']) is obj)
+        self.assertTrue(root.get_content_by_id(self.ids['A']) is obj.__parent__.__parent__)
+        self.assertEqual(len(collection.finds), 2)
+
+    def test_stale_chain(self):
+        # "b" moved into "x", but the ancestor ids of "c" weren't updated (yet).
+        self.db['content'].docs[self.ids['B']]['__parent__'] = self.ids['X']
+        obj = self._makeRoot().get_content_by_id(self.ids['C'])
+        self.assertEqual(obj.get_path(), '/x/b/c')
+
+    def test_missing_ancestor(self):
+        del self.db['content'].docs[self.ids['A']]
+        self.assertEqual(self._makeRoot().get_content_by_id(self.ids['C']), None)
+        self.assertEqual(self._makeRoot().get_content_by_id(self.ids['A']), None)
+
+    def test_trashed_chain(self):
+        root = self._makeRoot()
+        root['trash'].move_child(root['a'])
+        obj = self._makeRoot().get_content_by_id(self.ids['C'])
+        self.assertEqual(obj.get_path(), '/trash/%s/b/c' % self.ids['A'])
+        self.assertTrue(obj.in_trash())
+
+class OrderedFolderTests(unittest.TestCase):
+
+    def setUp(self):
+        from bson.objectid import ObjectId
+        from cms.resources import Folder, Article
+        self.config = testing.setUp()
+        self.db = DummyMongoDB()
+        self.root_id = ObjectId()
+        root = self._makeRoot()
+        root.add_child('f', Folder(root.request, title='F'))
+        for name in ('c3', 'c1', 'c4', 'c2'):
+            root['f'].add_child(name, Article(root.request, title=name, body=''))
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _makeRoot(self):
+        return _makeContentRoot(_makeContentRequest(self.db), self.root_id)
+
+    def _getOrderedFolder(self):
+        folder = self._makeRoot()['f']
+        folder._is_ordered = True
+        folder.save()
+        return self._makeRoot()['f']
+
+    def test_init_child_positions(self):
+        folder = self._getOrderedFolder()
+        self.assertEqual(folder.get_ordered_names(), ['c1', 'c2', 'c3', 'c4'])
+        from cms.resources import Article
+        folder.add_child('c0', Article(folder.request, title='c0', body=''))
+        self.assertEqual(folder.get_ordered_names(), ['c1', 'c2', 'c3', 'c4', 'c0'])
+
+    def test_save_skips_positions_when_already_ordered(self):
+        folder = self._getOrderedFolder()
+        collection = self.db['content']
+        collection.finds = []
+        folder.save()
+        self.assertEqual(collection.finds, [])
+
+    def test_legacy_ordered_names(self):
+        collection = self.db['content']
+        doc = collection.docs[self._makeRoot()['f']._id]
+        doc['_is_ordered'] = True
+        doc['_ordered_names'] = ['c4', 'c2', 'c1']
+        folder = self._makeRoot()['f']
+        self.assertEqual(folder.get_ordered_names(), ['c4', 'c2', 'c1', 'c3'])
+        self.assertFalse('_ordered_names' in doc)
+        self.assertFalse(hasattr(folder, '_legacy_ordered_names'))
+
+    def test_reorder_by_delta(self):
+        folder = self._getOrderedFolder()
+        self.assertEqual(folder.reorder_names_down(['c1']), ['c1'])
+        self.assertEqual(folder.get_ordered_names(), ['c2', 'c1', 'c3', 'c4'])
+        self.assertEqual(folder.reorder_names_up(['c4'], delta=2), ['c4'])
+        self.assertEqual(folder.get_ordered_names(), ['c2', 'c4', 'c1', 'c3'])
+        self.assertEqual(folder.reorder_names_up(['c2']), [])
+        # Children that reach the end stack up there in the given order.
+        self.assertEqual(folder.reorder_names_down(['c2', 'c4'], delta=10), ['c4', 'c2'])
+        self.assertEqual(folder.get_ordered_names(), ['c1', 'c3', 'c2', 'c4'])
+
+    def test_reorder_to_end(self):
+        folder = self._getOrderedFolder()
+        self.assertEqual(folder.reorder_names_to_bottom(['c1']), ['c1'])
+        self.assertEqual(folder.get_ordered_names(), ['c2', 'c3', 'c4', 'c1'])
+        self.assertEqual(folder.reorder_names_to_top(['c4', 'c1']), ['c4', 'c1'])
+        self.assertEqual(folder.get_ordered_names(), ['c4', 'c1', 'c2', 'c3'])
+        self.assertEqual(folder.reorder_names_to_top(['c4']), [])
+        self.assertEqual(folder.reorder_names_to_bottom(['c2', 'c3']), [])
+
+class ExtractedTextTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_extracted_once_per_save(self):
+        from bson.objectid import ObjectId
+        from cms.resources import Article
+        from cms.htmlutil import html_text_cache
+        request = _makeContentRequest(DummyMongoDB())
+        request.registry.settings.update(es_async_indexing=False, persist_extracted_text=True)
+        root = _makeContentRoot(request, ObjectId())
+        docs = []
+        class DummyBulk(object):
+            def index(self, doctype, _id, doc):
+                docs.append(doc)
+        article = Article(request, title='A', description='', body='<p>Some &amp; body</p>')
+        article.__name__ = 'a'
+        article.__parent__ = root
+        calls = []
+        get_es_other_text = article.get_es_other_text
+        def counting_get_es_other_text(texts=None):
+            calls.append(texts)
+            return get_es_other_text(texts)
+        article.get_es_other_text = counting_get_es_other_text
+        article.save(bulk=DummyBulk())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(docs[0]['other_text'], 'Some & body')
+        key = html_text_cache.get_key('<p>Some &amp; body</p>', 0)
+        self.assertEqual(request.registry.settings['db_conn']['cms']['content'].docs[article._id]['_extracted_text'], {key: 'Some & body'})
+        # Later indexing doesn't reuse the text from the save.
+        article.body = '<p>Changed</p>'
+        self.assertEqual(article._get_es_document()['other_text'], 'Changed')
+
+class SecurityFieldsTests(unittest.TestCase):
+
+    def setUp(self):
+        from bson.objectid import ObjectId
+        from cms.resources import Folder, Article
+        from cms.authorization import ACLAuthorizationPolicyWithLocalRoles
+        self.config = testing.setUp()
+        self.config.include('pyramid_zcml')
+        self.config.load_zcml('cms:workflow.zcml')
+        self.config.testing_securitypolicy(userid='pub', groupids=['group:publisher'])
+        self.config.set_authorization_policy(ACLAuthorizationPolicyWithLocalRoles())
+        self.db = DummyMongoDB()
+        self.root = root = _makeContentRoot(_makeContentRequest(self.db), ObjectId())
+        root.add_child('f', Folder(root.request, title='F', description=''))
+        root['f'].add_child('g', Folder(root.request, title='G', description=''))
+        root['f'].add_child('a', Article(root.request, title='A', description='', body=''))
+        root['f']['g'].add_child('b', Article(root.request, title='B', description='', body=''))
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _getDocs(self):
+        return dict([(doc['title'], doc) for doc in self.db['content'].docs.values() if 'title' in doc])
+
+    def test_pub_workflow_transition_recursively(self):
+        from cms.resources.folder import update_security_recursively
+        ids = self.root['f'].pub_workflow_transition_recursively('publish')
+        docs = self._getDocs()
+        self.assertEqual(ids, set([doc['_id'] for doc in docs.values()]))
+        for doc in docs.values():
+            self.assertEqual(doc['_pub_state'], 'public')
+            self.assertTrue('system.Everyone' in doc['_view'])
+        # Nothing is left out of date (in memory or stored).
+        self.assertEqual(update_security_recursively(self.root['f']), 0)
+
+    def test_update_security_recursively(self):
+        self.root['f']['a'].pub_workflow_transition('publish')
+        docs = self._getDocs()
+        self.assertFalse('system.Everyone' in docs['A']['_view'])
+        collection = self.db['content']
+        del collection.updates[:]
+        self.db['index_queue'].docs.clear()
+        self.root['f'].pub_workflow_transition('publish')
+        docs = self._getDocs()
+        # Only A (public, in a folder that's now public) changed, with one multi-document update.
+        self.assertEqual(collection.updates, [({'_id': {'$in': [docs['A']['_id']]}}, {'$set': dict(_view=docs['A']['_view'])}, True)])
+        self.assertTrue('system.Everyone' in docs['A']['_view'])
+        for title in ('G', 'B'):
+            self.assertEqual(docs[title]['_pub_state'], 'private')
+            self.assertFalse('system.Everyone' in docs[title]['_view'])
+        # The unchanged descendants aren't reindexed either.
+        self.assertEqual(set(self.db['index_queue'].docs), set([docs['F']['_id'], docs['A']['_id']]))
+
 class FunctionalTests(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,24 @@
+from pyramid.traversal import ResourceTreeTraverser, traversal_path
+
+# Don't bother preloading absurdly deep paths (the tail is probably a view name or subpath anyway).
+MAX_PRELOAD_DEPTH = 30
+
+class ContentPathTraverser(ResourceTreeTraverser):
+    """ A traverser that resolves the content portion of the request path with
+    a single indexed query on the "_path" field of the content collection
+    (see Root.preload_path()), then lets the standard ResourceTreeTraverser
+    walk the tree.  Since the preloaded objects are in the request's identity
+    map, the walk itself doesn't hit MongoDB again.
+    """
+
+    def __call__(self, request):
+        preload_path = getattr(self.root, 'preload_path', None)
+        environ = getattr(request, 'environ', {})
+        if preload_path and ('bfg.routes.matchdict' not in environ):
+            try:
+                names = traversal_path(environ.get('PATH_INFO') or '/')
+            except (UnicodeDecodeError, ValueError):
+                names = ()
+            if names:
+                preload_path(names[:MAX_PRELOAD_DEPTH])
+        return ResourceTreeTraverser.__call__(self, request)
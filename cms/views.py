@@ -17,6 +17,9 @@ from resources.history import HistoryCollection
 from pyramid.view import render_view_to_response
 from cms import formatters
 from cms.exceptions import *
+from cms.authorization import has_permission_many, get_permitted_permissions
+from cms import searchafter
+from resources.root import FACETS
 
 # Setup a directory to override some of the deform templates.
 from pkg_resources import resource_filename
@@ -39,25 +42,27 @@ def get_actions(context, request):
                 if has_permission(EDIT, context, request):
                     actions['context'].append(dict(title='Delete', url=request.resource_url(context, 'delete')))
         elif isinstance(context, Object):
-            if has_permission(VIEW, context, request):
+            # Resolve all the permissions we need for this context in one pass.
+            permitted = get_permitted_permissions((VIEW, EDIT, ADD, SET_ROLES), context, request)
+            if VIEW in permitted:
                 actions['context'].append(dict(title='View', url=request.resource_url(context)))
-            if has_permission(EDIT, context, request):
+            if EDIT in permitted:
                 actions['context'].append(dict(title='Edit', url=request.resource_url(context, 'edit')))
             if isinstance(context, User):
-                if has_permission(EDIT, context, request):
+                if EDIT in permitted:
                     actions['context'].append(dict(title='Set password', url=request.resource_url(context, 'password')))
             if not isinstance(context, Root):
-                if has_permission(EDIT, context, request):
+                if EDIT in permitted:
                     actions['context'].append(dict(title='Rename', url=request.resource_url(context, 'rename')))
                     actions['context'].append(dict(title='Delete', url=request.resource_url(context, 'delete')))
             if isinstance(context, Folder):
-                if has_permission(VIEW, context, request):
+                if VIEW in permitted:
                     actions['context'].append(dict(title='Manage contents', url=request.resource_url(context, 'contents')))
-                if has_permission(ADD, context, request):
+                if ADD in permitted:
                     for item in getattr(context, '_allowed_child_types', []):
                         actions['add'].append(dict(title=item.capitalize(), url=request.resource_url(context, 'add', item)))
                 if not isinstance(context, Root):
-                    if has_permission(SET_ROLES, context, request):
+                    if SET_ROLES in permitted:
                         actions['context'].append(dict(title='Local roles', url=request.resource_url(context, 'local_roles')))
             if isinstance(context, Content):
                 actions['context'].append(dict(title='History', url=request.resource_url(context, 'history')))
@@ -149,7 +154,7 @@ def folder_view(context, request):
             return HTTPNotFound("%s not found" % name)
     elif context.view_style == 'redirect_first_viewable':
         if context.is_ordered():
-            children = context.get_viewable_ordered_children()
+            children = context.get_viewable_ordered_children(limit=1)
         else:
             children = context.get_viewable_sorted_children(limit=1)
         if children:
@@ -168,34 +173,22 @@ def folder_view(context, request):
     data['intro'] = context.child_list_settings['intro']
     data['outro'] = context.child_list_settings['outro']
 
-    list_item_style = context.child_list_settings['list_item_style']
-    list_item_fields = ['title']
-    if list_item_style == 'title_description':
-        list_item_fields.append('description')
-    elif list_item_style == 'title_date':
-        list_item_fields.append('date')
-    elif list_item_style == 'title_date_description':
-        list_item_fields.append('date')
-        list_item_fields.append('description')
-    elif list_item_style == 'title_description_date':
-        list_item_fields.append('description')
-        list_item_fields.append('date')
-    data['list_item_fields'] = list_item_fields
-    display_date = context.child_list_settings['display_date']
-    if display_date=='_other': display_date = context.child_list_settings['other_display_date']
-    data['display_date'] = display_date
+    data['list_item_fields'] = context.get_list_item_fields()
+    data['display_date'] = context.get_display_date_name()
 
+    # Only load the fields needed for the listing (not, say, the body of every article).
+    fields = context.get_child_listing_projection()
+    (token, per_page) = get_cursor_parms(request)
     if context.is_ordered():
-        data['items'] = context.get_viewable_ordered_children()
+        result = context.get_viewable_ordered_child_summaries_page(limit=per_page, token=token, fields=fields)
     else:
-        (page, per_page, skip) = get_pagination_parms(request)
-        result = context.get_viewable_sorted_children_and_total(skip=skip, limit=per_page)
-        data['items'] = result['items']
-        if (page > 1) and context.child_list_settings['intro_outro_first_page_only']:
-            data['intro'] = ''
-            data['outro'] = ''
-        if result['total'] > per_page:
-            data['pagination'] = render_pagination(request, page, per_page, result['total'])
+        result = context.get_viewable_sorted_child_summaries_page(limit=per_page, token=token, fields=fields)
+    data['items'] = result['items']
+    if result['has_prev'] and context.child_list_settings['intro_outro_first_page_only']:
+        data['intro'] = ''
+        data['outro'] = ''
+    if token or result['has_next']:
+        data['pagination'] = render_cursor_pagination(request, result)
     return render_to_response('templates/folder_view.pt', data, request=request)
 
 def search(context, request):
@@ -251,18 +244,10 @@ def advanced_search_form(context, request):
     data['form'] = form.render()
     return data
 
-# FIXME: check for POST and handle batch deletes and workflow transitions
-def advanced_search_results(context, request):
-    data = common_view(context, request)
-    csrf_token = request.session.get_csrf_token()
-    data['csrf_token'] = csrf_token
-    data['page_title'] = "Advanced search results"
-    fulltext = request.params.get('fulltext', '').strip()
-    title = request.params.get('title', '').strip()
-    description = request.params.get('description', '').strip()
-    __name__ = request.params.get('__name__', '').strip()
-    _object_type = request.params.getall('_object_type')
-    _pub_state = request.params.getall('_pub_state')
+def get_advanced_search_parms(context, request):
+    """ Return a dictionary of search_raw() keyword arguments from the request
+    parameters of the advanced search form.
+    """
     path_id = None
     path = request.params.get('path', '').strip()
     if path:
@@ -271,6 +256,36 @@ def advanced_search_results(context, request):
         except KeyError:
             path_id = None
             request.session.flash("Invalid path: %s" % path, 'error')
+    return dict(
+        fulltext = request.params.get('fulltext', '').strip(),
+        title = request.params.get('title', '').strip(),
+        description = request.params.get('description', '').strip(),
+        __name__ = request.params.get('__name__', '').strip(),
+        _object_type = request.params.getall('_object_type'),
+        _pub_state = request.params.getall('_pub_state'),
+        path_id = path_id,
+        # Note that we expect the sort value to be an elasticsearch-style
+        # sort string (for example, "_modified:desc" or "_object_type,_created:desc")
+        sort = request.params.get('sort', '').strip() or None,
+        # Only return what the current user may view (the form is open to anyone with the "view" permission).
+        viewable_only = True,
+    )
+
+# FIXME: check for POST and handle batch deletes and workflow transitions
+def advanced_search_results(context, request):
+    data = common_view(context, request)
+    csrf_token = request.session.get_csrf_token()
+    data['csrf_token'] = csrf_token
+    data['page_title'] = "Advanced search results"
+    parms = get_advanced_search_parms(context, request)
+    fulltext = parms['fulltext']
+    title = parms['title']
+    description = parms['description']
+    __name__ = parms['__name__']
+    _object_type = parms['_object_type']
+    _pub_state = parms['_pub_state']
+    path = request.params.get('path', '').strip()
+    sort = parms['sort']
 
     data['fulltext'] = fulltext
     data['title'] = title
@@ -279,20 +294,33 @@ def advanced_search_results(context, request):
     data['path'] = path
     data['_object_type'] = _object_type
     data['_pub_state'] = _pub_state
-
-    # Note that we expect the sort value to be an elasticsearch-style
-    # sort string (for example, "_modified:desc" or "_object_type,_created:desc")
-    sort = request.params.get('sort', '').strip() or None
     data['sort'] = sort
 
-    (page, per_page, skip) = get_pagination_parms(request)
-    result = context.search(fulltext=fulltext, title=title, description=description, __name__=__name__, _object_type=_object_type, _pub_state=_pub_state, path_id=path_id, start=skip, size=per_page, viewable_only=False, sort=sort)
-    total_items = result['total']
-    data['items'] = result['items']
-    data['total_items'] = total_items
-    data['start_num'] = (per_page * (page-1)) + 1
-    if total_items > per_page:
-        data['pagination'] = render_pagination(request, page, per_page, total_items)
+    # Keep repeated parameters (such as _object_type).
+    query = [(k, v) for (k, v) in request.GET.items() if k not in ('page', 'per_page', 'cursor')]
+    data['csv_url'] = request.resource_url(context, 'advanced_search_export', query=query + [('format', 'csv')])
+    data['json_url'] = request.resource_url(context, 'advanced_search_export', query=query + [('format', 'json')])
+
+    if searchafter.can_search_after(searchafter.parse_sort(sort)):
+        # Page with search-after cursors (deep pages stay fast).
+        (token, per_page) = get_cursor_parms(request)
+        sort = parms.pop('sort')
+        result = context.search_page(sort, size=per_page, token=token, facets=FACETS, **parms)
+        data['items'] = result['items']
+        data['total_items'] = result['total']
+        if token or result['has_next']:
+            data['pagination'] = render_cursor_pagination(request, result)
+    else:
+        (page, per_page, skip) = get_pagination_parms(request)
+        result = context.search(start=skip, size=per_page, facets=FACETS, **parms)
+        total_items = result['total']
+        data['items'] = result['items']
+        data['total_items'] = total_items
+        data['start_num'] = (per_page * (page-1)) + 1
+        if total_items > per_page:
+            data['pagination'] = render_pagination(request, page, per_page, total_items)
+
+    data['facets'] = get_refinement_facets(context, request, result['facets'])
 
     # Build up a (relatively) friendly string describing the search parameters.
     summary_parts = []
@@ -308,6 +336,96 @@ def advanced_search_results(context, request):
     data['summary'] = "You searched for "+summary
     return data
 
+def get_refinement_facets(context, request, facets):
+    """ Return a list of dictionaries (with the keys "title" and "items")
+    for displaying the facet counts of an advanced search, where each item is
+    a dictionary with the keys "title", "count" and "url" (a url to refine the
+    search, or None).
+    """
+    def get_url(name, value):
+        query = [(k, v) for (k, v) in request.GET.items() if k not in ('page', 'cursor')]
+        if name == 'path':
+            query = [(k, v) for (k, v) in query if k != 'path']
+        elif (name, value) in query:
+            return None
+        query.append((name, value))
+        return request.resource_url(context, 'advanced_search_results', query=query)
+    result = []
+    if facets.get('_object_type'):
+        result.append(dict(title='Type', items=[dict(title=term, count=count, url=get_url('_object_type', term)) for (term, count) in facets['_object_type']]))
+    if facets.get('_pub_state'):
+        result.append(dict(title='State', items=[dict(title=term, count=count, url=get_url('_pub_state', term)) for (term, count) in facets['_pub_state']]))
+    if facets.get('_section'):
+        result.append(dict(title='Section', items=[dict(title=x['title'] or x['__name__'], count=x['count'], url=get_url('path', '/'+x['__name__'])) for x in facets['_section']]))
+    if facets.get('_modified'):
+        result.append(dict(title='Modified', items=[dict(title=dt.strftime('%Y-%m'), count=count, url=None) for (dt, count) in reversed(facets['_modified'])]))
+    return result
+
+EXPORT_FIELDS = ('path', 'type', 'state', 'created', 'modified')
+
+def iter_search_export_rows(context, hits, batch_size=500):
+    """ Generate a dictionary (with the EXPORT_FIELDS keys) for each search hit.
+    Fields are loaded from mongo with one query per batch of hits.
+    """
+    collection = dbutil.get_collection(context.request, 'content')
+    def get_rows(ids):
+        docs = {}
+        for doc in collection.find({'_id': {'$in': ids}}, fields=['_path', '_object_type', '_pub_state', '_created', '_modified']):
+            docs[doc['_id']] = doc
+        for _id in ids:
+            doc = docs.get(_id)
+            if doc is None: continue
+            yield dict(path=doc.get('_path'), type=doc.get('_object_type'), state=doc.get('_pub_state'),
+                       created=doc.get('_created') and doc['_created'].isoformat(), modified=doc.get('_modified') and doc['_modified'].isoformat())
+    ids = []
+    for hit in hits:
+        ids.append(ObjectId(hit['_id']))
+        if len(ids) >= batch_size:
+            for row in get_rows(ids): yield row
+            ids = []
+    if ids:
+        for row in get_rows(ids): yield row
+
+def iter_csv(rows):
+    import csv, cStringIO
+    buffer = cStringIO.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow([unicode(row[x] or '').encode('utf-8') for x in EXPORT_FIELDS])
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def iter_json(rows):
+    import json
+    yield '['
+    separator = '\n'
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ',\n'
+    yield '\n]\n'
+
+def advanced_search_export(context, request):
+    """ Stream all the results of an advanced search as CSV or JSON
+    (depending on the "format" parameter).
+    Results are fetched with a scroll cursor and written out batch by batch,
+    so the whole result set is never in memory.
+    """
+    parms = get_advanced_search_parms(context, request)
+    format = request.params.get('format', 'csv')
+    if format not in ('csv', 'json'): return HTTPNotFound()
+    hits = context.iter_search_hits(fields=[], **parms)
+    rows = iter_search_export_rows(context, hits)
+    if format == 'json':
+        response = Response(content_type='application/json', app_iter=iter_json(rows))
+    else:
+        response = Response(content_type='text/csv', app_iter=iter_csv(rows))
+    response.content_disposition = 'attachment; filename="search_results.%s"' % format
+    return response
+
 def add_object(context, request):
     object_type = request.subpath[0]
     if object_type not in context._allowed_child_types:
@@ -497,6 +615,11 @@ def get_pagination_parms(request, default_per_page=20):
     return (page, per_page, skip)
 
 def render_pagination(request, page, per_page, total_items):
+    """ Render page number links for a result whose total is known (such as
+    an ElasticSearch search, which returns the total at no extra cost).
+    MongoDB listings page with render_cursor_pagination() instead, which
+    needs neither a count nor a skip.
+    """
     total_pages = total_items / per_page
     if total_items % per_page: total_pages += 1
     query_dict = {}
@@ -508,6 +631,31 @@ def render_pagination(request, page, per_page, total_items):
                   dict(page=page, per_page=per_page, total_items=total_items, total_pages=total_pages, get_page_url=get_page_url, significant_page_nums=get_significant_page_nums(total_pages, page)),
                   request=request)
 
+def get_cursor_parms(request, default_per_page=20):
+    """ Return a tuple of (token, per_page) for keyset pagination
+    (see keysetutil.get_page()).
+    """
+    token = request.GET.get('cursor') or None
+    try:
+        per_page = int(request.GET.get('per_page'))
+    except:
+        per_page = default_per_page
+    return (token, per_page)
+
+def render_cursor_pagination(request, result):
+    """ Render first/previous/next links for a keysetutil.get_page() result. """
+    query_dict = {}
+    query_dict.update(request.GET)
+    query_dict.pop('cursor', None)
+    query_dict.pop('page', None)
+    def get_cursor_url(token):
+        query = dict(query_dict)
+        if token: query['cursor'] = token
+        return request.resource_url(request.context, request.view_name, query=query)
+    return render('templates/cursor_pagination.pt',
+                  dict(has_prev=result['has_prev'], has_next=result['has_next'], prev_token=result['prev_token'], next_token=result['next_token'], is_first=not request.GET.get('cursor'), get_cursor_url=get_cursor_url),
+                  request=request)
+
 def get_significant_page_nums(total_pages, page):
     sig = []
     if total_pages < 14:
@@ -588,18 +736,20 @@ def collection_contents_view(context, request, default_sort=[]):
         sort = default_sort
     data['sort'] = sort
 
+    (token, per_page) = get_cursor_parms(request)
     # Note: would use context.is_ordered(), but this view is used by Collection, not just Folder.
     if getattr(context, '_is_ordered', False) and not sort:
-        children = context.get_ordered_children()
-        data['items'] = children
-        data['total_items'] = len(children)
+        result = context.get_ordered_children_page(limit=per_page, token=token)
     else:
-        (page, per_page, skip) = get_pagination_parms(request)
-        result = context.get_children_and_total(sort=sort, skip=skip, limit=per_page)
-        data['items'] = result['items']
-        data['total_items'] = result['total']
-        if result['total'] > per_page:
-            data['pagination'] = render_pagination(request, page, per_page, result['total'])
+        result = context.get_children_page(sort=sort, limit=per_page, token=token)
+    data['items'] = result['items']
+    # Only count the children for the first page (and only if there's more
+    # than one page), rather than running a count query for every page.
+    if token: data['total_items'] = None
+    elif result['has_next']: data['total_items'] = context.get_child_count()
+    else: data['total_items'] = len(result['items'])
+    if token or result['has_next']:
+        data['pagination'] = render_cursor_pagination(request, result)
     return data
 
 def folder_contents(context, request):
@@ -611,13 +761,16 @@ def folder_contents(context, request):
             orignames = request.POST.getall('orignames')
             newnames = request.POST.getall('newnames')
             renames = []
+            children = []
             for (origname, newname) in zip(orignames, newnames):
                 if origname != newname:
                     child = context.get_child(origname)
                     if child:
-                        if not has_permission(EDIT, child, request):
-                            raise HTTPForbidden("You don't have permission to rename %s." % origname)
+                        children.append(child)
                         renames.append((origname, newname))
+            for (child, permitted) in zip(children, has_permission_many(EDIT, children, request)):
+                if not permitted:
+                    raise HTTPForbidden("You don't have permission to rename %s." % child.__name__)
             try:
                 num = command.rename_children(request, context, renames)
                 msg = "Renamed %s %s." % (num, (num==1 and "item") or "items")
@@ -628,14 +781,7 @@ def folder_contents(context, request):
         elif 'delete' in request.POST:
             names = request.POST.getall('names')
             if names:
-                children_to_trash = []
-                for name in names:
-                    child = context.get_child(name)
-                    if child:
-                        if has_permission(EDIT, child, request):
-                            children_to_trash.append(child)
-                        else:
-                            raise HTTPForbidden("You don't have permission to delete %s." % name)
+                children_to_trash = _get_children_with_permission(context, request, names, EDIT, "You don't have permission to delete %s.")
                 num = command.trash_children(request, context, children_to_trash)
                 msg = "Deleted %s %s." % (num, (num==1 and "item") or "items")
                 request.session.flash(msg, 'info')
@@ -658,13 +804,8 @@ def folder_contents(context, request):
         elif 'cut' in request.POST:
             names = request.POST.getall('names')
             if names:
-                ids = []
-                for name in names:
-                    child = context.get_child(name)
-                    if child:
-                        if not has_permission(EDIT, child, request):
-                            raise HTTPForbidden("You don't have permission to delete %s." % name)
-                        ids.append(child._id)
+                children = _get_children_with_permission(context, request, names, EDIT, "You don't have permission to delete %s.")
+                ids = [child._id for child in children]
                 num = len(ids)
                 request.session[PASTE_BUFFER] = dict(op='cut', ids=ids)
                 msg = "Put %s %s in cut buffer." % (num, (num==1 and "item") or "items")
@@ -758,6 +899,21 @@ def folder_contents(context, request):
     data['page_title'] = "Manage contents"
     return data
 
+def _get_children_with_permission(context, request, names, permission, error_msg):
+    """ Return the existing children of context with the given names.
+    Raises HTTPForbidden (with error_msg formatted with the child's name) if
+    permission isn't granted on any of them.
+    Permissions for all of the children are evaluated in a single batch.
+    """
+    children = []
+    for name in names:
+        child = context.get_child(name)
+        if child: children.append(child)
+    for (child, permitted) in zip(children, has_permission_many(permission, children, request)):
+        if not permitted:
+            raise HTTPForbidden(error_msg % child.__name__)
+    return children
+
 def add_user(context, request):
     def morph_schema(context, request, schema):
         schema.children.append(colander.SchemaNode(colander.String(), name='password', title='Password', widget=deform.widget.CheckedPasswordWidget(size=20), missing='', description="If left blank, a random password will be generated."))
@@ -1205,12 +1361,12 @@ def history_view(context, request):
                 request.session.flash("Please select a single item to revert to.", 'warn')
     data = common_view(context, request)
     data['page_title'] = "History"
-    (page, per_page, skip) = get_pagination_parms(request)
+    (token, per_page) = get_cursor_parms(request)
     hc = HistoryCollection(request)
-    result = hc.get_history_for_id(context._id, skip=skip, limit=per_page)
+    result = hc.get_history_page_for_id(context._id, limit=per_page, token=token)
     data['items'] = result['items']
-    if result['total'] > per_page:
-        data['pagination'] = render_pagination(request, page, per_page, result['total'])
+    if token or result['has_next']:
+        data['pagination'] = render_cursor_pagination(request, result)
     data['csrf_token'] = csrf_token
     data['can_revert'] = can_revert
     data['hc'] = hc
@@ -44,6 +44,10 @@ setup(name='cms',
       entry_points = """\
       [paste.app_factory]
       main = cms:main
+      [console_scripts]
+      recms-sort-indexes = cms.sortindexes:main
+      recms-index-worker = cms.indexqueue:main
+      recms-reindex = cms.reindex:main
       """,
       )
 